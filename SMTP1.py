@@ -5,10 +5,139 @@ Patrick Lewis for COMP 431 Spring 2026
 HW2: More Baby-steps Towards the Construction of an SMTP Server
 """
 
+from collections import Counter, OrderedDict
 from pathlib import Path
+from typing import NamedTuple
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import io
+import json
+import mmap
+import os
+import queue
+import re
+import shutil
+import signal
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+# Character sets taken straight from the grammar in the HW1/HW2 writeups. These are shared by the
+# recursive descent Parser and the CompiledParser so that both engines recognize the same language.
+SP_CHARS = " \t"
+LETTER_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+DIGIT_CHARS = "0123456789"
+CRLF_CHARS = "\n"
+# The slash had to be escaped for this to work, just like the double quote.
+SPECIAL_CHARS = "<>()[]\\.,;:@\""
+# <char> is any printable ASCII character (32-126) except <special> or <SP>. Space is 32, so the
+# printable range starts at 33 here.
+CHAR_CHARS = "".join(chr(code) for code in range(33, 127) if chr(code) not in SPECIAL_CHARS + SP_CHARS)
+# The writeup says that we can assume the text of a message "is limited to printable text,
+# whitespace, and newlines". Printable ASCII is 32-126, which already includes the space.
+MESSAGE_TEXT_CHARS = "".join(chr(code) for code in range(32, 127)) + SP_CHARS + CRLF_CHARS
+# Message lines can be read as bytes, so these are needed as bytes as well
+CRLF_BYTES = CRLF_CHARS.encode("ascii")
+# <data-end-cmd> ::= <CRLF> "." <CRLF>, where the first <CRLF> is implied at the start of a line
+DATA_END_LINE = "." + CRLF_CHARS
+DATA_END_LINE_BYTES = DATA_END_LINE.encode("ascii")
+DATA_END_CMD = CRLF_CHARS + DATA_END_LINE
+DATA_END_CMD_BYTES = DATA_END_CMD.encode("ascii")
+
+
+def regex_char_class(chars: str) -> str:
+    """
+    Builds a regular expression character class (e.g., "[ \\t]") from a string of characters.
+    Every character is escaped so that characters like "]" and "\\" are taken literally.
+    """
+
+    if not chars:
+        raise ValueError("regex_char_class(); chars must be a non-empty string")
+
+    return "[" + "".join(re.escape(ch) for ch in chars) + "]"
+
+
+class CharacterClass:
+    """
+    A set of characters that is built once and then reused by the Parser, instead of calling
+    set(...) every time a non-terminal like <letter> or <SP> is checked. Besides the set itself,
+    it keeps a compiled pattern that matches a run of zero or more of these characters so that
+    a repetition like <string> or <whitespace> can be matched with one call.
+    """
+
+    def __init__(self, chars: str):
+        if not chars:
+            raise ValueError("CharacterClass(); chars must be a non-empty string")
+
+        self.chars = frozenset(chars)
+        """
+        The characters in this class, for single-character membership checks.
+        """
+
+        self.regex = regex_char_class(chars)
+        """
+        The regular expression character class, e.g., "[ \\t]".
+        """
+
+        self.run_re = re.compile(self.regex + "*")
+        """
+        Matches a run of zero or more characters from this class.
+        """
+
+        self.run_bytes_re = re.compile(self.regex.encode("ascii") + b"*") if chars.isascii() else None
+        """
+        The same as run_re, but for lines that were read as bytes (None if the class is not ASCII).
+        """
+
+    def __contains__(self, char: str) -> bool:
+        return char in self.chars
+
+    def __len__(self) -> int:
+        return len(self.chars)
+
 
+SP_CLASS = CharacterClass(SP_CHARS)
+LETTER_CLASS = CharacterClass(LETTER_CHARS)
+DIGIT_CLASS = CharacterClass(DIGIT_CHARS)
+LET_DIG_CLASS = CharacterClass(LETTER_CHARS + DIGIT_CHARS)
+CRLF_CLASS = CharacterClass(CRLF_CHARS)
+SPECIAL_CLASS = CharacterClass(SPECIAL_CHARS)
+CHAR_CLASS = CharacterClass(CHAR_CHARS)
+MESSAGE_TEXT_CLASS = CharacterClass(MESSAGE_TEXT_CHARS)
+
+
+# The grammar rewritten as regular expressions. Each piece mirrors a non-terminal function in the
+# Parser class, so the compiled patterns below are built from the same grammar, just once at import
+# time instead of once per character.
+RE_WHITESPACE = SP_CLASS.regex + "+"
+RE_NULLSPACE = SP_CLASS.regex + "*"
+RE_CRLF = CRLF_CLASS.regex
+RE_STRING = CHAR_CLASS.regex + "+"
+RE_ELEMENT = LETTER_CLASS.regex + LET_DIG_CLASS.regex + "*"
+RE_DOMAIN = f"{RE_ELEMENT}(?:\\.{RE_ELEMENT})*"
+# The domain is kept as a group so that CompiledParser can check its length
+RE_MAILBOX = f"{RE_STRING}@(?P<domain>{RE_DOMAIN})"
+RE_PATH = f"(?P<path><{RE_MAILBOX}>)"
+
+# The literal tokens at the beginning of a command. If these do not match, that is a 500 error.
+MAIL_FROM_PREFIX_RE = re.compile(f"MAIL{RE_WHITESPACE}FROM:")
+RCPT_TO_PREFIX_RE = re.compile(f"RCPT{RE_WHITESPACE}TO:")
+
+# Everything after the literal tokens: <nullspace> <path> <nullspace> <CRLF>
+PATH_ARGUMENTS_RE = re.compile(f"{RE_NULLSPACE}{RE_PATH}{RE_NULLSPACE}{RE_CRLF}")
+
+# <mail-from-cmd> ::= "MAIL" <whitespace> "FROM:" <nullspace> <reverse-path> <nullspace> <CRLF>
+MAIL_FROM_CMD_RE = re.compile(MAIL_FROM_PREFIX_RE.pattern + PATH_ARGUMENTS_RE.pattern)
+# <rcpt-to-cmd> ::= "RCPT" <whitespace> "TO:" <nullspace> <forward-path> <nullspace> <CRLF>
+RCPT_TO_CMD_RE = re.compile(RCPT_TO_PREFIX_RE.pattern + PATH_ARGUMENTS_RE.pattern)
 
 
 class ParserError(Exception):
@@ -22,11 +151,16 @@ class ParserError(Exception):
     If the correct message token(s) are recognized (i.e., your parser "knows"
     what message it's parsing), but some other error occurs on the line, a type
     501 error message is generated.
+
+    A type 552 error is sent at the end of a message that was too large (see
+    SMTPServer.max_message_size and SMTPServer.max_line_length). A command line that is too long
+    gets a type 500 error (RFC 5321, section 4.5.3.1.4).
     """
 
     COMMAND_UNRECOGNIZED = 500
     SYNTAX_ERROR_IN_PARAMETERS = 501
     BAD_SEQUENCE_OF_COMMANDS = 503
+    EXCEEDED_STORAGE_ALLOCATION = 552
 
     def __init__(self, error_no: int):
         self.error_no = error_no
@@ -44,10 +178,355 @@ class ParserError(Exception):
         if self.error_no == self.BAD_SEQUENCE_OF_COMMANDS:
             return "503 Bad sequence of commands"
 
+        if self.error_no == self.EXCEEDED_STORAGE_ALLOCATION:
+            return "552 Requested mail action aborted: exceeded storage allocation"
+
         # Assume 500 for anything else
         return "500 Syntax error: command unrecognized"
 
 
+REPLY_MESSAGES = {
+    250: "250 OK",
+    354: "354 Start mail input; end with <CRLF>.<CRLF>",
+    **{
+        error_no: ParserError(error_no).get_error_message()
+        for error_no in [ParserError.COMMAND_UNRECOGNIZED, ParserError.SYNTAX_ERROR_IN_PARAMETERS,
+                         ParserError.BAD_SEQUENCE_OF_COMMANDS,
+                         ParserError.EXCEEDED_STORAGE_ALLOCATION]
+    },
+}
+"""
+The text of every reply, by reply code.
+"""
+
+
+class CommandResult(NamedTuple):
+    """
+    What became of one input line, for the exception-free API (Parser.parse_command() and
+    SMTPServer.evaluate_line()). Instead of raising a ParserError, those return one of these:
+
+    - code: the reply code (250, 354, 500, 501, 503, 552), or 0 if there is no reply (a line of
+      message text)
+    - command: the command that was recognized ("MAIL FROM", "RCPT TO", "DATA"), or ""
+    - path_span: where the <path> (including "<" and ">") is in the line, as (start, end), or
+      None if no path was parsed
+    - address: the <path> and the email address in it (without "<" and ">"), as (path, email
+      address), or None if no path was parsed
+    """
+
+    code: int
+    command: str = ""
+    path_span: tuple = None
+    address: tuple = None
+
+    def is_error(self) -> bool:
+        """
+        Returns True for the error codes (500 and up).
+        """
+
+        return self.code >= ParserError.COMMAND_UNRECOGNIZED
+
+    def reply(self) -> str:
+        """
+        Returns the text of the reply, the same as the success message or the ParserError of the
+        exception-based API, or "" if there is no reply.
+        """
+
+        return REPLY_MESSAGES.get(self.code, "")
+
+
+class LineRecord(NamedTuple):
+    """
+    What SMTPServer.process_lines() yields for every input line:
+
+    - echo: the line exactly as it was read (text or bytes), to be echoed
+    - reply: the text of the reply without a newline, or "" if there is no reply
+    - ok: False if an unexpected error occurred; no more lines are handled after that
+    """
+
+    echo: str | bytes
+    reply: str = ""
+    ok: bool = True
+
+
+class ResponseWriter:
+    """
+    Collects everything the program writes to stdout (the echoed input lines and the replies) and
+    writes it out in large pieces instead of flushing after every line. The output is flushed only
+    at these points:
+
+    - when flush() is called, e.g., at the end of the input
+    - after every line when running interactively (someone is typing at a terminal), so that each
+      reply shows up right away
+    - once at least flush_threshold characters are waiting
+
+    Both text and bytes can be written. If the stream has a binary buffer underneath (like
+    sys.stdout does), everything is encoded and written to the buffer so that lines read as bytes
+    never have to be decoded; otherwise bytes are decoded and written as text. Either way, the
+    bytes that come out are exactly the same as with print() and sys.stdout.write(); only the
+    number of writes changes.
+    """
+
+    DEFAULT_FLUSH_THRESHOLD = 64 * 1024
+    """
+    How many characters may be waiting before they are written out in batch mode.
+    """
+
+    def __init__(self, stream=None, interactive: bool = None,
+                 flush_threshold: int = DEFAULT_FLUSH_THRESHOLD, echo_input: bool = True,
+                 before_flush=None):
+        """
+        :param stream: Where the output goes; defaults to sys.stdout.
+        :param interactive: Flush after every line; defaults to whether stdin is a terminal.
+        :param flush_threshold: Flush once this many characters are waiting (0 flushes every line).
+        :param echo_input: Whether echo() writes the input lines (a network client does not need
+            its own lines sent back).
+        :param before_flush: Called before anything is written out, e.g., GroupCommitDelivery.sync()
+            so that no reply is sent before its message is durable.
+        """
+
+        self.echo_input = echo_input
+        self.before_flush = before_flush
+
+        self.stream = stream if stream is not None else sys.stdout
+
+        self.binary_stream = getattr(self.stream, "buffer", None)
+        """
+        The binary buffer underneath the stream, or None if the stream only accepts text.
+        """
+
+        self.encoding = getattr(self.stream, "encoding", None) or "utf-8"
+        self.errors = getattr(self.stream, "errors", None) or "strict"
+
+        if interactive is None:
+            interactive = sys.stdin.isatty()
+        self.interactive = interactive
+
+        if flush_threshold < 0:
+            raise ValueError("flush_threshold must be zero or greater.")
+        self.flush_threshold = flush_threshold
+
+        self.pending = []
+        """
+        Output that has been written but not flushed yet; bytes if there is a binary stream,
+        otherwise text.
+        """
+
+        self.pending_size = 0
+        """
+        The number of characters (or bytes) in pending.
+        """
+
+    def write(self, data):
+        """
+        Adds text or bytes to the output and flushes if one of the flush points has been reached.
+        """
+
+        if self.binary_stream is not None:
+            if isinstance(data, str):
+                data = data.encode(self.encoding, self.errors)
+        elif not isinstance(data, str):
+            data = bytes(data).decode(self.encoding, self.errors)
+
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+        if self.interactive or self.pending_size >= self.flush_threshold:
+            self.flush()
+
+    def echo(self, line):
+        """
+        Echoes an input line exactly as it was read (it already ends with a newline, if any).
+        """
+
+        if self.echo_input:
+            self.write(line)
+
+    def reply(self, message: str):
+        """
+        Writes a reply (or any other message generated by the program) followed by a newline,
+        just like print() would.
+        """
+
+        self.write(message + "\n")
+
+    def flush(self):
+        """
+        Writes out everything that is waiting and flushes the stream.
+        """
+
+        if not self.pending:
+            self.stream.flush()
+            return
+
+        if self.before_flush is not None:
+            self.before_flush()
+
+        if self.binary_stream is None:
+            self.stream.write("".join(self.pending))
+            self.stream.flush()
+        else:
+            # Anything printed directly to the text layer (debug statements) has to go first
+            self.stream.flush()
+            self.binary_stream.write(b"".join(self.pending))
+            self.binary_stream.flush()
+
+        self.pending = []
+        self.pending_size = 0
+
+
+def read_chunked_lines(stream, chunk_size: int = 64 * 1024, max_line_length: int = None):
+    """
+    Reads a binary stream (e.g., sys.stdin.buffer) in large chunks and returns an iterator over
+    its lines as bytes, including the newline at the end (the last line might not have one).
+    Nothing is decoded here. Lines longer than max_line_length are cut short as they are read
+    (see read_limited_line()).
+
+    The splitting itself is done by a BufferedReader with a chunk_size buffer: it reads chunk_size
+    bytes at a time and cuts lines out of its buffer in C, which turned out to be several times
+    faster than looking for newlines in each chunk from Python. It also returns a line as soon as
+    it is available, so it still works when the input is typed.
+
+    :param stream: A binary stream, ideally one with a file descriptor.
+    :param chunk_size: How many bytes to read at a time.
+    :param max_line_length: The longest line (without the newline) that is kept whole, or None.
+    """
+
+    if chunk_size <= 0:
+        raise ValueError("read_chunked_lines(); chunk_size must be greater than zero")
+
+    try:
+        file_descriptor = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        # Streams that only live in memory (like io.BytesIO) are already one big buffer
+        reader = stream
+    else:
+        # closefd=False leaves sys.stdin open when this reader goes away
+        reader = open(file_descriptor, "rb", buffering=chunk_size, closefd=False)
+
+    if max_line_length is None:
+        return iter(reader)
+
+    return read_limited_lines(reader, max_line_length)
+
+
+def read_limited_line(stream, max_line_length: int = None) -> tuple:
+    """
+    Reads the next line from stream (text or binary), like stream.readline(), but keeps no more
+    than its first max_line_length + 1 characters (or bytes) and its newline: the rest is read
+    and thrown away a piece at a time, so a line that never ends does not have to fit in memory.
+    What is kept is still longer than max_line_length, so the line is still rejected as too long.
+
+    Returns (the line, how many characters or bytes were read), or an empty line at the end of
+    the input.
+    """
+
+    if max_line_length is None:
+        line = stream.readline()
+        return line, len(line)
+
+    kept_length = max_line_length + 1
+    line = stream.readline(kept_length + 1)
+    read = len(line)
+    newline = CRLF_CHARS if isinstance(line, str) else CRLF_BYTES
+
+    if len(line) <= kept_length or line.endswith(newline):
+        return line, read
+
+    line = line[:kept_length]
+    while True:
+        piece = stream.readline(64 * 1024)
+        read += len(piece)
+
+        if not piece:
+            return line, read
+
+        if piece.endswith(newline):
+            return line + newline, read
+
+
+def read_limited_lines(stream, max_line_length: int = None):
+    """
+    Yields the lines of stream (text or binary) as read by read_limited_line().
+    """
+
+    while True:
+        line, _ = read_limited_line(stream, max_line_length)
+        if not line:
+            return
+
+        yield line
+
+
+class AddressCache:
+    """
+    Remembers what became of the arguments of recent MAIL FROM and RCPT TO commands, so that an
+    address that comes up again and again does not have to go through is_path(), mailbox(),
+    domain(), etc. every time. The key is the rest of the line after the command's literal tokens,
+    without the <nullspace> around it and the newline (e.g., "<jeffay@cs.unc.edu>"); the value is
+    the <path> and the email address in it (see CommandResult.address), or None if the arguments
+    are not valid.
+
+    Once more than max_size arguments are remembered, the least recently used one is forgotten.
+    hits, misses and evictions are counted for --stats.
+    """
+
+    DEFAULT_MAX_SIZE = 1024
+    """
+    How many arguments are remembered at most by default.
+    """
+
+    MISSING = object()
+    """
+    What get() returns for arguments that are not remembered (None means "not valid").
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+
+        self.max_size = max_size
+
+        self.entries = OrderedDict()
+        """
+        The (<path>, email address) or None by arguments, from least to most recently used.
+        """
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, arguments: str):
+        """
+        Returns the (<path>, email address) remembered for arguments, None if they are not valid,
+        or MISSING if they are not remembered.
+        """
+
+        address = self.entries.get(arguments, self.MISSING)
+        if address is self.MISSING:
+            self.misses += 1
+            return address
+
+        self.hits += 1
+        self.entries.move_to_end(arguments)
+        return address
+
+    def put(self, arguments: str, address: tuple | None):
+        """
+        Remembers the (<path>, email address) in arguments (None if they are not valid),
+        forgetting the least recently used arguments if there are too many.
+        """
+
+        self.entries[arguments] = address
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
 class Parser:
     """
     This will process a string and determine whether that string conforms to a
@@ -65,22 +544,137 @@ class Parser:
     Based on the HW1 writeup,
     """
 
-    def __init__(self, input_string: str, debug_mode: bool = False):
+    COMMAND_KEYWORD_LENGTH = 4
+    """
+    Every command starts with a four-letter keyword ("MAIL", "RCPT", "DATA").
+    """
+
+    COMMAND_TABLE = {
+        "MAIL": ("MAIL FROM", re.compile(f"{RE_WHITESPACE}FROM:")),
+        "RCPT": ("RCPT TO", re.compile(f"{RE_WHITESPACE}TO:")),
+        # DATA has no arguments; it is only identified if the rest of the line is
+        # <nullspace> <CRLF>, but the cursor stays right after "DATA".
+        "DATA": ("DATA", re.compile(f"(?={RE_NULLSPACE}{RE_CRLF})")),
+    }
+    """
+    Dispatch table used to recognize commands. Maps the keyword at the beginning of a line to the
+    command name and a pattern for the rest of the literal tokens, which is matched right after
+    the keyword.
+    """
+
+    BEGINNING_POSITION = 0
+    """
+    The position of the first character of every input string.
+    """
+
+    NON_TERMINALS = (
+        "check_for_commands", "parse_command", "mail_from_cmd", "rcpt_to_cmd", "data_cmd", "data_read_msg_line",
+        "data_end_cmd", "whitespace", "nullspace", "reverse_path", "forward_path", "is_path",
+        "mailbox", "local_part", "is_string", "is_char", "domain", "element", "name",
+        "let_dig_str", "let_dig", "letter", "digit", "sp", "special", "crlf",
+    )
+    """
+    The functions that Statistics counts and times (the non-terminals, plus command recognition).
+    """
+
+    # A Parser is re-armed with load() for every line instead of being created for every line, and
+    # __slots__ keeps each instance small (no per-instance __dict__).
+    __slots__ = (
+        "input_string",
+        "position",
+        "OUT_OF_BOUNDS",
+        "command_identified",
+        "command_name",
+        "command_parsed",
+        "arguments_position",
+        "debug_mode",
+        "writer",
+        "max_label_length",
+        "max_domain_length",
+        "checked_text_position",
+        "pending_pieces",
+        "pending_length",
+        "max_line_length",
+        "discarding",
+        "address_cache",
+    )
+
+    def __init__(self, input_string: str = "", debug_mode: bool = False,
+                 writer: ResponseWriter = None, max_label_length: int = None,
+                 max_domain_length: int = None, address_cache: AddressCache = None,
+                 max_line_length: int = None):
         """
         Constructor for the Parser class.
 
         :param input_string: String from stdin to be parsed as a "MAIL FROM:" command.
+        :param writer: Where success messages are written; if None, they are printed.
+        :param max_label_length: The longest <element> allowed in a <domain>, or None.
+        :param max_domain_length: The longest <domain> allowed, or None.
+        :param address_cache: Remembers the arguments of recent commands for parse_command(), or
+            None to parse them every time.
+        :param max_line_length: The most of a line (without the newline) that feed() keeps, plus
+            one, or None to keep all of it.
+        """
+
+        self.debug_mode = debug_mode
+        """
+        If True, print additional statements that help with debugging. Turned off by default to
+        prevent changing the output for grading.
+        """
+
+        self.writer = writer
+        """
+        The ResponseWriter that success messages are written to, or None to use print().
+        """
+
+        self.max_label_length = max_label_length
+        self.max_domain_length = max_domain_length
+        """
+        Limits on the length of each <element> of a <domain> and of the whole <domain>; a longer
+        one does not match (which makes the command a 501 error). None means no limit.
+        """
+
+        self.address_cache = address_cache
+        """
+        The AddressCache used by parse_command(), or None.
+        """
+
+        self.pending_pieces = []
+        """
+        The pieces of a line that feed() has received so far, while the rest of it has not
+        arrived yet.
+        """
+
+        self.pending_length = 0
+        """
+        The number of characters (or bytes) in pending_pieces.
         """
-        self.input_string = input_string
 
+        self.max_line_length = max_line_length
+        self.discarding = False
+        """
+        Once a line that feed() is putting together is longer than max_line_length, only its first
+        max_line_length + 1 characters are kept (so that it is still known to be too long), and
+        the rest of it is thrown away as it arrives (discarding is True) until its newline.
+        """
+
+        self.load(input_string)
+
+    def load(self, input_string: str):
+        """
+        Re-arms the parser with a new input string so that the same Parser object can be used for
+        every line that is read, instead of creating a new one each time.
+
+        :param input_string: The next line to be parsed.
+        """
+
+        self.input_string = input_string
 
-        self.BEGINNING_POSITION = 0
         self.position = self.BEGINNING_POSITION
         """
         The position of the "cursor", like in SQL, of the current character.
         """
 
-
         self.OUT_OF_BOUNDS = len(input_string)
         """
         A constant representing when the position has reached the end of the input string.
@@ -104,12 +698,109 @@ class Parser:
         can be identified but not successfully parsed.
         """
 
-        self.debug_mode = debug_mode
+        self.arguments_position = None
         """
-        If True, print additional statements that help with debugging. Turned off by default to
-        prevent changing the output for grading.
+        The position right after the literal tokens of the command found by check_for_commands(),
+        or None if no command has been identified yet.
+        """
+
+        self.checked_text_position = self.BEGINNING_POSITION
+        """
+        Everything before this position is already known to be message text (feed() checks the
+        pieces of a message line as they arrive), so data_read_msg_line() starts from here.
+        """
+
+    def feed(self, chunk, start: int = 0, message_text: bool = False) -> int:
+        """
+        Adds the next piece of a line that arrives in pieces (e.g., from a network connection).
+        Only chunk[start:] is looked at, and only once: the newline is searched for from start,
+        and with message_text=True, the new characters are checked to be message text as they
+        arrive, so that data_read_msg_line() does not scan them again.
+
+        Once the line is complete, it is loaded (as with load()) and the position in chunk right
+        after its newline is returned. If chunk[start:] has no newline, it is kept until the rest
+        of the line arrives, and -1 is returned. The chunk can be either text or bytes.
+
+        A line is never kept past max_line_length + 1 characters while it is waiting for its
+        newline; see discarding.
+        """
+
+        if isinstance(chunk, str):
+            newline, text_re = CRLF_CHARS, MESSAGE_TEXT_CLASS.run_re
+        else:
+            newline, text_re = CRLF_BYTES, MESSAGE_TEXT_CLASS.run_bytes_re
+
+        newline_position = chunk.find(newline, start)
+        end = len(chunk) if newline_position < 0 else newline_position + len(newline)
+
+        if self.discarding:
+            if newline_position < 0:
+                return -1
+
+            # Only the newline is added to what was kept of the line
+            start = newline_position
+            checked = self.checked_text_position
+        else:
+            # Keep checking only while everything so far has been message text
+            checked = self.checked_text_position if self.pending_pieces else self.BEGINNING_POSITION
+            if message_text and checked == self.pending_length:
+                checked += text_re.match(chunk, start, end).end() - start
+
+        if newline_position < 0:
+            if start < end:
+                self.pending_pieces.append(chunk[start:])
+                self.pending_length += end - start
+            self.checked_text_position = checked
+
+            if self.max_line_length is not None and self.pending_length > self.max_line_length:
+                self.start_discarding()
+            return -1
+
+        line = chunk[start:end]
+        if self.pending_pieces:
+            self.pending_pieces.append(line)
+            line = line[:0].join(self.pending_pieces)
+
+        self.load_fed_line(line, checked)
+        return end
+
+    def start_discarding(self):
+        """
+        Cuts the line that feed() is putting together down to max_line_length + 1 characters and
+        throws away the rest of it as it arrives.
         """
 
+        kept_length = self.max_line_length + 1
+        line = self.pending_pieces[0][:0].join(self.pending_pieces)
+        self.pending_pieces = [line[:kept_length]]
+        self.pending_length = kept_length
+        self.checked_text_position = min(self.checked_text_position, kept_length)
+        self.discarding = True
+
+    def feed_end(self) -> bool:
+        """
+        Loads what feed() has received of a line that will never be finished (the input ended
+        without a newline). Returns False if there is nothing left.
+        """
+
+        if not self.pending_pieces:
+            return False
+
+        line = self.pending_pieces[0][:0].join(self.pending_pieces)
+        self.load_fed_line(line, self.checked_text_position)
+        return True
+
+    def load_fed_line(self, line, checked_text_position: int):
+        """
+        Loads a line put together by feed(), keeping how much of it is known to be message text.
+        """
+
+        self.pending_pieces = []
+        self.pending_length = 0
+        self.discarding = False
+        self.load(line)
+        self.checked_text_position = checked_text_position
+
     def set_command_parsed(self):
         """
         Sets the command_parsed flag.
@@ -144,33 +835,51 @@ class Parser:
         flag and command_name accordingly. This function keeps up with the original position
         and restores it after the checks are performed so that non-terminals are identified
         correctly.
+
+        Instead of trying every command one after another, the first four characters of the line
+        are looked up in COMMAND_TABLE, so the line is classified in a single pass. The position
+        right after the literal tokens is saved in arguments_position so that the full parse of
+        the recognized command can pick up from there instead of starting over.
         """
 
         start = self.position
         self.reset()
 
-        # Check for MAIL FROM
-        # The second part is not needed; if this non-terminal function returns true with
-        # check_only=True, that means either the command was identified or identified and parsed.
-        if self.mail_from_cmd(check_only=True):
-            self.rewind(start)
-            return True
-
-        self.reset()
-        if self.rcpt_to_cmd(check_only=True):
-            self.rewind(start)
-            return True
+        entry = self.COMMAND_TABLE.get(self.input_string[:self.COMMAND_KEYWORD_LENGTH])
+        if entry is not None:
+            command_name, literal_re = entry
+            match = literal_re.match(self.input_string, self.COMMAND_KEYWORD_LENGTH)
+            if match:
+                self.set_command_identified(command_name)
+                self.arguments_position = match.end()
+                self.rewind(start)
+                return True
 
-        self.reset()
-        if self.data_cmd(check_only=True):
-            self.rewind(start)
-            return True
+            # "DATA" followed by anything else is not a command, but the keyword still names it
+            # (get_command_name(), which --debug prints), as it does in data_cmd()
+            if command_name == "DATA":
+                self.command_name = command_name
 
         # This means no commands have been identified, which can mean a number of things but not
         # necessarily a problem (depending on the state of the SMTP Server)
         self.rewind(start)
         return False
 
+    def resume_command(self, command_name: str) -> bool:
+        """
+        If check_for_commands() already recognized command_name on this line, move the cursor to
+        the position right after the literal tokens and return True. Otherwise, return False
+        and leave the cursor where it is so that the literal tokens are matched as usual.
+        """
+
+        if not (self.command_identified and self.command_name == command_name):
+            return False
+
+        if self.arguments_position is None:
+            return False
+
+        return self.fast_forward(self.arguments_position)
+
     def get_input_line_raw(self) -> str:
         """
         Get the exact string passed to the parser.
@@ -180,7 +889,8 @@ class Parser:
 
     def get_input_line(self) -> str:
         """
-        Docstring for get_input_line
+        Returns the input line without the newline at the end. Message lines that were read as
+        bytes are returned as bytes.
 
         :param self: Description
         :return: Description
@@ -191,13 +901,25 @@ class Parser:
             print(f"original: {self.input_string}")
             print(f"sliced: {self.input_string[:-1]}")
 
-        if not self.input_string.endswith("\n"):
+        newline = CRLF_CHARS if isinstance(self.input_string, str) else CRLF_BYTES
+        if not self.input_string.endswith(newline):
             return self.input_string
 
         return self.input_string[:-1]
 
 
-    def get_email_address(self) -> str:
+    def get_input_line_length(self) -> int:
+        """
+        Returns the length of the input line without the newline at the end.
+        """
+
+        newline = CRLF_CHARS if isinstance(self.input_string, str) else CRLF_BYTES
+        if self.input_string.endswith(newline):
+            return self.OUT_OF_BOUNDS - len(newline)
+
+        return self.OUT_OF_BOUNDS
+
+    def get_email_address(self) -> str:
         """
         Extracts and returns the email address from the input string.
         """
@@ -241,14 +963,22 @@ class Parser:
         Prints the success message when a line is successfully parsed.
         """
 
-        if msg_no == 250:
-            print("250 OK")
-
-        if msg_no == 354:
-            print("354 Start mail input; end with <CRLF>.<CRLF>")
+        if msg_no in [250, 354]:
+            self.write_reply(REPLY_MESSAGES[msg_no])
 
         return True
 
+    def write_reply(self, message: str):
+        """
+        Writes a reply to the ResponseWriter, or prints it if there is no writer.
+        """
+
+        if self.writer is None:
+            print(message)
+            return
+
+        self.writer.reply(message)
+
 
     def current_char(self) -> str:
         """
@@ -291,10 +1021,12 @@ class Parser:
 
         <mail-from-cmd> ::= "MAIL" <whitespace> "FROM:" <nullspace> <reverse-path> <nullspace> <CRLF>
         """
-        if not (self.match_chars("MAIL") and self.whitespace() and self.match_chars("FROM:")):
-            return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
-        # Flag that the command has been identified
-        self.set_command_identified("MAIL FROM")
+        # Skip the literal tokens if check_for_commands() already matched them
+        if not self.resume_command("MAIL FROM"):
+            if not (self.match_chars("MAIL") and self.whitespace() and self.match_chars("FROM:")):
+                return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
+            # Flag that the command has been identified
+            self.set_command_identified("MAIL FROM")
 
         # If we are only checking for command recognition, we can stop here and return
         if check_only:
@@ -315,11 +1047,13 @@ class Parser:
         <rcpt-to-cmd> ::= "RCPT" <whitespace> "TO:" <nullspace> <forward-path> <nullspace> <CRLF>
         """
 
-        if not (self.match_chars("RCPT") and self.whitespace() and self.match_chars("TO:")):
-            return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
+        # Skip the literal tokens if check_for_commands() already matched them
+        if not self.resume_command("RCPT TO"):
+            if not (self.match_chars("RCPT") and self.whitespace() and self.match_chars("TO:")):
+                return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
 
-        # Flag that the command has been identified
-        self.set_command_identified("RCPT TO")
+            # Flag that the command has been identified
+            self.set_command_identified("RCPT TO")
 
         # If we are only checking for command recognition, we can stop here and return
         if check_only:
@@ -343,7 +1077,7 @@ class Parser:
 
         # This is an example of a literal string in a production rule
         # If an error occurs here, it is a 500 error
-        if not self.match_chars("DATA"):
+        if not (self.resume_command("DATA") or self.match_chars("DATA")):
             return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
 
         # Flag that the command has been identified
@@ -360,31 +1094,130 @@ class Parser:
         self.set_command_parsed()
         return self.print_success(354)
 
+    def parse_command(self, expected_commands: tuple = None) -> CommandResult:
+        """
+        Exception-free version of check_for_commands() followed by mail_from_cmd(), rcpt_to_cmd()
+        or data_cmd(), whichever command the line is. Nothing is printed; the result says what
+        the reply would be: 500 if no command is recognized, 503 if it is not one of
+        expected_commands (if given), 501 if the arguments are wrong, and 250 (with where the
+        <path> is) or 354 if the line is fine. That is the same order of precedence as
+        SMTPServer.evaluate_state(), and the arguments of an unexpected command are not parsed.
+        """
+
+        if not self.check_for_commands():
+            return CommandResult(ParserError.COMMAND_UNRECOGNIZED)
+
+        command_name = self.command_name
+        if expected_commands is not None and command_name not in expected_commands:
+            return CommandResult(ParserError.BAD_SEQUENCE_OF_COMMANDS, command_name)
+
+        self.resume_command(command_name)
+
+        # check_for_commands() only recognizes DATA if the rest of the line is <nullspace> <CRLF>
+        if command_name == "DATA":
+            self.fast_forward(self.OUT_OF_BOUNDS)
+            self.set_command_parsed()
+            return CommandResult(354, command_name)
+
+        if self.address_cache is None:
+            parsed = self.match_path()
+        else:
+            parsed = self.match_cached_path_arguments()
+
+        if parsed is None:
+            return CommandResult(ParserError.SYNTAX_ERROR_IN_PARAMETERS, command_name)
+
+        self.set_command_parsed()
+        return CommandResult(250, command_name, *parsed)
+
+    def match_path(self) -> tuple | None:
+        """
+        match_path_arguments(), but returns where the <path> is together with the <path> and the
+        email address in it, as ((start, end), (path, email address)), or None.
+        """
+
+        path_span = self.match_path_arguments()
+        if path_span is None:
+            return None
+
+        path = self.input_string[slice(*path_span)]
+        return path_span, (path, path[1:-1])
+
+    def match_cached_path_arguments(self) -> tuple | None:
+        """
+        match_path() through the address_cache: arguments that were seen recently are looked up
+        instead of being parsed again. The <nullspace> around them and the newline are not part
+        of the key, since they change neither whether the arguments are valid nor the address.
+        """
+
+        # Without the newline the arguments are not valid; that is not worth remembering
+        if not self.input_string.endswith(CRLF_CHARS):
+            return self.match_path()
+
+        start = self.span(SP_CLASS)
+        arguments = self.input_string[start:-len(CRLF_CHARS)].rstrip(SP_CHARS)
+
+        address = self.address_cache.get(arguments)
+        if address is AddressCache.MISSING:
+            parsed = self.match_path()
+            self.address_cache.put(arguments, None if parsed is None else parsed[1])
+            return parsed
+
+        if address is None:
+            return None
+
+        self.fast_forward(self.OUT_OF_BOUNDS)
+        return (start, start + len(address[0])), address
+
+    def match_path_arguments(self) -> tuple | None:
+        """
+        Matches the arguments of MAIL FROM and RCPT TO, <nullspace> <path> <nullspace> <CRLF>,
+        and returns where the <path> is as (start, end), or None if they do not match.
+        """
+
+        self.nullspace()
+        start = self.position
+
+        if not self.is_path():
+            return None
+
+        end = self.position
+
+        if not (self.nullspace() and self.crlf()):
+            return None
+
+        return start, end
+
     def data_read_msg_line(self):
         """
         Handles the reading of mail input lines after a successful DATA command.
+
+        There are no limits or constraints on what, how much text can be entered after a correct
+        DATA message other than we'll assume that text is limited to printable text, whitespace,
+        and newlines. Instead of checking one character at a time, the whole line is checked with
+        a single scan over MESSAGE_TEXT_CLASS. The line can be either text or bytes.
+
+        The caller is responsible for checking for <data-end-cmd> first (SMTPServer.evaluate_state
+        does this once per line), so it is not checked again here. Whatever feed() has already
+        checked is not scanned again.
         """
 
-        # This means to loop until we match <CRLF>.<CRLF>, or until we
-        # encounter an invalid character.
-        # I think this should work because data_end_cmd() rewinds the position
-        # if it fails to match.
-        while not self.data_end_cmd():
-            # No need to continue if there are no more characters
-            if self.is_at_end():
-                break
-            # What characters are allowed here?
-            # There are no limits or constraints on what, how much text can be
-            # entered after a correct DATA message other than we'll assume that
-            # text is limited to printable text, whitespace, and newlines.
-            if not (self.match_ascii_printable() or self.whitespace()
-                or self.crlf()):
-                # print(f"data_read_msg_line(); nothing matched...")
-                return False
+        start = max(self.position, self.checked_text_position)
+
+        # Message lines may have been read as bytes so that they never have to be decoded
+        if isinstance(self.input_string, str):
+            end = MESSAGE_TEXT_CLASS.run_re.match(self.input_string, start).end()
+        else:
+            end = MESSAGE_TEXT_CLASS.run_bytes_re.match(self.input_string, start).end()
 
+        if end != self.OUT_OF_BOUNDS:
+            # print(f"data_read_msg_line(); invalid character at position {end}")
+            return False
+
+        self.fast_forward(end)
         return True
 
-    def data_end_cmd(self):
+    def data_end_cmd(self, check_only: bool = False):
         """
         The <data-end-cmd> non-terminal handles the end of mail input,
         represented by a line containing only a period. This non-terminal has
@@ -404,27 +1237,35 @@ class Parser:
         only reading from the current position. This means that the code calling this function
         is responsible for calling it only after the "DATA" command has been successfully parsed.
 
+        Either way, the terminator is compared as a whole with a single startswith() call. The
+        line can be either text or bytes. With check_only=True, the success message is not
+        printed, so that the caller can print it once the message has been delivered.
+
         <data-end-cmd> ::= <CRLF> "." <CRLF>
         """
 
         # The line must begin with a period and nothing else
         # The beginning of a new line implies <CRLF> as defined by the
         # production rule.
-        start = self.position
+        # If we are not at the beginning of a new line, then we need to check for
+        # <CRLF> "." <CRLF> from the current position.
+        # Message lines may have been read as bytes.
+        if isinstance(self.input_string, str):
+            at_beginning, terminator = DATA_END_LINE, DATA_END_CMD
+        else:
+            at_beginning, terminator = DATA_END_LINE_BYTES, DATA_END_CMD_BYTES
 
         if self.position == self.BEGINNING_POSITION:
-            if not (self.match_chars(".") and self.crlf()):
-                self.rewind(start)
-                return False
+            terminator = at_beginning
 
-            return self.print_success()
-
-        # If we are not at the beginning of a new line, then we need to check for
-        # <CRLF> "." <CRLF> from the current position.
-        if not (self.crlf() and self.match_chars(".") and self.crlf()):
-            self.rewind(start)
+        if not self.input_string.startswith(terminator, self.position):
             return False
 
+        self.fast_forward(self.position + len(terminator))
+
+        if check_only:
+            return True
+
         return self.print_success()
 
     def is_ascii(self, char: str) -> bool:
@@ -500,6 +1341,7 @@ class Parser:
         self.command_identified = False
         self.command_name = ""
         self.command_parsed = False
+        self.arguments_position = None
         return self.rewind(self.BEGINNING_POSITION)
 
     def match_chars(self, expected: str) -> bool:
@@ -527,6 +1369,27 @@ class Parser:
 
         return True
 
+    def span(self, char_class: CharacterClass) -> int:
+        """
+        Returns the position just past the run of characters from char_class that starts at the
+        current position. If the current character is not in char_class, the current position is
+        returned. The cursor does not move.
+        """
+
+        return char_class.run_re.match(self.input_string, self.position).end()
+
+    def scan(self, char_class: CharacterClass) -> int:
+        """
+        Advances the cursor past the run of characters from char_class that starts at the current
+        position and returns how many characters were matched (0 if none).
+        """
+
+        end = self.span(char_class)
+        count = end - self.position
+        self.fast_forward(end)
+
+        return count
+
     def whitespace(self) -> bool:
         """
         Matches one or more <sp> characters. Since this non-terminal does
@@ -534,13 +1397,7 @@ class Parser:
         value.
         """
 
-        if not self.sp():
-            return False
-
-        while self.sp():
-            pass
-
-        return True
+        return self.scan(SP_CLASS) > 0
 
     def nullspace(self) -> bool:
         """
@@ -554,11 +1411,7 @@ class Parser:
         :param self: Description
         """
 
-        if self.is_at_end():
-            return True
-
-        while self.sp():
-            pass
+        self.scan(SP_CLASS)
 
         return True
 
@@ -582,33 +1435,48 @@ class Parser:
         """
         The function that handles the <domain> non-terminal, which is:
         <domain> ::= <element> | <element> "." <domain>
+
+        This used to call itself for every period, so a domain with a few thousand elements ran
+        out of Python stack (RecursionError). The rule means the same thing as
+        <element> { "." <element> }, so the elements are matched in a loop instead. A period must
+        always be followed by another element.
         """
 
         start = self.position
 
-        if not self.element():
-            # print("Domain element failed")
-            self.rewind(start)
-            return False
+        while True:
+            element_start = self.position
 
-        # Update the starting position since this succeeded!
-        start = self.position
+            if not self.element():
+                # print("Domain element failed")
+                self.rewind(start)
+                return False
 
-        if not self.match_chars("."):
-            # Since there is no period, rewind and stop here
-            # print("Domain period not found, rewinding")
-            self.rewind(start)
-            return True
+            # Stop as soon as an element (or the domain so far) is too long
+            if self.max_label_length is not None and \
+                    self.position - element_start > self.max_label_length:
+                self.rewind(start)
+                return False
 
-        # Since there is a period, see if there is another element. If not,
-        # rewind again and return False. We are rewinding to before the period
-        # since the period by itself is not enough for the "right-side" of the
-        # "or" operator in the <domain> non-terminal. Calling this checks
-        # for another element after the period.
-        if not self.domain():
+            if self.max_domain_length is not None and self.position - start > self.max_domain_length:
+                self.rewind(start)
+                return False
 
-            self.rewind(start)
-            # print(f"Rewinding after failed domain check; current position is {self.position}, start: {start}")
+            # Without a period, the domain ends here
+            if not self.match_chars("."):
+                return True
+
+    def is_domain_within_limits(self, domain: str) -> bool:
+        """
+        Checks a <domain> that has already been matched against max_label_length and
+        max_domain_length (see CompiledParser).
+        """
+
+        if self.max_domain_length is not None and len(domain) > self.max_domain_length:
+            return False
+
+        if self.max_label_length is not None and \
+                max(map(len, domain.split("."))) > self.max_label_length:
             return False
 
         return True
@@ -657,13 +1525,7 @@ class Parser:
         digit is required.
         """
 
-        if not self.let_dig():
-            return False
-
-        while self.let_dig():
-            pass
-
-        return True
+        return self.scan(LET_DIG_CLASS) > 0
 
     def let_dig(self) -> bool:
         """
@@ -672,9 +1534,9 @@ class Parser:
         :param self: Description
         """
 
-        return self.letter() or self.digit()
+        return self.char_in_set(LET_DIG_CLASS)
 
-    def char_in_set(self, char_set: set) -> bool:
+    def char_in_set(self, char_set: CharacterClass) -> bool:
         """
         Reusable function that checks if the current character is in the
         provided set of characters. This helps reduce code duplication for a
@@ -757,43 +1619,27 @@ class Parser:
     def is_string(self) -> bool:
         """
         Function for the <string> non-terminal. This seems to mean
-        "one or more <char> characters".
+        "one or more <char> characters", which is matched with one scan.
 
         :param self: Description
         :return: Description
         :rtype: bool
         """
 
-        start = self.position
-        if not self.is_char():
-            self.rewind(start)
-            return False
-
-        while self.is_char():
-            pass
-
-        return True
+        return self.scan(CHAR_CLASS) > 0
 
     def is_char(self) -> bool:
         """
         Returns True if the current character is any ASCII character except
-        those in <special> or those in <sp>.
+        those in <special> or those in <sp>. CHAR_CLASS is built once from the
+        printable ASCII characters with <special> and <SP> already taken out.
 
         :param self: Description
         :return: Description
         :rtype: bool
         """
 
-        start = self.position
-        if self.special() or self.sp():
-            self.rewind(start)
-            return False
-
-        if not self.is_ascii_printable(self.current_char()):
-            return False
-
-        self.advance()
-        return True
+        return self.char_in_set(CHAR_CLASS)
 
     def sp(self) -> bool:
         """
@@ -804,8 +1650,7 @@ class Parser:
         :return: Description
         :rtype: bool
         """
-        special_chars = set(" \t")
-        return self.char_in_set(special_chars)
+        return self.char_in_set(SP_CLASS)
 
     def letter(self) -> bool:
         """
@@ -815,10 +1660,7 @@ class Parser:
         :return: Description
         """
 
-        special_chars = set(
-            "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-        )
-        return self.char_in_set(special_chars)
+        return self.char_in_set(LETTER_CLASS)
 
     def digit(self) -> bool:
         """
@@ -827,8 +1669,7 @@ class Parser:
 
         # WARNING: Do NOT use str.isdigit because it includes more than just 0-9!
         # https://docs.python.org/3/library/stdtypes.html#str.isdigit
-        special_chars = set("0123456789")
-        return self.char_in_set(special_chars)
+        return self.char_in_set(DIGIT_CLASS)
 
     def crlf(self) -> bool:
         """
@@ -838,8 +1679,7 @@ class Parser:
         if self.is_at_end():
             return False
 
-        special_chars = set("\n")
-        if self.char_in_set(special_chars):
+        if self.char_in_set(CRLF_CLASS):
             return True
 
         # 10 is carriage return in the ASCII table
@@ -857,220 +1697,2939 @@ class Parser:
         :return: Description
         :rtype: bool
         """
-        # This is a cool trick: calling set() on a string creates a unique
-        # list of characters in that string
-        # The slash had to be escaped for this to work, just like the double
-        # quote.
-        special_chars = set("<>()[]\\.,;:@\"")
-        return self.char_in_set(special_chars)
+        return self.char_in_set(SPECIAL_CLASS)
 
-class SMTPServer:
+
+class CompiledParser(Parser):
     """
-    Class that will operate like a state machine to keep track of what command
-    is being handled next.
+    Alternate engine for the "MAIL FROM:" and "RCPT TO:" commands. Instead of walking every
+    character through the non-terminal functions (is_path -> mailbox -> local_part -> is_string
+    -> is_char -> ...), the whole line is accepted or rejected by a regular expression that was
+    compiled once at import time from the same grammar.
+
+    The recursive descent Parser is still the reference implementation; everything that is not
+    overridden here (DATA, the message body, etc.) is handled exactly the same way.
     """
-    EXPECTING_MAIL_FROM = 0
-    EXPECTING_RCPT_TO = 1
-    EXPECTING_RCPT_TO_OR_DATA = 2
-    EXPECTING_DATA_END = 3
 
-    def __init__(self, debug_mode: bool = False):
-        self.state = self.EXPECTING_MAIL_FROM
-        self.to_email_addresses = []
-        self.email_text = []
-        self.parser = None
-        self.debug_mode = debug_mode
+    __slots__ = ()
 
-    def set_parser(self, current_parser: Parser):
+    def match_compiled_cmd(self, cmd_re: re.Pattern, prefix_re: re.Pattern, command_name: str,
+                           check_only: bool = False) -> bool:
         """
-        By the time the parser is set, the line has already been read. That means,
-        what we do is check the current state and act accordingly.
+        Matches a full command line using cmd_re. Only if that fails is prefix_re used to decide
+        between a 500 error (the literal tokens were not recognized) and a 501 error (the command
+        was recognized but the arguments are wrong).
+
+        If check_for_commands() already recognized the command, only the arguments are matched,
+        starting right after the literal tokens.
         """
-        self.parser = current_parser
 
-        if not isinstance(current_parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
+        if not check_only and self.resume_command(command_name):
+            match = PATH_ARGUMENTS_RE.match(self.input_string, self.position)
+            if not match or not self.is_domain_within_limits(match.group("domain")):
+                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
 
-    def add_text_to_email_body(self, text: str):
+            self.fast_forward(match.end())
+            self.set_command_parsed()
+            return self.print_success()
+
+        if not check_only:
+            match = cmd_re.match(self.input_string, self.position)
+            if match and self.is_domain_within_limits(match.group("domain")):
+                self.set_command_identified(command_name)
+                self.fast_forward(match.end())
+                self.set_command_parsed()
+                return self.print_success()
+
+        prefix_match = prefix_re.match(self.input_string, self.position)
+        if not prefix_match:
+            return self.raise_parser_error(ParserError.COMMAND_UNRECOGNIZED, check_only)
+
+        # Flag that the command has been identified
+        self.set_command_identified(command_name)
+        self.fast_forward(prefix_match.end())
+
+        # If we are only checking for command recognition, we can stop here and return
+        if check_only:
+            return True
+
+        raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+    def mail_from_cmd(self, check_only: bool = False) -> bool:
         """
-        Add the input string without the trailing newline character to the list of lines that
-        will be appended to the message if the message parses correctly.
+        Compiled version of <mail-from-cmd>.
 
-        Note to self: .strip() is too greedy and will remove trailing and leading spaces and tabs,
-        changing the original content of each line passed to the parser.
+        <mail-from-cmd> ::= "MAIL" <whitespace> "FROM:" <nullspace> <reverse-path> <nullspace> <CRLF>
+        """
 
-        Another note to self: if this function is called, just do it; do not try to prevent an
-        empty string from being sent to the email message.
+        return self.match_compiled_cmd(MAIL_FROM_CMD_RE, MAIL_FROM_PREFIX_RE, "MAIL FROM", check_only)
+
+    def rcpt_to_cmd(self, check_only: bool = False) -> bool:
         """
+        Compiled version of <rcpt-to-cmd>.
 
-        self.email_text.append(text)
+        <rcpt-to-cmd> ::= "RCPT" <whitespace> "TO:" <nullspace> <forward-path> <nullspace> <CRLF>
+        """
 
+        return self.match_compiled_cmd(RCPT_TO_CMD_RE, RCPT_TO_PREFIX_RE, "RCPT TO", check_only)
 
-    def evaluate_state(self):
+    def match_cached_path_arguments(self) -> tuple | None:
         """
-        Determines what should happen
+        The compiled pattern is cheaper than looking the arguments up (see benchmark.py
+        address_cache), so the address_cache is not used.
         """
-        if not isinstance(self.parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
 
-        # Syntax errors in the message name (type 500 errors) should take precedence over all other
-        # errors.
-        # Out-of-order (type 503 errors) should take precedence over parameter/argument errors
-        # (type 501 errors). This means that we can no longer throw a 501 error until we have
-        # verified that the command is in the correct sequence.
+        return self.match_path()
 
-        # We need to know if any command is recognized to be ready for 503 errors
-        recognized_command = self.command_id_errors()
+    def match_path_arguments(self) -> tuple | None:
+        """
+        Compiled version of Parser.match_path_arguments().
+        """
 
-        # STATE == 0
-        if self.state == self.EXPECTING_MAIL_FROM:
-            # if the command fails, that means a type 501 error occurred.
-            if not self.parser.mail_from_cmd():
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+        match = PATH_ARGUMENTS_RE.match(self.input_string, self.position)
+        if not match or not self.is_domain_within_limits(match.group("domain")):
+            return None
 
-            # If we made it here, the command was fully parsed successfully
-            # Add the "From: <reverse-path>" line to the list of email text lines
-            self.add_text_to_email_body(self.parser.get_from_line_for_email())
-            return self.advance()
+        self.fast_forward(match.end())
+        return match.span("path")
 
-        if self.state == self.EXPECTING_RCPT_TO or \
-            (self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command == "RCPT TO"):
-            # if the command fails, that means a type 501 error occurred.
-            if not self.parser.rcpt_to_cmd():
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
 
-            # If we made it here, the command was fully parsed successfully
-            # Add the "To: <forward-path>" line to the list of email text lines
-            self.add_text_to_email_body(self.parser.get_to_line_for_email())
-            self.to_email_addresses.append(self.parser.get_email_address())
+class MessageBuffer:
+    """
+    Collects the text of one message, one line at a time, as bytes. Each line is followed by a
+    newline, so the result is the same as joining the lines with newlines and adding one more.
 
-            # Only advance if this is the first time we are seeing a To: address
-            if self.state == self.EXPECTING_RCPT_TO:
-                self.advance()
+    Small messages stay in memory as a list of lines. Once a message is larger than
+    spill_threshold bytes, everything is moved to a temporary file (a "spool"), and from then on
+    the lines are moved there every time another spill_threshold bytes have been collected, so a
+    huge message does not have to fit in memory. Delivery then copies the spool to each mailbox
+    file a piece at a time (see write_to()).
 
-            return
+    Whoever delivers the message closes the buffer (see MailboxDelivery.deliver()), which deletes
+    the temporary file.
+    """
 
-        if self.state == self.EXPECTING_RCPT_TO_OR_DATA:
-            # This means that the recognized command must be "DATA", but we'll check anyway
-            if recognized_command == "DATA" and not self.parser.data_cmd():
-                raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+    DEFAULT_SPILL_THRESHOLD = 1024 * 1024
+    """
+    How large a message can get (in bytes) before it is moved to a temporary file, by default.
+    """
 
-            # If we made it here, the command was fully parsed successfully
-            # Advance so that we can start reading the message
-            return self.advance()
+    COPY_SIZE = 1024 * 1024
+    """
+    How many bytes are copied from the spool to a mailbox file at a time.
+    """
 
-        if self.state == self.EXPECTING_DATA_END:
-            # This is different because any text that does not create an error that is parsed
-            # here is considered valid until the ending comes.
-            if self.parser.data_end_cmd():
-                self.process_email_message()
-                return self.advance()
+    __slots__ = ("spill_threshold", "lines", "lines_size", "spool", "spool_size")
 
-            # if an error occurs while reading a line meant for the body of the message, then
-            # throw an error. According to the writeup, "we'll assume that 'text' is limited to
-            # printable text, whitespace, and newlines".
-            if not self.parser.data_read_msg_line():
-                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+    def __init__(self, spill_threshold: int = DEFAULT_SPILL_THRESHOLD):
+        if spill_threshold < 0:
+            raise ValueError("spill_threshold must not be negative.")
 
-            self.add_text_to_email_body(self.parser.get_input_line())
+        self.spill_threshold = spill_threshold
 
-    def command_id_errors(self) -> str:
+        self.lines = []
         """
-        If no command is recognized, then that results in a 500 error.
-        If an unexpected command is recognized based on the current state, that results in a 503.
-        Return the recognized command. This is helpful for when a state represents an option,
-        RCPT TO or DATA.
+        The lines of the message that are in memory (all of them, until it is spilled).
         """
 
-        if self.state not in [self.EXPECTING_MAIL_FROM, self.EXPECTING_RCPT_TO, self.EXPECTING_RCPT_TO_OR_DATA]:
-            return ""
+        self.lines_size = 0
+        """
+        The size of the lines in memory in bytes, including the newlines.
+        """
 
-        if not isinstance(self.parser, Parser):
-            raise ValueError("parser must be an instance of Parser class.")
+        self.spool = None
+        """
+        The temporary file that the message was moved to, or None while it is in memory.
+        """
 
-        any_command_recognized = self.parser.check_for_commands()
-        recognized_command = self.parser.get_command_name()
+        self.spool_size = 0
+        """
+        How many bytes have been moved to the temporary file.
+        """
 
-        if self.debug_mode:
-            print(f"line: {self.parser.input_string.strip()}, state: {self.state}, recognized_command: {recognized_command}")
+    def __len__(self) -> int:
+        return self.spool_size + self.lines_size
+
+    def is_spilled(self) -> bool:
+        """
+        Returns True if the message has been moved to a temporary file.
+        """
+
+        return self.spool is not None
+
+    def append_line(self, line: bytes):
+        """
+        Adds a line (without its newline) to the end of the message.
+        """
+
+        self.lines.append(line)
+        self.lines_size += len(line) + 1
+
+        if self.lines_size > self.spill_threshold:
+            self.spill()
+
+    def join_lines(self) -> bytes:
+        """
+        Returns the lines that are in memory, each followed by a newline.
+        """
+
+        if not self.lines:
+            return b""
+
+        return CRLF_BYTES.join(self.lines) + CRLF_BYTES
+
+    def spill(self):
+        """
+        Moves the lines that are in memory to the temporary file, creating it the first time.
+        """
+
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+
+        self.spool.write(self.join_lines())
+        self.spool_size += self.lines_size
+        self.lines = []
+        self.lines_size = 0
+
+    def getvalue(self) -> bytes:
+        """
+        Returns the whole message. Only meant for messages that are still in memory.
+        """
+
+        if self.spool is None:
+            return self.join_lines()
+
+        self.spill()
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def write_to(self, destination):
+        """
+        Writes the whole message to the open binary file destination, a piece at a time if the
+        message is in a temporary file.
+        """
+
+        if self.spool is None:
+            destination.write(self.join_lines())
+            return
+
+        self.spill()
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, destination, self.COPY_SIZE)
+
+    def close(self):
+        """
+        Throws the message away (deleting the temporary file, if there is one). The buffer can
+        then be used for the next message.
+        """
+
+        self.lines = []
+        self.lines_size = 0
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+            self.spool_size = 0
+
+
+def get_file_size(path: Path) -> int:
+    """
+    Returns the size of the file at path in bytes, or 0 if there is no such file.
+    """
+
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+class IndexRecord(NamedTuple):
+    """
+    Where one message is in a mailbox file, as kept in the mailbox index (see MailboxDelivery):
+
+    - offset: the position of its first byte in the mailbox file
+    - length: its size in bytes
+    - recipients: how many recipients it was sent to (RCPT TO commands); the addresses
+      themselves are at the start of the message (see MailboxReader.get_recipients())
+    """
+
+    offset: int
+    length: int
+    recipients: int
+
+
+class MailboxDelivery:
+    """
+    Appends messages to the mailbox files in the "forward" folder. The folder is created only once
+    (when the first message is delivered), and instead of opening and closing a mailbox file for
+    every recipient of every message, the most recently used mailbox files are kept open. Once
+    more than max_open_files are open, the least recently used one is closed.
+
+    Each message is flushed as soon as it has been written, so the mailbox files always contain
+    complete messages, just like when each file was closed after writing.
+
+    With index=True, every mailbox file also gets an index in the ".index" folder inside the
+    "forward" folder (no address can start with a period, so it cannot be taken for a mailbox).
+    The index has one fixed-size record (see IndexRecord) per message, written right after the
+    message, so that MailboxReader can find the n-th message without reading the others.
+    Messages that were in a mailbox file before it had an index are not in the index.
+
+    With locking=True, several programs can deliver to the same "forward" folder at once. Before
+    a message is written, the mailbox files of all its recipients are locked (fcntl.flock) in
+    order of their addresses, so two deliveries can never wait for each other; each lock is
+    released as soon as the message (and its index record) has been written to that mailbox.
+    Every mailbox therefore gets every message in one piece, and two messages that share
+    mailboxes are in the same order in all of them. Every program writing to the folder has to
+    use locking for this to work (the locks are advisory).
+    """
+
+    DEFAULT_MAX_OPEN_FILES = 64
+    """
+    How many mailbox files are kept open at most by default.
+    """
+
+    INDEX_FOLDER_NAME = ".index"
+    """
+    The folder (inside the "forward" folder) that the mailbox indexes are in.
+    """
+
+    INDEX_RECORD = struct.Struct("<QQI")
+    """
+    The layout of an IndexRecord in an index file: offset, length, recipients.
+    """
+
+    def __init__(self, folder_name: str = "forward", max_open_files: int = DEFAULT_MAX_OPEN_FILES,
+                 base_folder: Path = None, index: bool = False, locking: bool = False):
+        """
+        :param folder_name: The name of the folder for the mailbox files.
+        :param max_open_files: How many mailbox files are kept open at most.
+        :param base_folder: The folder that folder_name is created in; defaults to the current
+            working directory at the time of the first delivery.
+        :param index: Whether to keep an index of the messages in every mailbox file.
+        :param locking: Whether to lock the mailbox files while writing to them.
+        """
+
+        if not folder_name:
+            raise ValueError("MailboxDelivery(); must specify a folder name")
+
+        if max_open_files < 1:
+            raise ValueError("max_open_files must be at least 1.")
+
+        self.folder_name = folder_name
+        self.max_open_files = max_open_files
+        self.base_folder = base_folder
+        self.index = index
+        self.locking = locking
+
+        self.folder = None
+        """
+        The folder the mailbox files are in, once it has been created.
+        """
+
+        self.open_files = OrderedDict()
+        """
+        Open mailbox files by email address, from least to most recently used.
+        """
+
+        self.open_indexes = {}
+        """
+        Open index files by email address; one is open only while its mailbox file is.
+        """
+
+        self.locked = set()
+        """
+        The addresses whose mailbox files are locked. They are not closed to make room for
+        others, since closing a file releases its lock.
+        """
+
+    def create_folder(self, folder_name: str) -> Path:
+        """
+        Create a folder with the specified name in the current working directory (or in
+        base_folder, if one was given).
+        """
+
+        if not folder_name:
+            raise ValueError("create_folder(); must specify a folder name")
+
+        # I got this wrong the first time; this should be in the "current working directory" (p. 6)
+        current_folder = self.base_folder if self.base_folder is not None else Path.cwd()
+        # This is the "forward" folder I want to create
+        new_folder = current_folder / folder_name
+
+        # it's okay if the folder already exists
+        new_folder.mkdir(exist_ok=True)
+
+        return new_folder
+
+    def get_folder(self) -> Path:
+        """
+        Returns the folder for the mailbox files, creating it the first time.
+        """
+
+        if self.folder is None:
+            self.folder = self.create_folder(self.folder_name)
+
+        return self.folder
+
+    def get_folder_path(self) -> Path:
+        """
+        Returns where the folder for the mailbox files is (or will be), without creating it.
+        """
+
+        if self.folder is not None:
+            return self.folder
+
+        current_folder = self.base_folder if self.base_folder is not None else Path.cwd()
+        return current_folder / self.folder_name
+
+    def open_mailbox(self, email_address: str):
+        """
+        Returns the open mailbox file for email_address, opening it (and closing the least
+        recently used one, if needed) if it is not open yet.
+        """
+
+        mailbox = self.open_files.get(email_address)
+        if mailbox is not None:
+            self.open_files.move_to_end(email_address)
+            return mailbox
+
+        while len(self.open_files) >= self.max_open_files:
+            unlocked_address = next((address for address in self.open_files
+                                     if address not in self.locked), None)
+            if unlocked_address is None:
+                # Only locked ones are open; there can be more than max_open_files for a while
+                break
+            self.close_mailbox(unlocked_address)
+
+        mailbox = (self.get_folder() / email_address).open("ab")
+        self.open_files[email_address] = mailbox
+        return mailbox
+
+    def close_mailbox(self, email_address: str):
+        """
+        Closes the mailbox file for email_address (and its index, if it is open).
+        """
+
+        index_file = self.open_indexes.pop(email_address, None)
+        if index_file is not None:
+            index_file.close()
+
+        # Closing the file releases its lock
+        self.locked.discard(email_address)
+        self.open_files.pop(email_address).close()
+
+    def lock_mailboxes(self, email_addresses) -> list:
+        """
+        Locks the mailbox files of email_addresses (opening them if needed), waiting for other
+        programs to release them. The locks are taken in order of the addresses, so that
+        programs locking overlapping sets of mailboxes cannot end up waiting for each other.
+        Returns the addresses that were locked by this call, i.e., not already locked.
+        """
+
+        newly_locked = []
+        for email_address in sorted(set(email_addresses)):
+            if email_address in self.locked:
+                continue
+
+            fcntl.flock(self.open_mailbox(email_address), fcntl.LOCK_EX)
+            self.locked.add(email_address)
+            newly_locked.append(email_address)
+
+        return newly_locked
+
+    def unlock_mailbox(self, email_address: str):
+        """
+        Releases the lock on the mailbox file for email_address, if it is locked. Everything
+        written to it must have been flushed.
+        """
+
+        if email_address in self.locked:
+            self.locked.remove(email_address)
+            fcntl.flock(self.open_files[email_address], fcntl.LOCK_UN)
+
+    def get_index_path(self, email_address: str) -> Path:
+        """
+        Returns the path of the index of the mailbox file for email_address.
+        """
+
+        return self.get_folder() / self.INDEX_FOLDER_NAME / email_address
+
+    def write_index_record(self, email_address: str, record: IndexRecord):
+        """
+        Appends a record to the index of the mailbox file for email_address, opening the index
+        (and creating the index folder) if it is not open yet. Call this only once the message
+        has been written and flushed, so that the index never points past the end of the mailbox.
+        """
+
+        index_file = self.open_indexes.get(email_address)
+        if index_file is None:
+            index_path = self.get_index_path(email_address)
+            index_path.parent.mkdir(exist_ok=True)
+            index_file = index_path.open("ab")
+            self.open_indexes[email_address] = index_file
+
+        index_file.write(self.INDEX_RECORD.pack(*record))
+        index_file.flush()
+
+    def deliver(self, email_addresses: list, message: bytes | MessageBuffer):
+        """
+        Appends message to the mailbox file of every address in email_addresses. A MessageBuffer
+        belongs to the delivery from now on; it is closed once it has been written (or failed).
+        """
+
+        message_buffer = None
+        if isinstance(message, MessageBuffer):
+            message_buffer = message
+            # A message in memory is put together once; one in a temporary file is copied to
+            # every mailbox a piece at a time, so it is never in memory all at once.
+            message = None if message_buffer.is_spilled() else message_buffer.getvalue()
+
+        # Each lock taken here is released right after the last write to that mailbox
+        newly_locked = self.lock_mailboxes(email_addresses) if self.locking else []
+        last_positions = {email_address: position
+                          for position, email_address in enumerate(email_addresses)}
+
+        try:
+            for position, email_address in enumerate(email_addresses):
+                self.append_message(email_address,
+                                    message if message is not None else message_buffer,
+                                    len(email_addresses))
+
+                if last_positions[email_address] == position and email_address in newly_locked:
+                    self.unlock_mailbox(email_address)
+        finally:
+            if message_buffer is not None:
+                message_buffer.close()
+
+            for email_address in newly_locked:
+                self.unlock_mailbox(email_address)
+
+    def append_message(self, email_address: str, message: bytes | MessageBuffer,
+                       recipients: int):
+        """
+        Appends one copy of message to the mailbox file for email_address, followed by its index
+        record (which says the message had `recipients` recipients). Unlike deliver(), this does
+        not lock the mailbox or close a MessageBuffer.
+        """
+
+        mailbox = self.open_mailbox(email_address)
+
+        try:
+            # Writes always go to the end of a file opened for appending, but other programs may
+            # have appended to it since this one last did
+            offset = mailbox.seek(0, os.SEEK_END)
+            if isinstance(message, MessageBuffer):
+                message.write_to(mailbox)
+            else:
+                mailbox.write(message)
+            mailbox.flush()
+
+            if self.index:
+                self.write_index_record(email_address, IndexRecord(
+                    offset, mailbox.tell() - offset, recipients
+                ))
+        except Exception:
+            # Do not keep using a file that failed
+            if email_address in self.locked:
+                self.replace_locked_mailbox(email_address)
+            else:
+                self.close_mailbox(email_address)
+            raise
+
+    def replace_locked_mailbox(self, email_address: str):
+        """
+        Replaces the locked mailbox file for email_address (after writing to it failed) with a
+        fresh file object, without releasing the lock: the new one uses a duplicate of the file
+        descriptor, and a lock belongs to the open file, not to the descriptor.
+        """
+
+        mailbox = self.open_files[email_address]
+        self.open_files[email_address] = os.fdopen(os.dup(mailbox.fileno()), "ab")
+
+        files = [mailbox]
+        index_file = self.open_indexes.pop(email_address, None)
+        if index_file is not None:
+            files.append(index_file)
+
+        for file in files:
+            # Whatever was not written is thrown away, and so is the error
+            with contextlib.suppress(OSError):
+                file.close()
+
+    def sync(self, email_addresses, folders: bool = False):
+        """
+        Makes sure that everything written to the mailbox files of email_addresses (and their
+        indexes) is on disk (fsync). Files that have been closed since are opened again for this.
+        With folders=True, the "forward" folder (and the index folder) are synced as well, which
+        is needed for mailbox files that were just created.
+        """
+
+        paths = []
+        for email_address in email_addresses:
+            for open_files, path in [(self.open_files, self.get_folder() / email_address),
+                                     (self.open_indexes, self.get_index_path(email_address))]:
+                file = open_files.get(email_address)
+                if file is not None:
+                    os.fsync(file.fileno())
+                elif open_files is self.open_files or self.index:
+                    paths.append(path)
+
+        if folders:
+            paths.append(self.get_folder())
+            if self.index:
+                paths.append(self.get_folder() / self.INDEX_FOLDER_NAME)
+
+        for path in paths:
+            try:
+                file_descriptor = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+
+            try:
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+
+    def get_sizes(self, email_address: str) -> tuple:
+        """
+        Returns the sizes in bytes of the mailbox file for email_address and of its index, as
+        (mailbox size, index size). A file that does not exist yet has size 0, and so does the
+        index if this delivery does not keep one.
+        """
+
+        mailbox = self.open_files.get(email_address)
+        if mailbox is not None:
+            mailbox_size = mailbox.seek(0, os.SEEK_END)
+        else:
+            mailbox_size = get_file_size(self.get_folder() / email_address)
+
+        index_size = 0
+        if self.index:
+            index_file = self.open_indexes.get(email_address)
+            if index_file is not None:
+                index_size = index_file.seek(0, os.SEEK_END)
+            else:
+                index_size = get_file_size(self.get_index_path(email_address))
+
+        return mailbox_size, index_size
+
+    def truncate_mailbox(self, email_address: str, sizes: tuple):
+        """
+        Cuts the mailbox file for email_address and its index back to sizes (as returned by
+        get_sizes() before something was written), throwing away whatever was appended since.
+        Files that are shorter than that, or do not exist, are left alone. A mailbox file that is
+        open stays open, and locked if it is.
+        """
+
+        files = [(self.open_files.get(email_address), self.get_folder() / email_address)]
+        if self.index:
+            files.append((self.open_indexes.get(email_address),
+                          self.get_index_path(email_address)))
+
+        for (file, path), size in zip(files, sizes):
+            if file is not None:
+                if file.seek(0, os.SEEK_END) > size:
+                    file.truncate(size)
+            elif get_file_size(path) > size:
+                os.truncate(path, size)
+
+    def append_mailboxes(self, source_folder: Path):
+        """
+        Appends every mailbox file in source_folder (the "forward" folder of another
+        MailboxDelivery) to the mailbox file with the same name, in order of their names. If this
+        delivery keeps an index, the records of the source's index are added to it, moved to where
+        the messages end up.
+        """
+
+        for source in sorted(source_folder.iterdir()):
+            # The index folder is not a mailbox
+            if not source.is_file():
+                continue
+
+            if self.locking:
+                self.lock_mailboxes([source.name])
+            mailbox = self.open_mailbox(source.name)
+            offset = mailbox.seek(0, os.SEEK_END)
+            append_file(source, mailbox)
+            mailbox.flush()
+
+            source_index = source_folder / self.INDEX_FOLDER_NAME / source.name
+            if self.index and source_index.is_file():
+                for record in self.INDEX_RECORD.iter_unpack(source_index.read_bytes()):
+                    record = IndexRecord(*record)
+                    self.write_index_record(source.name,
+                                            record._replace(offset=record.offset + offset))
+
+            self.unlock_mailbox(source.name)
+
+    def close(self):
+        """
+        Closes every mailbox file that is still open.
+        """
+
+        while self.open_files:
+            self.close_mailbox(next(iter(self.open_files)))
+
+
+class MailboxReader:
+    """
+    Reads messages from a mailbox file that has an index (see MailboxDelivery), without reading
+    the rest of the mailbox: the index and the mailbox file are memory-mapped, so finding the n-th
+    message is one lookup in the index and reading it only touches its own pages.
+
+    The files can still be growing while they are being read; they are mapped again when a
+    message past the end of the mapping is asked for. Use it as a context manager, or call
+    close().
+
+    ```python
+    with MailboxReader("alice@cs.unc.edu") as mailbox:
+        print(len(mailbox), mailbox.get_message(-1), mailbox.get_recipients(-1))
+    ```
+    """
+
+    RECIPIENT_PREFIX = b"To: <"
+    """
+    How the line for each recipient at the start of a message begins (see get_recipients()).
+    """
+
+    def __init__(self, email_address: str, folder: Path = Path("forward")):
+        """
+        :param email_address: The mailbox to read.
+        :param folder: The "forward" folder that the mailbox file is in.
+        """
+
+        self.mailbox_file = (folder / email_address).open("rb")
+        self.index_file = (folder / MailboxDelivery.INDEX_FOLDER_NAME / email_address).open("rb")
+
+        self.mailbox_map = None
+        self.index_map = None
+        """
+        The memory-mapped mailbox file and index, or None while a file is empty.
+        """
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the mailbox file and the index again if they have grown since they were mapped.
+        """
+
+        # The index first: a record is only written once its message is in the mailbox file, so
+        # every record in the index mapping points into the mailbox mapping.
+        self.index_map = self.map_file(self.index_file, self.index_map)
+        self.mailbox_map = self.map_file(self.mailbox_file, self.mailbox_map)
+
+    @staticmethod
+    def map_file(file, current_map: mmap.mmap | None) -> mmap.mmap | None:
+        """
+        Returns a read-only mapping of the whole file, reusing current_map if the file has not
+        grown. Empty files cannot be mapped; None is returned for those.
+        """
+
+        size = os.fstat(file.fileno()).st_size
+        if current_map is not None and len(current_map) >= size:
+            return current_map
+
+        if current_map is not None:
+            current_map.close()
+
+        if size == 0:
+            return None
+
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        """
+        Returns how many messages are in the index.
+        """
+
+        self.refresh()
+        return self.count_mapped_records()
+
+    def count_mapped_records(self) -> int:
+        """
+        Returns how many records are in the part of the index that is mapped.
+        """
+
+        if self.index_map is None:
+            return 0
+
+        return len(self.index_map) // MailboxDelivery.INDEX_RECORD.size
+
+    def get_record(self, number: int) -> IndexRecord:
+        """
+        Returns the index record of message number (0 is the first one; negative numbers count
+        from the end, like with a list).
+        """
+
+        # The files are only checked for new messages if the number is not in the mapped part
+        count = self.count_mapped_records()
+        if number < 0 or number >= count:
+            count = len(self)
+
+        if number < 0:
+            number += count
+
+        if not 0 <= number < count:
+            raise IndexError(f"there is no message {number} in this mailbox ({count} messages)")
+
+        return IndexRecord(*MailboxDelivery.INDEX_RECORD.unpack_from(
+            self.index_map, number * MailboxDelivery.INDEX_RECORD.size
+        ))
+
+    def get_message(self, number: int) -> bytes:
+        """
+        Returns message number (see get_record()) exactly as it is in the mailbox file.
+        """
+
+        record = self.get_record(number)
+        return self.mailbox_map[record.offset:record.offset + record.length]
+
+    def get_messages(self, start: int = 0, stop: int = None) -> list:
+        """
+        Returns the messages from number start up to (not including) stop, or up to the last one
+        if stop is None. Like with a slice, the numbers may be negative or out of range.
+        """
+
+        numbers = range(*slice(start, stop).indices(len(self)))
+        return [self.get_message(number) for number in numbers]
+
+    def get_recipients(self, number: int) -> list:
+        """
+        Returns the addresses that message number (see get_record()) was sent to, in the order of
+        its RCPT TO commands.
+
+        The addresses are not kept in the index a second time: every message starts with its
+        "From: <reverse-path>" line and one "To: <forward-path>" line per recipient, and the index
+        record says how many recipients there are, so only those lines are read, not the text.
+        """
+
+        record = self.get_record(number)
+        end = record.offset + record.length
+
+        # Skip the "From:" line
+        position = self.mailbox_map.find(CRLF_BYTES, record.offset, end) + len(CRLF_BYTES)
+
+        recipients = []
+        for _ in range(record.recipients):
+            line_end = self.mailbox_map.find(CRLF_BYTES, position, end)
+            # "To: <" address ">"
+            address = self.mailbox_map[position + len(self.RECIPIENT_PREFIX):line_end - 1]
+            recipients.append(address.decode("utf-8", "surrogateescape"))
+            position = line_end + len(CRLF_BYTES)
+
+        return recipients
+
+    def close(self):
+        """
+        Closes the mappings and the files.
+        """
+
+        for file_map in [self.mailbox_map, self.index_map]:
+            if file_map is not None:
+                file_map.close()
+
+        self.mailbox_map = self.index_map = None
+        self.mailbox_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DeliveryQueue:
+    """
+    Delivers messages in a background thread so that slow storage does not hold up reading and
+    answering the next command. deliver() puts the message in a queue and a worker thread writes
+    it with a MailboxDelivery. It can be used anywhere a MailboxDelivery is used.
+
+    - The queue holds at most max_pending messages; once it is full, deliver() waits for room.
+      Queued MessageBuffers belong to the queue, so a large message that was moved to a temporary
+      file stays there until it has been written.
+    - There is one worker thread and it writes messages in the order they were queued, so every
+      mailbox receives its messages in the same order as with synchronous delivery.
+    - close() waits until every queued message has been written, then closes the mailbox files.
+    - If writing fails, nothing else is written, and the error is raised by the next call to
+      deliver() or close() (the same error would have stopped the program without the queue).
+
+    When the "250 OK" for the <data-end-cmd> is sent depends on ack_policy:
+
+    - ACK_WHEN_QUEUED: as soon as the message is in the queue. The reply only means that the
+      server has accepted the message; if the program is killed before the queue is drained, the
+      message can be lost.
+    - ACK_WHEN_WRITTEN: only after the message has been written to every recipient's mailbox
+      file, exactly like synchronous delivery. Reading still is not blocked by other messages.
+
+    In neither case are the mailbox files synced to disk (fsync), so "written" means handed to
+    the operating system, just like synchronous delivery (see GroupCommitDelivery for that).
+    """
+
+    ACK_WHEN_QUEUED = "queued"
+    ACK_WHEN_WRITTEN = "written"
+    ACK_POLICIES = [ACK_WHEN_QUEUED, ACK_WHEN_WRITTEN]
+
+    DEFAULT_MAX_PENDING = 100
+    """
+    How many messages can wait in the queue by default.
+    """
+
+    def __init__(self, delivery: MailboxDelivery = None, max_pending: int = DEFAULT_MAX_PENDING,
+                 ack_policy: str = ACK_WHEN_QUEUED):
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1.")
+
+        if ack_policy not in self.ACK_POLICIES:
+            raise ValueError(f"ack_policy must be one of {self.ACK_POLICIES}.")
+
+        self.delivery = delivery if delivery is not None else MailboxDelivery()
+        self.ack_policy = ack_policy
+
+        self.pending = queue.Queue(maxsize=max_pending)
+        """
+        Messages waiting to be written, as (email_addresses, message, written) tuples. None tells
+        the worker thread to stop.
+        """
+
+        self.error = None
+        """
+        The first exception raised while writing, if any.
+        """
+
+        self.closed = False
+
+        self.worker = threading.Thread(target=self.run_worker, name="DeliveryQueue", daemon=True)
+        self.worker.start()
+
+    def run_worker(self):
+        """
+        Runs in the worker thread: writes queued messages in order until told to stop.
+        """
+
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+
+            email_addresses, message, written = item
+            try:
+                # After an error, the remaining messages are dropped, just like the program would
+                # have stopped without the queue.
+                if self.error is None:
+                    self.delivery.deliver(email_addresses, message)
+                elif isinstance(message, MessageBuffer):
+                    message.close()
+            except Exception as e:
+                self.error = e
+            finally:
+                written.set()
+
+    def raise_error(self):
+        """
+        Raises the error from the worker thread, if there was one.
+        """
+
+        if self.error is not None:
+            raise self.error
+
+    def deliver(self, email_addresses: list, message: bytes | MessageBuffer):
+        """
+        Queues message for every address in email_addresses. Depending on ack_policy, this returns
+        once the message is queued or once it has been written.
+        """
+
+        if self.closed:
+            raise ValueError("DeliveryQueue is closed.")
+
+        self.raise_error()
+
+        written = threading.Event()
+        self.pending.put((list(email_addresses), message, written))
+
+        if self.ack_policy == self.ACK_WHEN_WRITTEN:
+            written.wait()
+            self.raise_error()
+
+    def close(self):
+        """
+        Waits until every queued message has been written, stops the worker thread and closes
+        the mailbox files.
+        """
+
+        if not self.closed:
+            self.closed = True
+            self.pending.put(None)
+            self.worker.join()
+            self.delivery.close()
+
+        self.raise_error()
+
+
+class GroupCommitDelivery:
+    """
+    Makes delivered messages durable: the mailbox files that messages were written to are synced
+    to disk (fsync) in groups, once batch_size messages are waiting or the oldest one has waited
+    max_delay seconds, instead of once per message (slow) or never (messages are lost if the
+    machine crashes). It can be used anywhere a MailboxDelivery is used.
+
+    The "250 OK" for the <data-end-cmd> must not be sent until its message is durable. An
+    SMTPServer with a ResponseWriter takes care of that by having the writer call sync() before
+    it writes anything out (see ResponseWriter.before_flush), so replies are held back until
+    their group has been synced; anyone using SMTPServer.process_lines() has to call sync() before
+    passing replies on. A file of replies that is flushed often (e.g., interactive input) means
+    smaller groups.
+    """
+
+    DEFAULT_BATCH_SIZE = 32
+    """
+    How many messages are synced together at most by default.
+    """
+
+    DEFAULT_MAX_DELAY = 0.010
+    """
+    How long (in seconds) a message waits to be synced at most by default, as long as more
+    messages keep arriving.
+    """
+
+    def __init__(self, delivery: MailboxDelivery = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_delay: float = DEFAULT_MAX_DELAY):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+
+        if max_delay < 0:
+            raise ValueError("max_delay must not be negative.")
+
+        self.delivery = delivery if delivery is not None else MailboxDelivery()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self.touched = {}
+        """
+        The addresses whose mailbox files have been written to since the last sync (a dict is
+        used as a set that keeps its order).
+        """
+
+        self.created = False
+        """
+        Whether a new mailbox file has been created since the last sync.
+        """
+
+        self.known_addresses = set()
+        """
+        The addresses whose mailbox files are known to exist.
+        """
+
+        self.pending_count = 0
+        self.pending_since = None
+        """
+        How many messages are waiting to be synced, and since when (time.monotonic()).
+        """
+
+        self.syncs = 0
+        """
+        How many times the files were synced.
+        """
+
+    def deliver(self, email_addresses: list, message: bytes | MessageBuffer):
+        """
+        Writes message to the mailbox file of every address in email_addresses, and syncs the
+        group if it is full or its oldest message has waited long enough.
+        """
+
+        for email_address in email_addresses:
+            if email_address not in self.known_addresses:
+                if not (self.delivery.get_folder() / email_address).exists():
+                    self.created = True
+                self.known_addresses.add(email_address)
+
+            self.touched[email_address] = None
+
+        self.delivery.deliver(email_addresses, message)
+
+        if self.pending_count == 0:
+            self.pending_since = time.monotonic()
+        self.pending_count += 1
+
+        if self.pending_count >= self.batch_size or \
+                time.monotonic() - self.pending_since >= self.max_delay:
+            self.sync()
+
+    def sync(self):
+        """
+        Syncs every mailbox file that messages have been written to since the last sync. Every
+        message delivered so far is durable once this returns.
+        """
+
+        if self.pending_count == 0:
+            return
+
+        self.delivery.sync(self.touched, folders=self.created)
+        self.touched.clear()
+        self.created = False
+        self.pending_count = 0
+        self.pending_since = None
+        self.syncs += 1
+
+    def close(self):
+        """
+        Syncs whatever is still waiting and closes the mailbox files.
+        """
+
+        try:
+            self.sync()
+        finally:
+            self.delivery.close()
+
+
+class JournalEntry(NamedTuple):
+    """
+    A message as it was recorded in a journal (see JournaledDelivery):
+
+    - sequence: its number in the journal
+    - recipients: (email address, (mailbox size, index size)) for every address it was sent to,
+      with the sizes the files had before it was written
+    - message_offset: where the message starts in the journal
+    - message_length: its size in bytes
+    """
+
+    sequence: int
+    recipients: list
+    message_offset: int
+    message_length: int
+
+
+class JournaledDelivery:
+    """
+    Makes delivering a message to several mailboxes all-or-nothing, even if the program dies
+    halfway through the recipients. Before a message is written to any mailbox file, it is
+    appended to a journal once, together with its recipients and the size every one of their
+    mailbox files (and indexes) had. Once it has been written to all of them, it is marked as
+    delivered. It can be used anywhere a MailboxDelivery is used.
+
+    - The journal is a file named ".journal-..." in the "forward" folder (no address can start
+      with a period). Every JournaledDelivery has its own journal and holds a lock on it
+      (fcntl.flock) for as long as it is open.
+    - Writing the journal costs one sequential write per message: the mark that the previous
+      message has been delivered goes out in the same write as the entry of the next one.
+    - If writing to a mailbox fails, the mailboxes that the message was already written to are
+      cut back to their recorded sizes, the entry is marked right away and the error is raised.
+    - recover() finishes the journals that nobody holds a lock on (their program died). Every
+      message that was recorded completely but not marked as delivered (which includes the last
+      one delivered) is written to each of its mailboxes that does not have it yet. A message
+      whose entry was cut short had not been written to any mailbox or acknowledged, so it is
+      dropped. Call recover() once when the program starts, before delivering anything.
+    - Once the journal is larger than max_journal_size, it is emptied, so recovery never has
+      much to read. Everything in it has been delivered by then; with durable=True, it is only
+      emptied by sync(), after the mailbox files have been synced too. close() removes it.
+
+    A mailbox is only ever cut back if everything after the recorded size is (part of) the
+    message itself, so nothing that another program appended is thrown away. If something else
+    follows a copy of the message that was cut short, the copy stays, and the message is
+    written again at the end. With a MailboxDelivery that uses locking, the mailboxes of a
+    message stay locked from recording their sizes until it has been written to all of them
+    (or they have been cut back), and recovery takes the same locks.
+
+    With durable=True (see GroupCommitDelivery), every entry is synced to disk (fsync) before
+    the message is written to any mailbox, so this also holds if the machine crashes. Without
+    it, the journal only protects against the program dying.
+    """
+
+    JOURNAL_PREFIX = ".journal-"
+    """
+    How the names of journal files start.
+    """
+
+    DEFAULT_MAX_JOURNAL_SIZE = 1024 * 1024
+    """
+    How large (in bytes) a journal grows by default before it is emptied.
+    """
+
+    ENTRY_HEADER = struct.Struct("<cQIQ")
+    """
+    The start of an entry: "B", sequence number, number of recipients, message length. The
+    recipients (RECIPIENT, then the address), the message and ENTRY_END follow.
+    """
+
+    RECIPIENT = struct.Struct("<QQH")
+    """
+    One recipient of an entry: mailbox size, index size, length of the address (UTF-8).
+    """
+
+    ENTRY_END = struct.Struct("<cQI")
+    """
+    The end of an entry: "E", sequence number, CRC-32 of the header and the recipients.
+    """
+
+    DELIVERED = struct.Struct("<cQ")
+    """
+    The mark that an entry has been delivered (or cut back after a failure): "D", sequence number.
+    """
+
+    TAIL = "tail"
+    FOLLOWED = "followed"
+    FOREIGN = "foreign"
+    """
+    What compare_tail() can find after the recorded size of a file: nothing but (the start of)
+    what was expected, all of it followed by something else, or something else.
+    """
+
+    def __init__(self, delivery: MailboxDelivery = None,
+                 max_journal_size: int = DEFAULT_MAX_JOURNAL_SIZE, durable: bool = False):
+        if max_journal_size < 0:
+            raise ValueError("max_journal_size must not be negative.")
+
+        self.delivery = delivery if delivery is not None else MailboxDelivery()
+        self.max_journal_size = max_journal_size
+        self.durable = durable
+
+        self.journal = None
+        self.journal_path = None
+        """
+        The open journal and its path, once the first message has been recorded.
+        """
+
+        self.sequence = 0
+        """
+        The sequence number of the last entry written.
+        """
+
+        self.unmarked = None
+        """
+        The sequence number of the last entry once its message has been delivered, until its mark
+        has been written together with the next entry.
+        """
+
+        self.incomplete = False
+        """
+        Whether the journal could not be written, or a message could neither be delivered nor
+        cut back. The journal is then left for recovery, and nothing else is delivered.
+        """
+
+        self.recovery_problems = []
+        """
+        The mailboxes that recover() could only partly repair, as messages for the user.
+        """
+
+    def get_folder(self) -> Path:
+        """
+        Returns the folder for the mailbox files, creating it the first time.
+        """
+
+        return self.delivery.get_folder()
+
+    def open_journal(self):
+        """
+        Returns the open journal, creating and locking it the first time.
+        """
+
+        while self.journal is None:
+            file_descriptor, path = tempfile.mkstemp(prefix=self.JOURNAL_PREFIX,
+                                                     dir=self.get_folder())
+            journal = os.fdopen(file_descriptor, "wb")
+            fcntl.flock(journal, fcntl.LOCK_EX)
+
+            # Another program's recovery could have found the new, unlocked file and removed it
+            try:
+                if os.path.samestat(os.stat(path), os.fstat(journal.fileno())):
+                    self.journal = journal
+                    self.journal_path = Path(path)
+                    continue
+            except FileNotFoundError:
+                pass
+
+            journal.close()
+
+        if self.durable:
+            # The new journal has to be found after a crash
+            self.delivery.sync([], folders=True)
+
+        return self.journal
+
+    def encode_entry(self, email_addresses: list, sizes: dict, message_length: int) -> tuple:
+        """
+        Returns the start and the end of the next entry in the journal, as two bytes objects that
+        go around the message.
+        """
+
+        self.sequence += 1
+        pieces = [self.ENTRY_HEADER.pack(b"B", self.sequence, len(email_addresses),
+                                         message_length)]
+        for email_address in email_addresses:
+            encoded_address = email_address.encode("utf-8")
+            pieces.append(self.RECIPIENT.pack(*sizes[email_address], len(encoded_address)))
+            pieces.append(encoded_address)
+
+        start = b"".join(pieces)
+        return start, self.ENTRY_END.pack(b"E", self.sequence, zlib.crc32(start))
+
+    def get_mark(self) -> bytes:
+        """
+        Returns the mark for the entry that has been delivered but not marked yet (if any), to be
+        written in front of the next entry.
+        """
+
+        return self.DELIVERED.pack(b"D", self.unmarked) if self.unmarked is not None else b""
+
+    def mark_delivered(self, journal):
+        """
+        Marks the last entry as delivered right away.
+        """
+
+        journal.write(self.DELIVERED.pack(b"D", self.sequence))
+        journal.flush()
+
+    def empty_journal(self):
+        """
+        Empties the journal if it has grown larger than max_journal_size. Every message in it must
+        have been delivered (and, with durable=True, synced) by then.
+        """
+
+        if self.journal is not None and self.journal.tell() > self.max_journal_size:
+            self.journal.seek(0)
+            self.journal.truncate()
+            self.unmarked = None
+
+    def deliver(self, email_addresses: list, message: bytes | MessageBuffer):
+        """
+        Records message in the journal, then appends it to the mailbox file of every address in
+        email_addresses. If that fails, none of the mailbox files keep it.
+        """
+
+        if self.incomplete:
+            if isinstance(message, MessageBuffer):
+                message.close()
+            raise ValueError("JournaledDelivery cannot deliver after a message was left "
+                             "incomplete.")
+
+        journal = self.open_journal()
+
+        # With locking, the mailboxes must not change from measuring them until the message has
+        # been written to them (or they have been cut back)
+        locked = self.delivery.lock_mailboxes(email_addresses) if self.delivery.locking else []
+        try:
+            self.record_and_deliver(journal, email_addresses, message)
+        finally:
+            for email_address in locked:
+                self.delivery.unlock_mailbox(email_address)
+
+    def record_and_deliver(self, journal, email_addresses: list, message: bytes | MessageBuffer):
+        """
+        The rest of deliver(), once the journal is open and the mailboxes are locked.
+        """
+
+        sizes = {email_address: self.delivery.get_sizes(email_address)
+                 for email_address in email_addresses}
+
+        try:
+            # The mark for the previous message goes out with the entry
+            mark = self.get_mark()
+            if isinstance(message, MessageBuffer) and message.is_spilled():
+                start, end = self.encode_entry(email_addresses, sizes, len(message))
+                message_offset = journal.tell() + len(mark) + len(start)
+                journal.write(mark + start)
+                message.write_to(journal)
+                journal.write(end)
+            else:
+                # A message in memory goes out in the same write as the rest of its entry
+                if isinstance(message, MessageBuffer):
+                    message_buffer, message = message, message.getvalue()
+                    message_buffer.close()
+                start, end = self.encode_entry(email_addresses, sizes, len(message))
+                message_offset = journal.tell() + len(mark) + len(start)
+                journal.write(b"".join([mark, start, message, end]))
+            journal.flush()
+            self.unmarked = None
+
+            if self.durable:
+                os.fsync(journal.fileno())
+        except Exception:
+            # Recovery stops reading where an entry was cut short, so nothing can follow it
+            self.incomplete = True
+            if isinstance(message, MessageBuffer):
+                message.close()
+            raise
+
+        entry = JournalEntry(self.sequence,
+                             [(email_address, sizes[email_address])
+                              for email_address in email_addresses],
+                             message_offset, len(message))
+
+        try:
+            self.delivery.deliver(email_addresses, message)
+        except Exception:
+            # Until the mailboxes have been cut back, the entry is all that is left
+            self.incomplete = True
+            if self.roll_back(entry):
+                self.incomplete = False
+                # Recovery must not deliver a message whose delivery failed
+                self.mark_delivered(journal)
+            raise
+
+        self.unmarked = self.sequence
+        if not self.durable:
+            self.empty_journal()
+
+    def sync(self, email_addresses, folders: bool = False):
+        """
+        Syncs the journal and then the mailbox files of email_addresses to disk (see
+        MailboxDelivery.sync()). With durable=True, the journal is emptied after that if it has
+        grown too large.
+        """
+
+        if self.journal is not None:
+            os.fsync(self.journal.fileno())
+
+        self.delivery.sync(email_addresses, folders)
+
+        if self.durable:
+            self.empty_journal()
+
+    @staticmethod
+    def read_exactly(file, size: int) -> bytes | None:
+        """
+        Reads size bytes from file, or returns None if it ends before that.
+        """
+
+        data = file.read(size)
+        return data if len(data) == size else None
+
+    def read_entry(self, journal, journal_size: int) -> JournalEntry | None:
+        """
+        Reads the rest of an entry whose "B" has just been read from journal. Returns None if the
+        entry was cut short (or is damaged).
+        """
+
+        header = self.read_exactly(journal, self.ENTRY_HEADER.size - 1)
+        if header is None:
+            return None
+        header = b"B" + header
+        _, sequence, recipient_count, message_length = self.ENTRY_HEADER.unpack(header)
+
+        pieces = [header]
+        recipients = []
+        for _ in range(recipient_count):
+            recipient = self.read_exactly(journal, self.RECIPIENT.size)
+            if recipient is None:
+                return None
+            mailbox_size, index_size, address_length = self.RECIPIENT.unpack(recipient)
+
+            encoded_address = self.read_exactly(journal, address_length)
+            if encoded_address is None:
+                return None
+
+            pieces += [recipient, encoded_address]
+            recipients.append((encoded_address.decode("utf-8", "replace"),
+                               (mailbox_size, index_size)))
+
+        message_offset = journal.tell()
+        if message_offset + message_length + self.ENTRY_END.size > journal_size:
+            return None
+        journal.seek(message_length, os.SEEK_CUR)
+
+        end = self.read_exactly(journal, self.ENTRY_END.size)
+        if end != self.ENTRY_END.pack(b"E", sequence, zlib.crc32(b"".join(pieces))):
+            return None
+
+        return JournalEntry(sequence, recipients, message_offset, message_length)
+
+    def read_unmarked_entries(self, journal) -> list:
+        """
+        Reads a whole journal and returns the entries that were recorded completely but not
+        marked as delivered, in order.
+        """
+
+        journal_size = os.fstat(journal.fileno()).st_size
+        entries = {}
+
+        while True:
+            kind = journal.read(1)
+            if kind == b"B":
+                entry = self.read_entry(journal, journal_size)
+                if entry is None:
+                    break
+                entries[entry.sequence] = entry
+            elif kind == b"D":
+                mark = self.read_exactly(journal, self.DELIVERED.size - 1)
+                if mark is None:
+                    break
+                entries.pop(self.DELIVERED.unpack(b"D" + mark)[1], None)
+            else:
+                # The end of the journal, or where writing it stopped
+                break
+
+        return list(entries.values())
+
+    @staticmethod
+    def read_message(journal_path: Path, entry: JournalEntry) -> bytes:
+        """
+        Returns the message of an entry, read from the journal at journal_path.
+        """
+
+        with journal_path.open("rb") as journal:
+            journal.seek(entry.message_offset)
+            return journal.read(entry.message_length)
+
+    @staticmethod
+    def group_recipients(entry: JournalEntry) -> list:
+        """
+        Returns (email address, (mailbox size, index size), copies) for every address of entry,
+        once per address; copies is how often the address was given (each got a copy).
+        """
+
+        copies = Counter(email_address for email_address, _ in entry.recipients)
+        sizes = dict(reversed(entry.recipients))
+        return [(email_address, sizes[email_address], count)
+                for email_address, count in copies.items()]
+
+    def get_expected_records(self, mailbox_size: int, entry: JournalEntry, copies: int) -> bytes:
+        """
+        Returns the index records that copies of the message of entry get when they are written
+        to a mailbox file at mailbox_size.
+        """
+
+        return b"".join(
+            MailboxDelivery.INDEX_RECORD.pack(mailbox_size + copy * entry.message_length,
+                                              entry.message_length, len(entry.recipients))
+            for copy in range(copies)
+        )
+
+    def compare_tail(self, path: Path, size: int, expected: bytes) -> str:
+        """
+        Tells what the file at path holds after its first size bytes: TAIL if that is expected or
+        the start of it (or nothing), FOLLOWED if it is expected followed by more, and FOREIGN if
+        it is anything else (or the file has become shorter than size).
+        """
+
+        try:
+            file = path.open("rb")
+        except FileNotFoundError:
+            return self.TAIL if size == 0 else self.FOREIGN
+
+        with file:
+            if os.fstat(file.fileno()).st_size < size:
+                return self.FOREIGN
+            file.seek(size)
+            data = file.read(len(expected) + 1)
+
+        if expected.startswith(data):
+            return self.TAIL
+        if data.startswith(expected):
+            return self.FOLLOWED
+        return self.FOREIGN
+
+    def roll_back(self, entry: JournalEntry) -> bool:
+        """
+        Cuts the mailbox files of entry (and their indexes) back to their recorded sizes, where
+        nothing but (part of) the message follows them. Returns False if the message could not be
+        taken out of one of them because something else follows it there.
+        """
+
+        message = self.read_message(self.journal_path, entry)
+        folder = self.delivery.get_folder()
+        rolled_back = True
+
+        for email_address, (mailbox_size, index_size), copies in self.group_recipients(entry):
+            if self.compare_tail(folder / email_address, mailbox_size,
+                                 message * copies) != self.TAIL:
+                rolled_back = False
+                continue
+
+            if self.delivery.index and self.compare_tail(
+                    self.delivery.get_index_path(email_address), index_size,
+                    self.get_expected_records(mailbox_size, entry, copies)) != self.TAIL:
+                rolled_back = False
+                continue
+
+            self.delivery.truncate_mailbox(email_address, (mailbox_size, index_size))
+
+        return rolled_back
+
+    def redeliver(self, journal_path: Path, entry: JournalEntry):
+        """
+        Writes the message of an entry to every one of its mailboxes that does not have it yet. A
+        copy that was cut short is only taken out if nothing follows it. The message is read
+        into memory; a journal has at most one such entry unless a message could not be cut back.
+        """
+
+        message = self.read_message(journal_path, entry)
+        folder = self.delivery.get_folder()
+        email_addresses = [email_address for email_address, _ in entry.recipients]
+
+        locked = self.delivery.lock_mailboxes(email_addresses) if self.delivery.locking else []
+        try:
+            for email_address, (mailbox_size, index_size), copies in self.group_recipients(entry):
+                mailbox_path = folder / email_address
+                expected = message * copies
+                mailbox_state = self.compare_tail(mailbox_path, mailbox_size, expected)
+
+                index_state = None
+                if self.delivery.index:
+                    index_state = self.compare_tail(
+                        self.delivery.get_index_path(email_address), index_size,
+                        self.get_expected_records(mailbox_size, entry, copies)
+                    )
+
+                if mailbox_state == self.FOLLOWED or (
+                        mailbox_state == self.TAIL and
+                        get_file_size(mailbox_path) == mailbox_size + len(expected)):
+                    # The message is all there; its index records may not be
+                    self.repair_index(email_address, index_state, mailbox_size, index_size,
+                                      entry, copies)
+                    continue
+
+                if mailbox_state == self.TAIL:
+                    # Only a copy that was cut short is at the end; take it out
+                    if index_state != self.TAIL:
+                        index_size = self.delivery.get_sizes(email_address)[1]
+                    self.delivery.truncate_mailbox(email_address, (mailbox_size, index_size))
+                else:
+                    self.recovery_problems.append(
+                        f"{mailbox_path}: the message was written again at the end; if the "
+                        f"program died while writing it here, part of it is still at byte "
+                        f"{mailbox_size}"
+                    )
+
+                for _ in range(copies):
+                    self.delivery.append_message(email_address, message, len(entry.recipients))
+        finally:
+            for email_address in locked:
+                self.delivery.unlock_mailbox(email_address)
+
+    def repair_index(self, email_address: str, index_state: str | None, mailbox_size: int,
+                     index_size: int, entry: JournalEntry, copies: int):
+        """
+        Adds the index records of a message that is all there in the mailbox file for
+        email_address, if they are missing (see redeliver()).
+        """
+
+        if index_state == self.TAIL:
+            # None, some or all of the records are there, and nothing else
+            self.delivery.truncate_mailbox(email_address,
+                                           (self.delivery.get_sizes(email_address)[0],
+                                            index_size))
+        elif index_state != self.FOREIGN:
+            return
+
+        for copy in range(copies):
+            self.delivery.write_index_record(email_address, IndexRecord(
+                mailbox_size + copy * entry.message_length, entry.message_length,
+                len(entry.recipients)
+            ))
+
+    def recover(self) -> int:
+        """
+        Finishes the deliveries in the journals of programs that died (the journals nobody holds
+        a lock on), then removes those journals. Returns how many messages were delivered again;
+        recovery_problems lists the mailboxes that could only partly be repaired.
+        """
+
+        folder = self.delivery.get_folder_path()
+        if not folder.is_dir():
+            return 0
+
+        recovered = 0
+        for path in sorted(folder.glob(self.JOURNAL_PREFIX + "*")):
+            try:
+                journal = path.open("rb")
+            except FileNotFoundError:
+                continue
+
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Still in use
+                    continue
+
+                for entry in self.read_unmarked_entries(journal):
+                    self.redeliver(path, entry)
+                    recovered += 1
+
+                with contextlib.suppress(FileNotFoundError):
+                    path.unlink()
+
+        return recovered
+
+    def close(self):
+        """
+        Closes the mailbox files, then removes the journal (unless a message in it was left
+        incomplete).
+        """
+
+        try:
+            self.delivery.close()
+        finally:
+            if self.journal is not None:
+                if not self.incomplete:
+                    with contextlib.suppress(FileNotFoundError):
+                        self.journal_path.unlink()
+                self.journal.close()
+                self.journal = None
+
+
+class Statistics:
+    """
+    Counters for --stats: how often each Parser non-terminal is called and how long it takes
+    (including the non-terminals that it calls), how many lines are handled in each state of the
+    SMTPServer, how many errors of each kind are sent, how many times a parser moves its cursor
+    back (rewinds), how often the AddressCache already knows the arguments of a command, and how
+    many bytes are delivered to each mailbox.
+
+    Nothing is counted unless an SMTPServer is given a Statistics object; without one, the only
+    cost is checking for None a few times per line. The non-terminals are timed by a subclass of
+    the parser class (see instrument()), so the Parser itself does not change at all.
+    """
+
+    def __init__(self):
+        self.nonterminal_calls = Counter()
+        self.nonterminal_seconds = Counter()
+        self.lines_by_state = Counter()
+        self.errors = Counter()
+        self.rewinds = 0
+        self.delivered_bytes = Counter()
+        self.address_cache = Counter()
+        self.instrumented_classes = {}
+
+    def __getstate__(self) -> dict:
+        # The instrumented classes are made on the fly and cannot be pickled (see run_batch())
+        state = self.__dict__.copy()
+        state["instrumented_classes"] = {}
+        return state
+
+    def instrument(self, parser_class: type) -> type:
+        """
+        Returns a subclass of parser_class that counts and times the non-terminals and counts the
+        rewinds into this Statistics object. The subclass is made only once per parser class.
+        """
+
+        if parser_class in self.instrumented_classes:
+            return self.instrumented_classes[parser_class]
+
+        calls = self.nonterminal_calls
+        seconds = self.nonterminal_seconds
+        perf_counter = time.perf_counter
+
+        def timed(name: str, method):
+            @functools.wraps(method)
+            def timed_method(parser, *args, **kwargs):
+                start = perf_counter()
+                try:
+                    return method(parser, *args, **kwargs)
+                finally:
+                    seconds[name] += perf_counter() - start
+                    calls[name] += 1
+
+            return timed_method
+
+        parent_rewind = parser_class.rewind
+
+        def rewind(parser, new_position: int) -> bool:
+            # fast_forward() goes through rewind() too; only moving back is a rewind
+            if new_position < parser.position:
+                self.rewinds += 1
+            return parent_rewind(parser, new_position)
+
+        namespace = {"__slots__": (), "rewind": rewind}
+        for name in parser_class.NON_TERMINALS:
+            namespace[name] = timed(name, getattr(parser_class, name))
+
+        instrumented_class = type(f"Instrumented{parser_class.__name__}", (parser_class,), namespace)
+        self.instrumented_classes[parser_class] = instrumented_class
+        return instrumented_class
+
+    def count_line(self, state: int):
+        """
+        Counts one line handled in the given SMTPServer state.
+        """
+
+        self.lines_by_state[state] += 1
+
+    def count_error(self, error_no: int):
+        """
+        Counts one error reply (500, 501, 503, 552).
+        """
+
+        self.errors[error_no] += 1
+
+    def count_delivery(self, email_addresses: list, size: int):
+        """
+        Counts a message of size bytes delivered to every one of email_addresses.
+        """
+
+        for email_address in email_addresses:
+            self.delivered_bytes[email_address] += size
+
+    def count_address_cache(self, address_cache: AddressCache):
+        """
+        Adds the hits, misses and evictions of an AddressCache.
+        """
+
+        self.address_cache.update(hits=address_cache.hits, misses=address_cache.misses,
+                                  evictions=address_cache.evictions)
+
+    def merge(self, other: "Statistics"):
+        """
+        Adds the counters of another Statistics object to this one.
+        """
+
+        self.nonterminal_calls.update(other.nonterminal_calls)
+        self.nonterminal_seconds.update(other.nonterminal_seconds)
+        self.lines_by_state.update(other.lines_by_state)
+        self.errors.update(other.errors)
+        self.rewinds += other.rewinds
+        self.delivered_bytes.update(other.delivered_bytes)
+        self.address_cache.update(other.address_cache)
+
+    def as_dict(self) -> dict:
+        """
+        Returns the counters in a form that can be written as JSON.
+        """
+
+        return {
+            "lines_by_state": {
+                SMTPServer.STATE_NAMES[state]: count for state, count in sorted(self.lines_by_state.items())
+            },
+            "errors": {str(error_no): count for error_no, count in sorted(self.errors.items())},
+            "rewinds": self.rewinds,
+            "address_cache": {
+                name: self.address_cache[name] for name in ["hits", "misses", "evictions"]
+            },
+            "nonterminals": {
+                name: {"calls": count, "seconds": self.nonterminal_seconds[name]}
+                for name, count in self.nonterminal_calls.most_common()
+            },
+            "delivered_bytes": dict(self.delivered_bytes.most_common()),
+        }
+
+    def write_summary(self, destination: str):
+        """
+        Writes the counters as JSON to the file at destination, or as text to stderr if
+        destination is "-".
+        """
+
+        if destination != "-":
+            with open(destination, "w", encoding="utf-8") as stats_file:
+                json.dump(self.as_dict(), stats_file, indent=2)
+                stats_file.write("\n")
+            return
+
+        summary = self.as_dict()
+        lines = ["statistics:", "  lines per state:"]
+        lines += [f"    {name:<30} {count:12,}" for name, count in summary["lines_by_state"].items()]
+        lines.append("  errors:")
+        lines += [f"    {error_no:<30} {count:12,}" for error_no, count in summary["errors"].items()]
+        lines.append(f"  {'rewinds':<32} {self.rewinds:12,}")
+        lines.append("  address cache:")
+        lines += [f"    {name:<30} {count:12,}" for name, count in summary["address_cache"].items()]
+        lines.append("  non-terminals (calls, total ms, us/call):")
+        for name, counters in summary["nonterminals"].items():
+            milliseconds = counters["seconds"] * 1000
+            lines.append(f"    {name:<30} {counters['calls']:12,} {milliseconds:12.1f} "
+                         f"{milliseconds * 1000 / counters['calls']:10.2f}")
+        lines.append(f"  bytes delivered ({len(self.delivered_bytes):,} mailboxes, "
+                     f"{sum(self.delivered_bytes.values()):,} bytes; top 20):")
+        lines += [f"    {address:<30} {size:12,}" for address, size in self.delivered_bytes.most_common(20)]
+
+        print("\n".join(lines), file=sys.stderr)
+
+
+class SMTPServer:
+    """
+    Class that will operate like a state machine to keep track of what command
+    is being handled next.
+    """
+    EXPECTING_MAIL_FROM = 0
+    EXPECTING_RCPT_TO = 1
+    EXPECTING_RCPT_TO_OR_DATA = 2
+    EXPECTING_DATA_END = 3
+
+    STATE_NAMES = {
+        EXPECTING_MAIL_FROM: "EXPECTING_MAIL_FROM",
+        EXPECTING_RCPT_TO: "EXPECTING_RCPT_TO",
+        EXPECTING_RCPT_TO_OR_DATA: "EXPECTING_RCPT_TO_OR_DATA",
+        EXPECTING_DATA_END: "EXPECTING_DATA_END",
+    }
+
+    EXPECTED_COMMANDS = {
+        EXPECTING_MAIL_FROM: ("MAIL FROM",),
+        EXPECTING_RCPT_TO: ("RCPT TO",),
+        EXPECTING_RCPT_TO_OR_DATA: ("RCPT TO", "DATA"),
+    }
+    """
+    The commands that are allowed in each state (anything else that is recognized is a 503).
+    """
+
+    NO_REPLY = CommandResult(0)
+    """
+    The result for a line of message text.
+    """
+
+    def __init__(self, debug_mode: bool = False, parser_class: type = Parser,
+                 writer: ResponseWriter = None, delivery: MailboxDelivery | DeliveryQueue = None,
+                 input_encoding: str = "utf-8", input_errors: str = "surrogateescape",
+                 stats: Statistics = None,
+                 spill_threshold: int = MessageBuffer.DEFAULT_SPILL_THRESHOLD,
+                 max_message_size: int = None, max_line_length: int = None,
+                 max_label_length: int = None, max_domain_length: int = None,
+                 address_cache_size: int = AddressCache.DEFAULT_MAX_SIZE):
+        self.state = self.EXPECTING_MAIL_FROM
+        self.to_email_addresses = []
+        # Messages larger than this are moved from memory to a temporary file
+        self.spill_threshold = spill_threshold
+        self.email_text = MessageBuffer(spill_threshold)
+        # The largest message (as written to a mailbox file) and the longest line (without the
+        # newline) that are accepted, or None for no limit
+        self.max_message_size = max_message_size
+        self.max_line_length = max_line_length
+        # Set once the current message is over a limit; the rest of it is thrown away
+        self.message_too_large = False
+        self.debug_mode = debug_mode
+        self.writer = writer
+        self.delivery = delivery if delivery is not None else MailboxDelivery()
+        # Replies are held back until the messages they acknowledge are durable
+        if writer is not None and isinstance(self.delivery, GroupCommitDelivery):
+            writer.before_flush = self.delivery.sync
+        # Command lines that arrive as bytes are decoded with these
+        self.input_encoding = input_encoding
+        self.input_errors = input_errors
+        # Counters for --stats, or None
+        self.stats = stats
+        if stats is not None:
+            parser_class = stats.instrument(parser_class)
+        # The arguments of recent MAIL FROM and RCPT TO commands, or None (address_cache_size=0)
+        self.address_cache = AddressCache(address_cache_size) if address_cache_size > 0 else None
+        # One parser per session; it is re-armed with set_line() for every line
+        self.parser = parser_class(debug_mode=debug_mode, writer=writer,
+                                   max_label_length=max_label_length,
+                                   max_domain_length=max_domain_length,
+                                   address_cache=self.address_cache,
+                                   max_line_length=max_line_length)
+
+    def handle_line(self, line) -> bool:
+        """
+        Handles one input line from start to finish: echoes it to the ResponseWriter, handles it
+        with process_line() and writes the reply (if any). Lines can be text or bytes. The line
+        is echoed before it is handled, so anything printed while handling it (--debug) comes
+        after it.
+
+        Returns False if an unexpected error occurred, which means that no more lines should be
+        handled.
+        """
+
+        if self.writer is None:
+            raise ValueError("handle_line() needs an SMTPServer with a ResponseWriter.")
+
+        self.writer.echo(line)
+        record = self.process_line(line)
+
+        if record.reply:
+            self.writer.reply(record.reply)
+
+        return record.ok
+
+    def write_record(self, record: LineRecord) -> bool:
+        """
+        Writes the echoed line and the reply (if any) of a LineRecord to the ResponseWriter and
+        returns record.ok.
+        """
+
+        # Apparently, print() was printing an extra line
+        self.writer.echo(record.echo)
+
+        if record.reply:
+            self.writer.reply(record.reply)
+
+        return record.ok
+
+    def process_lines(self, lines):
+        """
+        Handles lines one at a time as they are taken from lines (any iterable of text or bytes
+        lines, e.g., a file) and yields a LineRecord for each one, without writing anything
+        anywhere; the ResponseWriter is not needed. A whole transcript as one str or bytes object
+        is split into lines first (see process_chunks()).
+
+        Stops after the record of a line that caused an unexpected error (record.ok is False).
+        Errors from reading lines are not caught.
+        """
+
+        if isinstance(lines, (str, bytes, bytearray)):
+            yield from self.process_chunks([lines])
+            return
+
+        for line in lines:
+            record = self.process_line(line)
+            yield record
+
+            if not record.ok:
+                return
+
+    def process_line(self, line) -> LineRecord:
+        """
+        Handles one input line: loads it into the parser and evaluates the state of the server.
+        Command lines that are bytes are decoded first. Returns the LineRecord instead of writing
+        anything.
+        """
+
+        try:
+            # Only the text of a message may stay as bytes; the parser needs text otherwise
+            text = line
+            if isinstance(line, bytes) and not self.expects_message_text():
+                text = line.decode(self.input_encoding, self.input_errors)
+
+            # Load this line into the server's parser
+            self.set_line(text)
+
+        except Exception as e:
+            return LineRecord(line, f"An unexpected error occurred: {e}", False)
+
+        return self.process_loaded_line(line)
+
+    def process_loaded_line(self, echo) -> LineRecord:
+        """
+        The part of process_line() that comes after the line has been loaded into the parser:
+        evaluates the state of the server and returns the LineRecord, with echo as the line.
+        """
+
+        if self.stats is not None:
+            self.stats.count_line(self.state)
+
+        try:
+            # Based on the current line, evaluate the state of the SMTP server and what should be
+            # done. Errors come back as results instead of exceptions (see evaluate_line()).
+            result = self.evaluate_line()
+
+            if result.is_error() and self.stats is not None:
+                self.stats.count_error(result.code)
+
+            return LineRecord(echo, result.reply())
+
+        except ParserError as pe:
+            # All errors that should be handled according to the writeup are handled as ParserError
+            # objects. All other exceptions are ValueError or some other type. If a ParserError
+            # occurrs, the write up says "upon receipt of any erroneous SMTP message you should
+            # reset your state machine and return to the state of waiting for a valid MAIL FROM
+            # message".
+            self.reset()
+
+            if self.stats is not None:
+                self.stats.count_error(pe.error_no)
+
+            return LineRecord(echo, str(pe))
+
+        except Exception as e:
+            return LineRecord(echo, f"An unexpected error occurred: {e}", False)
+
+    def process_chunks(self, chunks):
+        """
+        Like process_lines(), but for input that arrives in arbitrary pieces of text or bytes
+        (e.g., from a network connection) instead of whole lines. See feed().
+        """
+
+        for chunk in chunks:
+            for record in self.process_chunk(chunk):
+                yield record
+
+                if not record.ok:
+                    return
+
+        if self.parser.feed_end():
+            yield self.process_fed_line()
+
+    def process_chunk(self, chunk):
+        """
+        Yields a LineRecord for every line that chunk completes; the rest is kept by the parser
+        until the next chunk. No part of chunk is scanned more than once; see Parser.feed().
+        """
+
+        start = 0
+        while start < len(chunk):
+            start = self.parser.feed(chunk, start, self.expects_message_text())
+            if start < 0:
+                return
+
+            yield self.process_fed_line()
+
+    def process_fed_line(self) -> LineRecord:
+        """
+        Handles a line that feed() has put together in the parser. Message text is handled where
+        it is, so that what feed() has already checked is not checked again; command lines go
+        through process_line() to be decoded.
+        """
+
+        line = self.parser.get_input_line_raw()
+
+        if not self.expects_message_text():
+            return self.process_line(line)
+
+        return self.process_loaded_line(line)
+
+    def feed(self, chunk) -> bool:
+        """
+        Handles input that arrives in arbitrary pieces (e.g., from a network connection) instead
+        of whole lines. Every line that is completed by chunk is handled right away, like with
+        handle_line(), and the rest is kept by the parser until the next call. Call feed_end() at
+        the end of the input.
+
+        Returns False if an unexpected error occurred, which means that no more input should be
+        handled.
+        """
+
+        if self.writer is None:
+            raise ValueError("feed() needs an SMTPServer with a ResponseWriter.")
+
+        for record in self.process_chunk(chunk):
+            if not self.write_record(record):
+                return False
+
+        return True
+
+    def feed_end(self) -> bool:
+        """
+        Handles the last line given to feed() if the input ended without a newline after it.
+        Returns False if an unexpected error occurred.
+        """
+
+        if not self.parser.feed_end():
+            return True
+
+        return self.write_record(self.process_fed_line())
+
+    def set_line(self, line: str):
+        """
+        Loads the next input line into the parser for this session. Lines of the message text may
+        be bytes; every other line must be text (see expects_message_text()).
+        """
+
+        self.parser.load(line)
+
+    def expects_message_text(self) -> bool:
+        """
+        Returns True if the next line is part of the text of a message (or the end of it). Those
+        lines can be passed to set_line() as bytes without decoding them.
+        """
+
+        return self.state == self.EXPECTING_DATA_END
+
+    def set_parser(self, current_parser: Parser):
+        """
+        By the time the parser is set, the line has already been read. That means,
+        what we do is check the current state and act accordingly.
+        """
+        self.parser = current_parser
+
+        if not isinstance(current_parser, Parser):
+            raise ValueError("parser must be an instance of Parser class.")
+
+    def add_text_to_email_body(self, text: str):
+        """
+        Add the input string without the trailing newline character to the MessageBuffer that
+        will be appended to the message if the message parses correctly.
+
+        Note to self: .strip() is too greedy and will remove trailing and leading spaces and tabs,
+        changing the original content of each line passed to the parser.
+
+        Another note to self: if this function is called, just do it; do not try to prevent an
+        empty string from being sent to the email message.
+
+        The lines are kept as bytes so that message lines that were read as bytes can go straight
+        to the mailbox files. Everything that reaches this point has been checked to be ASCII.
+        """
+
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+
+        self.email_text.append_line(text)
+
+
+    def evaluate_state(self):
+        """
+        Determines what should happen
+        """
+        if not isinstance(self.parser, Parser):
+            raise ValueError("parser must be an instance of Parser class.")
+
+        # Syntax errors in the message name (type 500 errors) should take precedence over all other
+        # errors.
+        # Out-of-order (type 503 errors) should take precedence over parameter/argument errors
+        # (type 501 errors). This means that we can no longer throw a 501 error until we have
+        # verified that the command is in the correct sequence.
+
+        # A command line that is too long is not parsed at all
+        if self.state != self.EXPECTING_DATA_END and self.is_line_too_long():
+            raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+        # We need to know if any command is recognized to be ready for 503 errors
+        recognized_command = self.command_id_errors()
+
+        # STATE == 0
+        if self.state == self.EXPECTING_MAIL_FROM:
+            # if the command fails, that means a type 501 error occurred.
+            if not self.parser.mail_from_cmd():
+                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+            # If we made it here, the command was fully parsed successfully
+            # Add the "From: <reverse-path>" line to the list of email text lines
+            self.add_text_to_email_body(self.parser.get_from_line_for_email())
+            return self.advance()
+
+        if self.state == self.EXPECTING_RCPT_TO or \
+            (self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command == "RCPT TO"):
+            # if the command fails, that means a type 501 error occurred.
+            if not self.parser.rcpt_to_cmd():
+                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+            # If we made it here, the command was fully parsed successfully
+            # Add the "To: <forward-path>" line to the list of email text lines
+            self.add_text_to_email_body(self.parser.get_to_line_for_email())
+            self.to_email_addresses.append(self.parser.get_email_address())
+
+            # Only advance if this is the first time we are seeing a To: address
+            if self.state == self.EXPECTING_RCPT_TO:
+                self.advance()
+
+            return
+
+        if self.state == self.EXPECTING_RCPT_TO_OR_DATA:
+            # This means that the recognized command must be "DATA", but we'll check anyway
+            if recognized_command == "DATA" and not self.parser.data_cmd():
+                raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
+
+            # If we made it here, the command was fully parsed successfully
+            # Advance so that we can start reading the message
+            return self.advance()
+
+        if self.state == self.EXPECTING_DATA_END:
+            # This is different because any text that does not create an error that is parsed
+            # here is considered valid until the ending comes.
+            if self.parser.data_end_cmd(check_only=True):
+                # A message that went over a limit is only rejected now, at its end, so that the
+                # rest of it is not taken for commands.
+                if self.message_too_large or self.is_over_message_size():
+                    raise ParserError(ParserError.EXCEEDED_STORAGE_ALLOCATION)
+
+                # The "250 OK" is only sent once the message has been handed to the mailboxes
+                # (see DeliveryQueue for what that means when delivery happens in the background).
+                self.process_email_message()
+                self.parser.print_success()
+                return self.advance()
+
+            # The rest of a message that is over a limit is not checked or kept
+            if self.message_too_large:
+                return
+
+            if self.is_line_too_long():
+                return self.discard_message()
+
+            # if an error occurs while reading a line meant for the body of the message, then
+            # throw an error. According to the writeup, "we'll assume that 'text' is limited to
+            # printable text, whitespace, and newlines".
+            if not self.parser.data_read_msg_line():
+                raise ParserError(ParserError.SYNTAX_ERROR_IN_PARAMETERS)
+
+            self.add_text_to_email_body(self.parser.get_input_line())
+
+            if self.is_over_message_size():
+                self.discard_message()
+
+    def evaluate_line(self) -> CommandResult:
+        """
+        Exception-free version of evaluate_state(): handles the line in the parser and returns a
+        CommandResult instead of raising a ParserError and printing the reply. The state machine
+        changes the same way, including starting over after an error, and the reply (if any) is
+        result.reply(). Under error-heavy input, this is cheaper than raising and catching an
+        exception for every rejected line.
+        """
+
+        if self.state == self.EXPECTING_DATA_END:
+            return self.evaluate_message_line()
+
+        # A command line that is too long is not parsed at all
+        if self.is_line_too_long():
+            return self.reject(CommandResult(ParserError.COMMAND_UNRECOGNIZED))
+
+        # 500 errors take precedence over 503 errors, which take precedence over 501 errors
+        result = self.parser.parse_command(self.EXPECTED_COMMANDS[self.state])
+
+        if self.debug_mode:
+            print(f"line: {self.parser.input_string.strip()}, state: {self.state}, recognized_command: {self.parser.get_command_name()}")
+
+        if result.is_error():
+            return self.reject(result)
+
+        if result.command == "DATA":
+            self.advance()
+            return result
+
+        path, email_address = result.address
+
+        if result.command == "MAIL FROM":
+            self.add_text_to_email_body(f"From: {path}")
+            self.advance()
+            return result
+
+        self.add_text_to_email_body(f"To: {path}")
+        self.to_email_addresses.append(email_address)
+
+        # Only advance if this is the first time we are seeing a To: address
+        if self.state == self.EXPECTING_RCPT_TO:
+            self.advance()
+
+        return result
+
+    def evaluate_message_line(self) -> CommandResult:
+        """
+        The EXPECTING_DATA_END part of evaluate_line(): either the end of the message or a line
+        of its text.
+        """
+
+        if self.parser.data_end_cmd(check_only=True):
+            if self.message_too_large or self.is_over_message_size():
+                return self.reject(CommandResult(ParserError.EXCEEDED_STORAGE_ALLOCATION))
+
+            self.process_email_message()
+            self.advance()
+            return CommandResult(250)
+
+        if self.message_too_large:
+            return self.NO_REPLY
+
+        if self.is_line_too_long():
+            self.discard_message()
+            return self.NO_REPLY
+
+        if not self.parser.data_read_msg_line():
+            return self.reject(CommandResult(ParserError.SYNTAX_ERROR_IN_PARAMETERS))
+
+        self.add_text_to_email_body(self.parser.get_input_line())
+
+        if self.is_over_message_size():
+            self.discard_message()
+
+        return self.NO_REPLY
+
+    def reject(self, result: CommandResult) -> CommandResult:
+        """
+        Starts over after an error, as the writeup requires, and returns the result.
+        """
+
+        self.reset()
+        return result
+
+    def is_over_message_size(self) -> bool:
+        """
+        Returns True if the current message is larger than max_message_size.
+        """
+
+        return self.max_message_size is not None and len(self.email_text) > self.max_message_size
+
+    def is_line_too_long(self) -> bool:
+        """
+        Returns True if the line in the parser is longer than max_line_length.
+        """
+
+        return self.max_line_length is not None and \
+            self.parser.get_input_line_length() > self.max_line_length
+
+    def discard_message(self):
+        """
+        Throws away the text of the current message because it went over a limit. The rest of
+        the message is ignored until the final ".", which is answered with a 552 error.
+        """
+
+        self.message_too_large = True
+        self.email_text.close()
+
+    def command_id_errors(self) -> str:
+        """
+        If no command is recognized, then that results in a 500 error.
+        If an unexpected command is recognized based on the current state, that results in a 503.
+        Return the recognized command. This is helpful for when a state represents an option,
+        RCPT TO or DATA.
+        """
+
+        if self.state not in [self.EXPECTING_MAIL_FROM, self.EXPECTING_RCPT_TO, self.EXPECTING_RCPT_TO_OR_DATA]:
+            return ""
+
+        if not isinstance(self.parser, Parser):
+            raise ValueError("parser must be an instance of Parser class.")
+
+        any_command_recognized = self.parser.check_for_commands()
+        recognized_command = self.parser.get_command_name()
+
+        if self.debug_mode:
+            print(f"line: {self.parser.input_string.strip()}, state: {self.state}, recognized_command: {recognized_command}")
 
         if not any_command_recognized or not recognized_command:
             raise ParserError(ParserError.COMMAND_UNRECOGNIZED)
 
-        if self.state == self.EXPECTING_MAIL_FROM and recognized_command != "MAIL FROM":
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+        if self.state == self.EXPECTING_MAIL_FROM and recognized_command != "MAIL FROM":
+            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+
+        if self.state == self.EXPECTING_RCPT_TO and recognized_command != "RCPT TO":
+            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+
+        if self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command not in ["RCPT TO", "DATA"]:
+            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+
+        return recognized_command
+
+    def reset(self):
+        """
+        Resets the SMTP server state machine to expect a new email.
+        """
+        self.state = self.EXPECTING_MAIL_FROM
+        self.to_email_addresses = []
+        # Throw away the text of a message that was not finished
+        self.email_text.close()
+        self.message_too_large = False
+
+    def advance(self):
+        """
+        Advances the state of the SMTP server by 1. If a message is completed,
+        then it starts over and waits for the next one.
+        """
+        if self.state != self.EXPECTING_DATA_END:
+            self.state += 1
+            return
+
+        self.reset()
+
+    def create_folder(self, folder_name: str) -> Path:
+        """
+        Create a folder with the specified name in the current working directory.
+
+        The mailbox folder itself is created by MailboxDelivery when the first message is
+        delivered. The server's delivery can be a wrapper around a MailboxDelivery, so this does
+        not go through it.
+        """
+
+        return MailboxDelivery(folder_name).create_folder(folder_name)
+
+    def process_email_message(self):
+        """
+        Takes the lines that make up the email message and appends them to the mailbox files in
+        the "forward" folder for each recipient of the current message (to_email_addresses).
+        """
+
+        # 1. Get the text of the message; it now belongs to the delivery, which closes it
+        email_complete_text = self.email_text
+        message_size = len(email_complete_text)
+        self.email_text = MessageBuffer(self.spill_threshold)
+
+        # 2. For each recipient of the latest email message, append the text
+        # of the email to a file with the email address as the name.
+        self.delivery.deliver(self.to_email_addresses, email_complete_text)
+
+        if self.stats is not None:
+            self.stats.count_delivery(self.to_email_addresses, message_size)
+
+    def close(self):
+        """
+        Closes the mailbox files that are still open. Call this at the end of the input, or when
+        stopping because of an error.
+        """
+
+        # The text of a message that was not finished is thrown away
+        self.email_text.close()
+        self.count_address_cache()
+        self.delivery.close()
+
+    def count_address_cache(self):
+        """
+        Adds the hits, misses and evictions of the address cache to the stats (if there are any)
+        and starts counting them over.
+        """
+
+        if self.stats is None or self.address_cache is None:
+            return
+
+        self.stats.count_address_cache(self.address_cache)
+        self.address_cache.hits = self.address_cache.misses = self.address_cache.evictions = 0
+
+
+class ConnectionOutput:
+    """
+    Lets a ResponseWriter write to a network connection (an asyncio.StreamWriter). The replies
+    are written as bytes; waiting for them to be sent (drain) is up to handle_connection().
 
-        if self.state == self.EXPECTING_RCPT_TO and recognized_command != "RCPT TO":
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+    It has to be made in the event loop thread. With threadsafe=True, it can be written to from
+    any thread (the SMTPServer runs in the session thread; see handle_connection()): the data is
+    handed to the connection by the event loop, in the order it was written.
+    """
 
-        if self.state == self.EXPECTING_RCPT_TO_OR_DATA and recognized_command not in ["RCPT TO", "DATA"]:
-            raise ParserError(ParserError.BAD_SEQUENCE_OF_COMMANDS)
+    encoding = "utf-8"
+    errors = "surrogateescape"
 
-        return recognized_command
+    def __init__(self, stream_writer: asyncio.StreamWriter, threadsafe: bool = False):
+        self.stream_writer = stream_writer
+        self.loop = asyncio.get_running_loop() if threadsafe else None
 
-    def reset(self):
+        # ResponseWriter writes bytes to the "buffer" of its stream
+        self.buffer = self
+
+    def write(self, data: bytes):
         """
-        Resets the SMTP server state machine to expect a new email.
+        Hands data to the connection; asyncio sends it in the background.
         """
-        self.state = self.EXPECTING_MAIL_FROM
-        self.to_email_addresses = []
-        self.email_text = []
 
-    def advance(self):
+        if self.loop is None:
+            self.stream_writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.stream_writer.write, data)
+
+    def flush(self):
         """
-        Advances the state of the SMTP server by 1. If a message is completed,
-        then it starts over and waits for the next one.
+        Nothing to do here; see handle_connection().
         """
-        if self.state != self.EXPECTING_DATA_END:
-            self.state += 1
+
+
+CONNECTION_READ_SIZE = 64 * 1024
+"""
+How many bytes are read from a network connection at a time.
+"""
+
+
+def create_session_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Returns the executor with the single session thread that runs the SMTPServer state machines
+    (and so the deliveries) of --listen and --daemon connections, one piece of input at a time.
+    """
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="session")
+
+
+def delivery_may_wait(delivery) -> bool:
+    """
+    Returns True if delivery can hold up its caller for longer than it takes to write to a file:
+    waiting for room in a DeliveryQueue or for its worker thread (--ack-when written), syncing to
+    disk (GroupCommitDelivery, or a durable JournaledDelivery) or waiting for a mailbox lock.
+    """
+
+    if isinstance(delivery, (DeliveryQueue, GroupCommitDelivery)):
+        return True
+
+    if isinstance(delivery, JournaledDelivery):
+        return delivery.durable or delivery_may_wait(delivery.delivery)
+
+    return delivery.locking
+
+
+async def run_in_session(executor: concurrent.futures.Executor, function, *args):
+    """
+    Calls function(*args) in the session thread of executor and waits for the result, or calls
+    it right away in the event loop thread if executor is None.
+    """
+
+    if executor is None:
+        return function(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def handle_connection(reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter,
+                            delivery: MailboxDelivery | DeliveryQueue, server_options: dict,
+                            executor: concurrent.futures.Executor = None):
+    """
+    Runs one SMTPServer state machine for one network connection. Lines are read from the
+    connection and the replies are written back to it (the lines are not echoed). All the lines
+    that arrived together are handled before the replies are sent, so a client that sends several
+    commands at once gets all of the replies at once.
+
+    The delivery is shared by every connection, and messages are never written to a mailbox file
+    at the same time. If executor is None, the state machine (and so the delivery) runs in the
+    event loop thread. Otherwise it runs in the single session thread of executor (see
+    create_session_executor()), so that a delivery that has to wait (see delivery_may_wait())
+    does not stop the event loop thread from accepting, reading and answering the other
+    connections in the meantime.
+
+    server_options are passed to SMTPServer() as keyword arguments (parser_class, stats, etc.).
+    """
+
+    loop = asyncio.get_running_loop()
+    output = ConnectionOutput(stream_writer, threadsafe=executor is not None)
+    writer = ResponseWriter(output, interactive=False, echo_input=False)
+    server = SMTPServer(writer=writer, delivery=delivery, **server_options)
+
+    def handle_chunk(chunk: bytes) -> bool:
+        # Lines are handled as soon as they are complete; a line that is cut off at the end
+        # of the chunk is finished by a later one
+        if not server.feed(chunk):
+            return False
+
+        writer.flush()
+        return True
+
+    def finish(ended: bool):
+        try:
+            if ended:
+                # The client closed the connection; the last line does not end with a newline
+                server.feed_end()
+        finally:
+            # The delivery is shared, so the server is not closed; only its counters are kept
+            server.count_address_cache()
+            writer.flush()
+            loop.call_soon_threadsafe(stream_writer.close)
+
+    ended = False
+    try:
+        while True:
+            chunk = await reader.read(CONNECTION_READ_SIZE)
+            if not chunk:
+                ended = True
+                break
+
+            if not await run_in_session(executor, handle_chunk, chunk):
+                break
+
+            await stream_writer.drain()
+
+    except ConnectionError:
+        # The client went away; nothing can be sent back
+        pass
+
+    finally:
+        if executor is None:
+            finish(ended)
+        else:
+            # The rest is not waited for; the connection is closed in the event loop thread once
+            # the replies are on their way
+            executor.submit(finish, ended)
+
+
+async def start_listener(host: str, port: int, delivery: MailboxDelivery | DeliveryQueue = None,
+                         **server_options) -> asyncio.Server:
+    """
+    Starts listening for SMTP clients on host and port (0 picks a free port). Every connection
+    gets its own SMTPServer, made with the keyword arguments in server_options; all of them
+    deliver with the same delivery (and count into the same stats, if there are any). If the
+    delivery may have to wait, they all run in the same session thread (see handle_connection()).
+    """
+
+    if delivery is None:
+        delivery = MailboxDelivery()
+
+    # Writing to a mailbox file is quick enough for the event loop thread. The session thread is
+    # left running until the program exits, since connections can still be finishing there.
+    executor = create_session_executor() if delivery_may_wait(delivery) else None
+
+    def on_connection(reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter):
+        return handle_connection(reader, stream_writer, delivery, server_options, executor)
+
+    return await asyncio.start_server(on_connection, host, port)
+
+
+async def run_listener(host: str, port: int, delivery: MailboxDelivery | DeliveryQueue,
+                       **server_options):
+    """
+    Serves SMTP clients until the program is stopped.
+    """
+
+    listener = await start_listener(host, port, delivery, **server_options)
+    addresses = ", ".join(str(sock.getsockname()) for sock in listener.sockets)
+    print(f"Listening on {addresses}", file=sys.stderr)
+
+    async with listener:
+        await listener.serve_forever()
+
+
+async def handle_transcript(reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter,
+                            create_delivery, server_options: dict,
+                            executor: concurrent.futures.Executor):
+    """
+    Runs one transcript sent by a client of the daemon (see smtp_client.py) with a fresh
+    SMTPServer, exactly as if it had been piped into the program: every line is echoed and the
+    output goes back over the connection. The first line that the client sends is its working
+    directory, where the "forward" folder goes; the transcript follows until the client shuts
+    down its side of the connection.
+
+    create_delivery(base_folder) makes the delivery for the transcript. server_options are passed
+    to SMTPServer() as keyword arguments. As with handle_connection(), the state machine and the
+    delivery run in the session thread of executor.
+    """
+
+    loop = asyncio.get_running_loop()
+    writer = ResponseWriter(ConnectionOutput(stream_writer, threadsafe=True), interactive=False)
+
+    def handle_chunk(chunk: bytes) -> bool:
+        if not server.feed(chunk):
+            return False
+
+        writer.flush()
+        return True
+
+    def finish(ended: bool):
+        try:
+            if ended:
+                # The input does not have to end with a newline
+                server.feed_end()
+        finally:
+            # Messages that are delivered in the background can still fail here
+            try:
+                server.close()
+            except Exception as e:
+                writer.reply(f"An unexpected error occurred: {e}")
+
+            writer.flush()
+            loop.call_soon_threadsafe(stream_writer.close)
+
+    try:
+        header = await reader.readline()
+        if not header.endswith(CRLF_BYTES):
+            stream_writer.close()
             return
 
-        self.reset()
+        base_folder = Path(os.fsdecode(header[:-len(CRLF_BYTES)]))
+        delivery = await run_in_session(executor, create_delivery, base_folder)
+        server = SMTPServer(writer=writer, delivery=delivery, **server_options)
+
+    except ConnectionError:
+        # The client went away; nothing can be sent back
+        stream_writer.close()
+        return
+
+    ended = False
+    try:
+        while True:
+            chunk = await reader.read(CONNECTION_READ_SIZE)
+            if not chunk:
+                ended = True
+                break
 
-    def create_folder(self, folder_name: str) -> Path:
-        """
-        Create a folder with the specified name in the same location as this
-        Python script.
-        """
+            if not await run_in_session(executor, handle_chunk, chunk):
+                break
 
-        if not folder_name:
-            raise ValueError("create_folder(); must specify a folder name")
+            await stream_writer.drain()
 
-        # This is the folder that this Python script lives in.
-        # I got this wrong the first time; this should be in the "current working directory" (p. 6)
-        current_folder = Path.cwd()
-        # This is the "forward" folder I want to create
-        new_folder = current_folder / folder_name
+    except ConnectionError:
+        # The client went away; nothing can be sent back
+        pass
 
-        # it's okay if the folder already exists
-        new_folder.mkdir(exist_ok=True)
+    finally:
+        # As in handle_connection(), the rest is not waited for
+        executor.submit(finish, ended)
 
-        return new_folder
 
-    def process_email_message(self):
-        """
-        Takes the lines that make up the email message and appends them to the mailbox files in
-        the "forward" folder for each recipient of the current message (to_email_addresses).
-        """
+async def run_daemon(socket_path: Path, create_delivery, **server_options):
+    """
+    Listens on the Unix socket at socket_path and runs every transcript that a client sends (see
+    handle_transcript()) until the program is stopped (Ctrl+C or SIGTERM). The program only starts
+    once, so a short transcript does not have to pay for starting Python and importing everything
+    every time.
+    """
 
-        # 1. Get the text of the message
-        email_complete_text = "\n".join(self.email_text) + "\n"
+    # Like start_listener(), the session thread is left running until the program exits
+    executor = create_session_executor()
 
-        # 2. Create the "folder" folder
-        forward_folder = self.create_folder("forward")
+    def on_connection(reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter):
+        return handle_transcript(reader, stream_writer, create_delivery, server_options, executor)
 
-        # 3. For each recipient of the latest email message, append the text
-        # of the email to a file with the email address as the name.
-        for email_address in self.to_email_addresses:
-            forward_path = forward_folder / email_address
+    # A socket file left behind by a daemon that was killed is replaced
+    if socket_path.is_socket():
+        socket_path.unlink()
+
+    listener = await asyncio.start_unix_server(on_connection, socket_path)
+    print(f"Listening on {socket_path}", file=sys.stderr)
+
+    # SIGTERM (e.g., from kill) stops the daemon the same way as Ctrl+C
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+
+    try:
+        async with listener:
+            await stopped.wait()
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            socket_path.unlink()
+
+
+def find_shard_boundaries(data, shard_count: int) -> list:
+    """
+    Splits a transcript into about shard_count pieces that can be processed independently and
+    returns them as (start, end) byte offsets.
+
+    A piece may only start where the SMTPServer state machine is known to be back in the
+    EXPECTING_MAIL_FROM state with nothing left over from the previous message. That is true right
+    after every line that is exactly "." <CRLF>: in the EXPECTING_DATA_END state it ends the
+    message, and in every other state it is not a command, so the 500 error resets the state
+    machine. So each piece starts right after such a line.
+
+    :param data: The transcript, e.g., a memory-mapped file (anything with find() and len()).
+    :param shard_count: How many pieces to aim for.
+    """
+
+    size = len(data)
+    shard_size = max(size // max(shard_count, 1), 1)
+    # "\n.\n" is a line that is exactly "." <CRLF>, preceded by the end of the line before it
+    split_marker = CRLF_BYTES + DATA_END_LINE_BYTES
+
+    starts = [0]
+    while True:
+        marker = data.find(split_marker, starts[-1] + shard_size - 1)
+        if marker == -1:
+            break
+
+        start = marker + len(split_marker)
+        if start >= size:
+            break
+
+        starts.append(start)
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def process_shard(path: str, start: int, end: int, shard_folder: str, input_encoding: str,
+                  input_errors: str, output_encoding: str, output_errors: str,
+                  collect_stats: bool = False, server_options: dict = None,
+                  mailbox_index: bool = False) -> tuple:
+    """
+    Runs in a worker process: handles the lines of the transcript from byte offset start up to
+    end with a fresh SMTPServer, made with the keyword arguments in server_options. The output
+    goes to shard_folder/stdout and the mailbox files (with their indexes, if mailbox_index is
+    True) to shard_folder/forward, so that run_batch() can put everything together in order.
+
+    Returns (False if an unexpected error stopped the shard early, the Statistics of the shard
+    or None).
+    """
+
+    shard_folder = Path(shard_folder)
+    completed = True
+    stats = Statistics() if collect_stats else None
+
+    with open(shard_folder / "stdout", "w", encoding=output_encoding, errors=output_errors) as output, \
+            open(path, "rb") as transcript:
+        writer = ResponseWriter(output, interactive=False)
+        delivery = MailboxDelivery(base_folder=shard_folder, index=mailbox_index)
+        server = SMTPServer(writer=writer, delivery=delivery, input_encoding=input_encoding,
+                            input_errors=input_errors, stats=stats, **(server_options or {}))
+
+        try:
+            transcript.seek(start)
+            position = start
+
+            # Every shard ends at the end of a line, so readline() never goes past end
+            max_line_length = (server_options or {}).get("max_line_length")
+            while position < end:
+                line, read = read_limited_line(transcript, max_line_length)
+                position += read
+
+                if not server.handle_line(line):
+                    completed = False
+                    break
+        finally:
+            server.close()
+            writer.flush()
+
+    return completed, stats
+
+
+def append_file(source: Path, destination):
+    """
+    Appends the contents of the file at source to the open binary file destination.
+    """
+
+    with source.open("rb") as source_file:
+        shutil.copyfileobj(source_file, destination, 1024 * 1024)
+
+
+def run_batch(path: Path, workers: int, stats: Statistics = None, mailbox_index: bool = False,
+              durable: bool = False, locking: bool = False, **server_options):
+    """
+    Processes a whole transcript file in parallel. The file is memory-mapped to find the places
+    where it can be split (see find_shard_boundaries()), and the pieces are handled by a pool of
+    worker processes. Then, in the original order, the output of every piece is written to
+    stdout and its messages are appended to the mailbox files in the "forward" folder, so both
+    end up exactly the same as when the file is piped through the program one line at a time,
+    including the order of the messages in every mailbox.
+
+    If a piece stops early because of an unexpected error, the pieces after it are thrown away,
+    since the program would have stopped there. The counters of every piece that is kept are
+    added to stats. server_options are passed to SMTPServer() in every worker process. With
+    mailbox_index=True, the mailbox files get indexes (see MailboxDelivery). With durable=True,
+    the messages of every piece are synced to disk (fsync) before its output is written. With
+    locking=True, every mailbox file is locked while a piece is appended to it.
+    """
+
+    stdout = sys.stdout
+    stdout.flush()
+
+    with open(path, "rb") as transcript:
+        if os.fstat(transcript.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(transcript.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # A few pieces per worker keeps every worker busy even if the pieces are uneven
+            shards = find_shard_boundaries(data, workers * 4)
+
+    delivery = MailboxDelivery(index=mailbox_index, locking=locking)
+
+    # The pieces are written next to the "forward" folder, on the same disk
+    with tempfile.TemporaryDirectory(prefix=".smtp1-shards-", dir=Path.cwd()) as temp_folder, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_folders = []
+        for number in range(len(shards)):
+            shard_folder = Path(temp_folder) / str(number)
+            shard_folder.mkdir()
+            shard_folders.append(shard_folder)
+
+        results = executor.map(
+            process_shard,
+            [str(path)] * len(shards),
+            [start for start, _ in shards],
+            [end for _, end in shards],
+            [str(shard_folder) for shard_folder in shard_folders],
+            [sys.stdin.encoding] * len(shards),
+            [sys.stdin.errors] * len(shards),
+            [stdout.encoding] * len(shards),
+            [stdout.errors] * len(shards),
+            [stats is not None] * len(shards),
+            [server_options] * len(shards),
+            [mailbox_index] * len(shards),
+        )
+
+        # Put the pieces together in order, as soon as each one is done
+        try:
+            for shard_folder, (completed, shard_stats) in zip(shard_folders, results):
+                if stats is not None:
+                    stats.merge(shard_stats)
+
+                shard_forward_folder = shard_folder / delivery.folder_name
+                if shard_forward_folder.is_dir():
+                    delivery.append_mailboxes(shard_forward_folder)
+
+                    # The replies of this piece are only written once its messages are durable
+                    if durable:
+                        delivery.sync([mailbox.name for mailbox in shard_forward_folder.iterdir()
+                                       if mailbox.is_file()], folders=True)
+
+                append_file(shard_folder / "stdout", stdout.buffer)
+
+                if not completed:
+                    executor.shutdown(cancel_futures=True)
+                    break
+        finally:
+            delivery.close()
+            stdout.buffer.flush()
+
+
+def parse_listen_address(value: str) -> tuple:
+    """
+    Parses the value of --listen, either "PORT" or "HOST:PORT", into (host, port).
+    """
 
-            with forward_path.open("a", encoding="utf-8") as f:
-                f.write(email_complete_text)
+    host, _, port = value.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid port: {port}") from None
 
-def detect_debug_mode() -> bool:
+    return host or "127.0.0.1", port
+
+
+def parse_command_line() -> argparse.Namespace:
     """
-    Detects whether debug mode is enabled or not from the command line. Useful for debugging
-    without having to remove numerous print statements once things are working.
+    Reads the options from the command line. "--debug" is useful for debugging without having to
+    remove numerous print statements once things are working.
     """
 
     arg_parser = argparse.ArgumentParser(description="HW2: More Baby-steps Towards the Construction of an SMTP Server")
@@ -1081,65 +4640,364 @@ def detect_debug_mode() -> bool:
         action="store_true",
         help="Enable additional logging that is helpful for debugging without modifying code."
     )
+    arg_parser.add_argument(
+        "--compiled",
+        action="store_true",
+        help="Validate MAIL FROM and RCPT TO lines with the compiled (regex) engine instead of the "
+             "recursive descent parser."
+    )
+    arg_parser.add_argument(
+        "--flush-threshold",
+        type=int,
+        default=ResponseWriter.DEFAULT_FLUSH_THRESHOLD,
+        metavar="CHARS",
+        help="Write output once this many characters are waiting (0 writes every line). Output "
+             "is always written after every line when stdin is a terminal."
+    )
+    arg_parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help="Read stdin as bytes in large chunks. Only command lines are decoded; message text "
+             "goes to the mailbox files as bytes. Ignored in debug mode."
+    )
+    arg_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64 * 1024,
+        metavar="BYTES",
+        help="How many bytes --chunked reads at a time."
+    )
+    arg_parser.add_argument(
+        "--max-open-mailboxes",
+        type=int,
+        default=MailboxDelivery.DEFAULT_MAX_OPEN_FILES,
+        metavar="COUNT",
+        help="How many mailbox files in the forward folder are kept open at most."
+    )
+    arg_parser.add_argument(
+        "--delivery-queue",
+        type=int,
+        default=0,
+        metavar="SIZE",
+        help="Write messages to the mailbox files in a background thread, with up to SIZE "
+             "messages waiting (0, the default, writes them before replying)."
+    )
+    arg_parser.add_argument(
+        "--ack-when",
+        choices=DeliveryQueue.ACK_POLICIES,
+        default=DeliveryQueue.ACK_WHEN_QUEUED,
+        help="With --delivery-queue, when the reply to the final \".\" is sent: once the message "
+             "is queued, or once it has been written to every mailbox."
+    )
+    arg_parser.add_argument(
+        "--mailbox-index",
+        action="store_true",
+        help="Also keep an index of the messages in every mailbox file, in forward/.index, so "
+             "that MailboxReader can get any one of them without reading the others."
+    )
+    arg_parser.add_argument(
+        "--group-commit",
+        type=int,
+        metavar="COUNT",
+        help="Sync the mailbox files to disk (fsync) once per COUNT messages (or see "
+             "--group-commit-delay), and hold back the reply to each final \".\" until its "
+             "message has been synced. Off by default (nothing is synced)."
+    )
+    arg_parser.add_argument(
+        "--group-commit-delay",
+        type=float,
+        default=GroupCommitDelivery.DEFAULT_MAX_DELAY * 1000,
+        metavar="MS",
+        help="With --group-commit, also sync once the oldest waiting message has waited this "
+             "many milliseconds."
+    )
+    arg_parser.add_argument(
+        "--lock-mailboxes",
+        action="store_true",
+        help="Lock the mailbox files of a message's recipients (fcntl.flock) while writing it, so "
+             "that several copies of the program can deliver to the same \"forward\" folder "
+             "at once."
+    )
+    arg_parser.add_argument(
+        "--journal",
+        action="store_true",
+        help="Record every message in a journal in the \"forward\" folder before writing it to "
+             "the mailbox files, so that a message reaches all of its recipients or none even if "
+             "the program dies; the next run finishes what was left unfinished."
+    )
+    arg_parser.add_argument(
+        "--spill-threshold",
+        type=int,
+        default=MessageBuffer.DEFAULT_SPILL_THRESHOLD,
+        metavar="BYTES",
+        help="Keep the text of a message in memory up to this size; larger messages are moved to "
+             "a temporary file and copied from there to the mailbox files."
+    )
+    arg_parser.add_argument(
+        "--max-message-size",
+        type=int,
+        metavar="BYTES",
+        help="Reject messages larger than this (as written to a mailbox file) with a 552 error "
+             "once the final \".\" arrives; the rest of the message is not kept. Unlimited by "
+             "default."
+    )
+    arg_parser.add_argument(
+        "--max-line-length",
+        type=int,
+        metavar="CHARS",
+        help="Reject messages with a line of text longer than this (without the newline) the same "
+             "way, and longer command lines with a 500 error right away. Longer lines are cut "
+             "short while they are read, so only their first CHARS + 1 characters are echoed. "
+             "Unlimited by default."
+    )
+    arg_parser.add_argument(
+        "--max-label-length",
+        type=int,
+        metavar="CHARS",
+        help="Reject addresses (501) with a domain element longer than this, e.g., 63. Unlimited "
+             "by default."
+    )
+    arg_parser.add_argument(
+        "--max-domain-length",
+        type=int,
+        metavar="CHARS",
+        help="Reject addresses (501) with a domain longer than this, e.g., 255. Unlimited by "
+             "default."
+    )
+    arg_parser.add_argument(
+        "--address-cache",
+        type=int,
+        default=AddressCache.DEFAULT_MAX_SIZE,
+        metavar="SIZE",
+        help="Remember what became of the arguments of this many recent MAIL FROM and RCPT TO "
+             "commands, so that repeated addresses are not parsed again (0 turns this off)."
+    )
+    arg_parser.add_argument(
+        "--daemon",
+        type=Path,
+        metavar="SOCKET",
+        help="Instead of reading stdin, keep running and process every transcript that "
+             "smtp_client.py sends to the Unix socket SOCKET, as if it had been piped in."
+    )
+    arg_parser.add_argument(
+        "--batch",
+        type=Path,
+        metavar="PATH",
+        help="Instead of reading stdin, process the transcript at PATH in parallel (see --workers). "
+             "The output and the mailbox files are the same as with \"< PATH\"."
+    )
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        metavar="COUNT",
+        help="How many worker processes --batch uses."
+    )
+    arg_parser.add_argument(
+        "--listen",
+        type=parse_listen_address,
+        metavar="[HOST:]PORT",
+        help="Instead of reading stdin, serve SMTP clients over TCP (HOST defaults to 127.0.0.1). "
+             "Replies go back over each connection; input lines are not echoed."
+    )
+
+    arg_parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="-",
+        metavar="PATH",
+        help="Count calls and time per non-terminal, lines per state, errors, rewinds and bytes "
+             "delivered per mailbox, and write a summary to stderr at exit (or as JSON to PATH)."
+    )
+
     command_line_args = arg_parser.parse_args()
 
-    return command_line_args.debug
+    if command_line_args.batch and command_line_args.debug:
+        arg_parser.error("--batch cannot be combined with --debug")
+
+    if command_line_args.daemon and command_line_args.debug:
+        arg_parser.error("--daemon cannot be combined with --debug")
+
+    if sum(bool(mode) for mode in [command_line_args.batch, command_line_args.listen,
+                                   command_line_args.daemon]) > 1:
+        arg_parser.error("only one of --batch, --listen and --daemon can be used")
+
+    if command_line_args.batch and command_line_args.journal:
+        arg_parser.error("--batch cannot be combined with --journal")
+
+    if command_line_args.workers < 1:
+        arg_parser.error("--workers must be at least 1")
+
+    if command_line_args.spill_threshold < 0:
+        arg_parser.error("--spill-threshold must not be negative")
+
+    if command_line_args.group_commit is not None:
+        if command_line_args.group_commit < 1:
+            arg_parser.error("--group-commit must be at least 1")
+
+        if command_line_args.group_commit_delay < 0:
+            arg_parser.error("--group-commit-delay must not be negative")
+
+        if command_line_args.delivery_queue > 0:
+            arg_parser.error("--group-commit cannot be combined with --delivery-queue")
+
+    if command_line_args.address_cache < 0:
+        arg_parser.error("--address-cache must not be negative")
+
+    for limit in ["max_message_size", "max_line_length", "max_label_length", "max_domain_length"]:
+        if getattr(command_line_args, limit) is not None and getattr(command_line_args, limit) < 0:
+            arg_parser.error(f"--{limit.replace('_', '-')} must not be negative")
+
+    return command_line_args
 
 def main():
     """
     The starting point for the entire script.
     """
 
-    debug_mode = detect_debug_mode()
+    command_line_args = parse_command_line()
+    debug_mode = command_line_args.debug
+    parser_class = CompiledParser if command_line_args.compiled else Parser
+    stats = Statistics() if command_line_args.stats else None
+
+    # SMTPServer keyword arguments that are the same in every mode
+    server_options = {
+        "parser_class": parser_class,
+        "spill_threshold": command_line_args.spill_threshold,
+        "max_message_size": command_line_args.max_message_size,
+        "max_line_length": command_line_args.max_line_length,
+        "max_label_length": command_line_args.max_label_length,
+        "max_domain_length": command_line_args.max_domain_length,
+        "address_cache_size": command_line_args.address_cache,
+    }
 
     if debug_mode:
         print("Debug mode enabled for this script.")
 
-    # Create an SMTPServer object to act as a state machine for processing lines and creating
-    # email messages.
-    server = SMTPServer(debug_mode)
+    # Output is buffered and written out in large pieces. Debug statements are printed directly,
+    # so in debug mode everything is written out right away to keep the output in order.
+    writer = ResponseWriter(
+        flush_threshold=0 if debug_mode else command_line_args.flush_threshold
+    )
 
-    while True:
+    # The journals in a "forward" folder are recovered once, before this program first delivers
+    # to it (with --daemon, that can be long after it started)
+    recovered_folders = set()
+
+    def create_delivery(base_folder: Path = None) -> MailboxDelivery | DeliveryQueue:
+        delivery = MailboxDelivery(max_open_files=command_line_args.max_open_mailboxes,
+                                   base_folder=base_folder, index=command_line_args.mailbox_index,
+                                   locking=command_line_args.lock_mailboxes)
+        if command_line_args.journal:
+            delivery = JournaledDelivery(delivery,
+                                         durable=command_line_args.group_commit is not None)
+
+            folder = delivery.delivery.get_folder_path()
+            if folder not in recovered_folders:
+                recovered_folders.add(folder)
+                recovered = delivery.recover()
+                if recovered:
+                    print(f"Finished {recovered} unfinished deliveries from the journals in "
+                          f"{folder}", file=sys.stderr)
+                for problem in delivery.recovery_problems:
+                    print(problem, file=sys.stderr)
+        if command_line_args.delivery_queue > 0:
+            delivery = DeliveryQueue(delivery, command_line_args.delivery_queue,
+                                     command_line_args.ack_when)
+        if command_line_args.group_commit is not None:
+            delivery = GroupCommitDelivery(delivery, command_line_args.group_commit,
+                                           command_line_args.group_commit_delay / 1000)
+        return delivery
+
+    # Run the transcripts that clients send, each with its own delivery
+    if command_line_args.daemon:
         try:
-            # read one line from standard input
-            # line = input()
-            line = sys.stdin.readline()
-            if not line or line == "":
-                if debug_mode:
-                    print("End-of-life is reached on the input stream. Stopping here.")
-                break
-
-            # Create a Parser object to parse this line
-            parser = Parser(line, debug_mode=debug_mode)
-            # Apparently, print() was printing an extra line
-            sys.stdout.write(line)
-            sys.stdout.flush()
+            asyncio.run(run_daemon(command_line_args.daemon, create_delivery, stats=stats,
+                                   **server_options))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if stats is not None:
+                stats.write_summary(command_line_args.stats)
+        return
+
+    # Process a whole transcript file in parallel instead of reading stdin; every worker process
+    # delivers with its own MailboxDelivery
+    if command_line_args.batch:
+        try:
+            run_batch(command_line_args.batch, command_line_args.workers, stats,
+                      command_line_args.mailbox_index, command_line_args.group_commit is not None,
+                      command_line_args.lock_mailboxes, **server_options)
+        finally:
+            if stats is not None:
+                stats.write_summary(command_line_args.stats)
+        return
+
+    delivery = create_delivery()
+
+    # Serve network clients instead of reading stdin
+    if command_line_args.listen:
+        host, port = command_line_args.listen
+        try:
+            asyncio.run(run_listener(host, port, delivery, stats=stats, **server_options))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            delivery.close()
+            if stats is not None:
+                stats.write_summary(command_line_args.stats)
+        return
 
-            # Pass this parser to the SMTPServer object
-            server.set_parser(parser)
+    # Create an SMTPServer object to act as a state machine for processing lines and creating
+    # email messages.
+    server = SMTPServer(debug_mode, writer=writer, delivery=delivery,
+                        input_encoding=sys.stdin.encoding, input_errors=sys.stdin.errors,
+                        stats=stats, **server_options)
+
+    # Either read one line at a time through the text layer, or read bytes in large chunks and
+    # only decode the command lines. Debug mode always reads text so that its output is unchanged.
+    # A line longer than --max-line-length is cut short while it is read.
+    max_line_length = command_line_args.max_line_length
+    if command_line_args.chunked and not debug_mode:
+        lines = read_chunked_lines(sys.stdin.buffer, command_line_args.chunk_size, max_line_length)
+    elif max_line_length is not None:
+        lines = read_limited_lines(sys.stdin, max_line_length)
+    else:
+        lines = iter(sys.stdin.readline, "")
+
+    try:
+        try:
+            # The state machine handles one line at a time as it is read from standard input;
+            # all that is left to do here is write out the echoed lines and the replies. With
+            # --debug, handle_line() echoes every line before its debug statements are printed.
+            if debug_mode:
+                completed = all(server.handle_line(line) for line in lines)
+            else:
+                completed = all(server.write_record(record) for record in server.process_lines(lines))
 
-            # Based on the current line, evaluate the state of the SMTP server and what should be
-            # done.
-            server.evaluate_state()
+            if completed and debug_mode:
+                print("End-of-life is reached on the input stream. Stopping here.")
 
         except EOFError:
             # Ctrl+D (Unix) or end-of-file from a pipe
-            break
+            pass
         except KeyboardInterrupt:
             # Ctrl+C
-            break
-        except ParserError as pe:
-            # All errors that should be handled according to the writeup are handled as ParserError
-            # objects. All other exceptions are ValueError or some other type. If a ParserError
-            # occurrs, the write up says "upon receipt of any erroneous SMTP message you should
-            # reset your state machine and return to the state of waiting for a valid MAIL FROM
-            # message".
-            print(pe)
-            server.reset()
-            continue
+            pass
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            break
+            # Reading the input failed
+            writer.reply(f"An unexpected error occurred: {e}")
+    finally:
+        # End of input (or an unexpected error); close the mailbox files and write out whatever is
+        # still waiting. Messages that are delivered in the background can still fail here.
+        try:
+            server.close()
+        except Exception as e:
+            writer.reply(f"An unexpected error occurred: {e}")
+        writer.flush()
+
+        if stats is not None:
+            stats.write_summary(command_line_args.stats)
 
 if __name__ == "__main__":
     main()
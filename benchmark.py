@@ -0,0 +1,1420 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for SMTP1.py. These are not part of the assignment; they exist to measure how fast the
+parser and the SMTP server are, and to compare one version of SMTP1.py against another.
+
+By default, SMTP1.py from this folder is measured. Use --module to measure a different copy, e.g.,
+the version from the previous commit:
+
+```bash
+git show HEAD~1:SMTP1.py > /tmp/SMTP1_before.py
+python3 ./benchmark.py --module /tmp/SMTP1_before.py recognition
+python3 ./benchmark.py recognition
+```
+
+The nonterminals and end_to_end benchmarks run on a synthetic transcript (see
+generate_transcript()); its shape is set with --messages, --recipients, --body-size,
+--line-length and the --error-* rates. Use --save to append the results to a JSON Lines file,
+together with the commit they were measured on, and --compare to print how much faster or slower
+every result is than the last one saved for it:
+
+```bash
+python3 ./benchmark.py --save results.jsonl end_to_end
+# ... change SMTP1.py ...
+python3 ./benchmark.py --compare results.jsonl end_to_end
+```
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import gc
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+ENVELOPE_LINES = [
+    "MAIL FROM:<jeffay@cs.unc.edu>\n",
+    "RCPT TO:<alice@cs.unc.edu>\n",
+    "RCPT TO: <bob_the-builder99@department.cs.unc.edu>\n",
+    "DATA\n",
+    "MAIL\tFROM:\t<sender@test.com>  \n",
+    "RCPT TO:<recipient_with_a_much_longer_local_part@mail.example.org>\n",
+]
+"""
+A small mix of valid envelope lines used by the command recognition benchmark.
+"""
+
+BODY_TEXT = "The quick brown fox jumps over the lazy dog.\tPack my box with five dozen liquor jugs! "
+"""
+The text that the lines of generated message bodies are cut from.
+"""
+
+ERROR_LINES = {
+    500: ["HELO cs.unc.edu\n", "MAIL\n", "QUIT\n"],
+    501: ["MAIL FROM:<jeffay@cs.unc.edu\n", "MAIL FROM: jeffay@cs.unc.edu\n", "MAIL FROM:<@unc.edu>\n"],
+    503: ["RCPT TO:<alice@cs.unc.edu>\n", "DATA\n"],
+}
+"""
+Lines that cause each kind of error when the server is expecting a MAIL FROM command. Every
+error resets the state machine, so they can be put between any two messages.
+"""
+
+RESULTS = []
+"""
+Every result reported by the benchmarks that ran, for --save and --compare.
+"""
+
+
+def load_smtp_module(module_path: Path):
+    """
+    Imports a copy of SMTP1.py from an arbitrary path so that two versions can be compared.
+    """
+
+    spec = importlib.util.spec_from_file_location("smtp_under_test", module_path)
+    if spec is None or spec.loader is None:
+        raise ValueError(f"load_smtp_module(); cannot import {module_path}")
+
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def report(name: str, count: int, elapsed: float, unit: str = "line"):
+    """
+    Prints one line of benchmark results.
+    """
+
+    per_item = elapsed / count * 1_000_000 if count else 0.0
+    rate = count / elapsed if elapsed else 0.0
+    print(f"{name:<40} {per_item:10.2f} us/{unit} {rate:14,.0f} {unit}s/sec")
+    RESULTS.append({"name": name, "count": count, "seconds": elapsed, f"{unit}s/sec": rate})
+
+
+def report_metric(value: float, label: str, spec: str = "10.2f"):
+    """
+    Prints one more number for the result that was reported last, e.g., its MB/sec.
+    """
+
+    print(f"{'':<40} {value:{spec}} {label}")
+    RESULTS[-1][label] = value
+
+
+def generate_addresses(options: argparse.Namespace) -> list:
+    """
+    Returns the options.mailboxes addresses that generated transcripts use.
+    """
+
+    return [f"user{number}@mail{number % 10}.example.org" for number in range(options.mailboxes)]
+
+
+def generate_transcript(options: argparse.Namespace) -> list:
+    """
+    Builds a synthetic transcript (a list of lines) from the command-line options:
+
+    - options.messages email messages, each to options.recipients of options.mailboxes mailboxes
+    - a body of about options.body_size characters, in lines of up to options.line_length
+      characters (including the line terminator)
+    - before each message, with the probabilities options.error_500, options.error_501 and
+      options.error_503, one line that causes that error
+
+    The same options (and options.seed) always produce the same transcript.
+    """
+
+    generator = random.Random(options.seed)
+    addresses = generate_addresses(options)
+    text_width = max(options.line_length - 1, 1)
+    body_text = BODY_TEXT * (text_width // len(BODY_TEXT) + 1)
+
+    lines = []
+    for _ in range(options.messages):
+        for error_no, rate in [(500, options.error_500), (501, options.error_501),
+                               (503, options.error_503)]:
+            if generator.random() < rate:
+                lines.append(generator.choice(ERROR_LINES[error_no]))
+
+        lines.append(f"MAIL FROM:<{generator.choice(addresses)}>\n")
+        for address in generator.sample(addresses, min(options.recipients, len(addresses))):
+            lines.append(f"RCPT TO: <{address}>\n")
+        lines.append("DATA\n")
+
+        remaining = options.body_size
+        while remaining > 0:
+            start = generator.randrange(len(BODY_TEXT))
+            width = min(text_width, remaining)
+            lines.append(body_text[start:start + width] + "\n")
+            remaining -= width + 1
+        lines.append(".\n")
+
+    return lines
+
+
+def transcript_size(lines: list) -> float:
+    """
+    Returns the size of a transcript in MB.
+    """
+
+    return sum(len(line) for line in lines) / 1_000_000
+
+
+def bench_recognition(smtp, options: argparse.Namespace):
+    """
+    Measures the per-line cost of recognizing an envelope command with check_for_commands() and
+    then fully parsing it, which is what the exception-based SMTPServer.evaluate_state() does for
+    every line (the program itself goes through evaluate_line() and Parser.parse_command()).
+    """
+
+    parser_methods = {
+        "MAIL FROM": "mail_from_cmd",
+        "RCPT TO": "rcpt_to_cmd",
+        "DATA": "data_cmd",
+    }
+
+    for parser_class_name in ["Parser", "CompiledParser"]:
+        parser_class = getattr(smtp, parser_class_name, None)
+        if parser_class is None:
+            continue
+
+        # The success messages are printed by the parser, so throw them away while timing
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for _ in range(options.repeat):
+                for line in ENVELOPE_LINES:
+                    parser = parser_class(line)
+                    parser.check_for_commands()
+                    getattr(parser, parser_methods[parser.get_command_name()])()
+            elapsed = time.perf_counter() - start
+
+        report(f"recognition ({parser_class_name})", options.repeat * len(ENVELOPE_LINES), elapsed)
+
+
+def bench_local_part(smtp, options: argparse.Namespace):
+    """
+    Measures <local-part> on a 64-character local part, the longest one allowed by RFC 5321.
+    """
+
+    line = "x" * 64 + "@cs.unc.edu>\n"
+
+    start = time.perf_counter()
+    for _ in range(options.repeat):
+        smtp.Parser(line).local_part()
+    elapsed = time.perf_counter() - start
+
+    report("local_part (64 characters)", options.repeat, elapsed, unit="call")
+
+
+def bench_message_body(smtp, options: argparse.Namespace):
+    """
+    Measures how fast lines of a message body are handled in the EXPECTING_DATA_END state, in
+    MB/sec of body text. Each repetition is one 78-character line. Copies of SMTP1.py with
+    SMTPServer.process_line() go through it, like the program does (evaluate_line()); older ones
+    get a new Parser and evaluate_state() for every line.
+    """
+
+    line = "The quick brown fox jumps over the lazy dog.\tPack my box with five dozen jugs!!\n"
+    server = smtp.SMTPServer()
+    process_line = getattr(server, "process_line", None)
+
+    start = time.perf_counter()
+    for count in range(options.repeat):
+        server.state = server.EXPECTING_DATA_END
+        if process_line is not None:
+            process_line(line)
+        else:
+            server.set_parser(smtp.Parser(line))
+            server.evaluate_state()
+
+        # Do not let the body grow without limits while measuring
+        if count % 10_000 == 0:
+            server.reset()
+    elapsed = time.perf_counter() - start
+
+    megabytes = options.repeat * len(line) / 1_000_000
+    report("message body", options.repeat, elapsed)
+    report_metric(megabytes / elapsed, "MB/sec")
+
+
+def bench_deep_domain(smtp, options: argparse.Namespace):
+    """
+    Adversarial input for <domain>: RCPT TO lines whose domain has more and more elements
+    ("a.a.a...."), both valid and with a period at the end, which fails only after the last
+    element. The cost per element should stay the same as the domain grows; copies of SMTP1.py
+    with a recursive domain() run out of stack instead.
+    """
+
+    for parser_class_name in ["Parser", "CompiledParser"]:
+        parser_class = getattr(smtp, parser_class_name, None)
+        if parser_class is None:
+            continue
+
+        for label_count in [10, 100, 1_000, 10_000]:
+            for kind, ending in [("valid", ">\n"), ("invalid", ".>\n")]:
+                line = "RCPT TO:<bob@" + "a." * (label_count - 1) + "a" + ending
+                repeat = max(options.repeat // label_count, 1)
+                engine = parser_class_name.replace("Parser", "") or "Parser"
+                name = f"deep_domain ({engine}, {label_count:,}, {kind})"
+
+                with open(os.devnull, "w", encoding="utf-8") as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    try:
+                        for _ in range(repeat):
+                            parser = parser_class(line)
+                            parser.check_for_commands()
+                            try:
+                                parser.rcpt_to_cmd()
+                            except smtp.ParserError:
+                                pass
+                    except RecursionError:
+                        elapsed = None
+                    else:
+                        elapsed = time.perf_counter() - start
+
+                if elapsed is None:
+                    print(f"{name:<40} RecursionError")
+                    continue
+
+                report(name, repeat * label_count, elapsed, unit="element")
+
+
+def generate_zipf_envelope(options: argparse.Namespace, address_count: int, exponent: float) -> list:
+    """
+    Returns options.repeat MAIL FROM and RCPT TO lines whose addresses are drawn from
+    address_count addresses with a Zipf-like distribution: the k-th most common address comes up
+    about 1 / k ** exponent as often as the most common one.
+    """
+
+    generator = random.Random(options.seed)
+    addresses = [f"user{number}@mail{number % 10}.example.org" for number in range(address_count)]
+    weights = [1 / rank ** exponent for rank in range(1, address_count + 1)]
+    chosen = generator.choices(addresses, weights, k=options.repeat)
+
+    return [
+        f"MAIL FROM:<{address}>\n" if number % 4 == 0 else f"RCPT TO: <{address}>\n"
+        for number, address in enumerate(chosen)
+    ]
+
+
+def bench_address_cache(smtp, options: argparse.Namespace):
+    """
+    Measures Parser.parse_command() on envelope lines with a skewed (Zipf-like) distribution of
+    addresses, with and without an AddressCache of the default size, and reports how many of the
+    lookups were hits.
+    """
+
+    if not hasattr(smtp, "AddressCache"):
+        print("address_cache: this copy of SMTP1.py has no AddressCache")
+        return
+
+    expected_commands = ("MAIL FROM", "RCPT TO")
+
+    for address_count, exponent in [(options.mailboxes * 100, 1.1), (options.mailboxes * 100, 0.8)]:
+        lines = generate_zipf_envelope(options, address_count, exponent)
+
+        # CompiledParser does not use the cache; it is measured as the reference
+        for parser_class_name, cached in [("Parser", False), ("Parser", True),
+                                          ("CompiledParser", False)]:
+            cache = smtp.AddressCache() if cached else None
+            parser = getattr(smtp, parser_class_name)(address_cache=cache)
+
+            start = time.perf_counter()
+            for line in lines:
+                parser.load(line)
+                parser.parse_command(expected_commands)
+            elapsed = time.perf_counter() - start
+
+            label = "cached" if cached else "uncached"
+            report(f"address_cache ({parser_class_name}, {label}, {address_count} addresses, "
+                   f"s={exponent})", len(lines), elapsed)
+            if cached:
+                report_metric(100 * cache.hits / (cache.hits + cache.misses), "% hits", "10.1f")
+
+
+def make_transcript(line_count: int) -> list:
+    """
+    Builds a transcript of line_count lines by repeating one small, valid email message.
+    """
+
+    message = [
+        "MAIL FROM:<jeffay@cs.unc.edu>\n",
+        "RCPT TO:<alice@cs.unc.edu>\n",
+        "RCPT TO:<bob@cs.unc.edu>\n",
+        "DATA\n",
+        "Hey Bob, do you really think we should use SMTP as a class\n",
+        "project in COMP 431 this year?\n",
+        ".\n",
+    ]
+
+    return [message[count % len(message)] for count in range(line_count)]
+
+
+def bench_allocation(smtp, options: argparse.Namespace):
+    """
+    Runs options.lines lines through the SMTPServer under tracemalloc and reports the peak traced
+    memory, the number of generation 0 garbage collections and the size of a Parser object. Each
+    line goes through SMTPServer.process_line() (set_line() and evaluate_line()), the way main()
+    handles it. Older copies of SMTP1.py use set_line() and evaluate_state(), or a new Parser per
+    line without set_line(). Delivery is skipped so that only parsing is measured.
+    """
+
+    transcript = make_transcript(options.lines)
+    server = smtp.SMTPServer()
+    server.process_email_message = lambda: None
+    reuse_parser = hasattr(server, "set_line")
+    process_line = getattr(server, "process_line", None)
+
+    gc.collect()
+    collections_before = gc.get_stats()[0]["collections"]
+    tracemalloc.start()
+
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for line in transcript:
+            if process_line is not None:
+                process_line(line)
+                continue
+
+            if reuse_parser:
+                server.set_line(line)
+            else:
+                server.set_parser(smtp.Parser(line))
+            server.evaluate_state()
+        elapsed = time.perf_counter() - start
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    collections = gc.get_stats()[0]["collections"] - collections_before
+
+    # Parsers without __slots__ also carry a per-instance __dict__
+    parser = smtp.Parser("MAIL FROM:<jeffay@cs.unc.edu>\n")
+    parser_size = sys.getsizeof(parser)
+    if hasattr(parser, "__dict__"):
+        parser_size += sys.getsizeof(parser.__dict__)
+
+    report(f"allocation ({'reused' if reuse_parser else 'new'} Parser)", len(transcript), elapsed)
+    report_metric(peak / 1024, "KiB peak traced memory", "10.1f")
+    report_metric(collections, "generation 0 collections", "10,")
+    report_metric(parser_size, "bytes per Parser object", "10,")
+
+
+def run_deliveries(smtp, mailbox_count: int, message_count: int, recipients: int) -> float:
+    """
+    Delivers message_count messages, each to `recipients` of mailbox_count mailboxes, in a
+    temporary folder and returns how long that took.
+    """
+
+    addresses = [f"user{number}@cs.unc.edu" for number in range(mailbox_count)]
+    message_text = ["From: <jeffay@cs.unc.edu>", "To: <alice@cs.unc.edu>", "x" * 70] * 5
+
+    with tempfile.TemporaryDirectory() as folder:
+        current_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            server = smtp.SMTPServer()
+            start = time.perf_counter()
+            for number in range(message_count):
+                server.to_email_addresses = [
+                    addresses[(number + offset) % mailbox_count] for offset in range(recipients)
+                ]
+                for line in message_text:
+                    server.add_text_to_email_body(line)
+                server.process_email_message()
+                server.reset()
+            # Copies of SMTP1.py without the mailbox cache have nothing to close
+            if hasattr(server, "close"):
+                server.close()
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(current_folder)
+
+    return elapsed
+
+
+def bench_delivery(smtp, options: argparse.Namespace):
+    """
+    Measures process_email_message() when a few mailboxes receive every message (hot) and when
+    the messages are spread over many more mailboxes than can be kept open (many).
+    """
+
+    message_count = max(options.repeat // 10, 1)
+    workloads = [
+        ("delivery (3 hot mailboxes)", 3, 2),
+        ("delivery (1,000 mailboxes)", 1000, 2),
+    ]
+
+    for name, mailbox_count, recipients in workloads:
+        elapsed = run_deliveries(smtp, mailbox_count, message_count, recipients)
+        report(name, message_count, elapsed, unit="message")
+
+
+def bench_mailbox_index(smtp, options: argparse.Namespace):
+    """
+    Delivers options.messages messages to one mailbox, with and without an index, and then gets
+    randomly chosen messages from it with MailboxReader. Without an index, the only way to get
+    one message is to read the whole mailbox, which is measured for comparison.
+    """
+
+    if not hasattr(smtp, "MailboxReader"):
+        print("mailbox_index: this copy of SMTP1.py has no MailboxReader")
+        return
+
+    address = "alice@cs.unc.edu"
+    generator = random.Random(options.seed)
+    body = [BODY_TEXT] * max(options.body_size // len(BODY_TEXT), 1)
+    lookups = max(options.repeat // 10, 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for index in [False, True]:
+            delivery = smtp.MailboxDelivery(base_folder=Path(folder) / str(index), index=index)
+            delivery.base_folder.mkdir()
+
+            start = time.perf_counter()
+            for number in range(options.messages):
+                message = smtp.MessageBuffer()
+                for line in [f"From: <user{number}@cs.unc.edu>", f"To: <{address}>", *body]:
+                    message.append_line(line.encode("ascii"))
+                delivery.deliver([address], message)
+            delivery.close()
+            elapsed = time.perf_counter() - start
+
+            report(f"mailbox_index (delivery, index={index})", options.messages, elapsed,
+                   unit="message")
+
+        forward_folder = Path(folder) / "True" / "forward"
+        numbers = [generator.randrange(options.messages) for _ in range(lookups)]
+
+        with smtp.MailboxReader(address, forward_folder) as reader:
+            start = time.perf_counter()
+            for number in numbers:
+                reader.get_message(number)
+            report("mailbox_index (get_message)", lookups, time.perf_counter() - start,
+                   unit="lookup")
+
+        mailbox_path = forward_folder / address
+        lookups = max(lookups // 100, 1)
+        start = time.perf_counter()
+        for _ in range(lookups):
+            mailbox_path.read_bytes()
+        report("mailbox_index (reading the mailbox)", lookups, time.perf_counter() - start,
+               unit="lookup")
+
+
+def run_group_commit(smtp, transcript: list, batch_size: int | None) -> tuple:
+    """
+    Runs a transcript through SMTPServer.handle_line() in a temporary folder, delivering with a
+    GroupCommitDelivery of batch_size (or a plain MailboxDelivery, without any syncing, if it is
+    None). Returns (elapsed seconds, messages, list of how long each message waited to be
+    synced).
+    """
+
+    waits = []
+    delivered_at = []
+
+    class TimedGroupCommit(smtp.GroupCommitDelivery):
+        def deliver(self, email_addresses, message):
+            delivered_at.append(time.perf_counter())
+            super().deliver(email_addresses, message)
+
+        def sync(self):
+            super().sync()
+            now = time.perf_counter()
+            waits.extend(now - start for start in delivered_at)
+            delivered_at.clear()
+
+    with tempfile.TemporaryDirectory() as folder, \
+            open(os.devnull, "w", encoding="utf-8") as devnull:
+        # Only the batch size decides when to sync, not the output or the delay
+        writer = smtp.ResponseWriter(devnull, interactive=False, flush_threshold=1 << 40)
+        delivery = smtp.MailboxDelivery(base_folder=Path(folder))
+        if batch_size is not None:
+            delivery = TimedGroupCommit(delivery, batch_size, max_delay=3600)
+        server = smtp.SMTPServer(writer=writer, delivery=delivery)
+
+        start = time.perf_counter()
+        for line in transcript:
+            server.handle_line(line)
+        server.close()
+        writer.flush()
+        elapsed = time.perf_counter() - start
+
+    return elapsed, transcript.count(".\n"), waits
+
+
+def bench_group_commit(smtp, options: argparse.Namespace):
+    """
+    Shows the tradeoff of --group-commit: messages/sec and how long a message waits to be synced
+    (its reply is held back that long) for different batch sizes, compared with not syncing at
+    all. Uses a generated transcript with a tenth of options.messages.
+    """
+
+    if not hasattr(smtp, "GroupCommitDelivery"):
+        print("group_commit: this copy of SMTP1.py has no GroupCommitDelivery")
+        return
+
+    transcript = generate_transcript(argparse.Namespace(
+        **{**vars(options), "messages": max(options.messages // 10, 1)}
+    ))
+
+    for batch_size in [None, 1, 4, 16, 64, 256]:
+        elapsed, messages, waits = run_group_commit(smtp, transcript, batch_size)
+        name = "no fsync" if batch_size is None else f"batch of {batch_size}"
+        report(f"group_commit ({name})", messages, elapsed, unit="message")
+
+        if waits:
+            waits.sort()
+            for label, fraction in [("p50", 0.50), ("p99", 0.99)]:
+                report_metric(percentile(waits, fraction) * 1000, f"ms {label} wait for fsync")
+
+
+def bench_journal(smtp, options: argparse.Namespace):
+    """
+    Delivers options.messages messages to three mailboxes each, with and without --journal, and
+    then measures recovery: the journal of a program that "died" (its lock is released without
+    removing it) after writing its last message is finished by JournaledDelivery.recover(). The
+    last message is never marked as delivered, since its mark goes out with the next entry.
+    """
+
+    if not hasattr(smtp, "JournaledDelivery"):
+        print("journal: this copy of SMTP1.py has no JournaledDelivery")
+        return
+
+    body = [BODY_TEXT] * max(options.body_size // len(BODY_TEXT), 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for journal in [False, True]:
+            base_folder = Path(folder) / str(journal)
+            base_folder.mkdir()
+            delivery = smtp.MailboxDelivery(base_folder=base_folder)
+            if journal:
+                delivery = smtp.JournaledDelivery(delivery)
+
+            start = time.perf_counter()
+            for number in range(options.messages):
+                addresses = [f"user{(number + offset) % 10}@cs.unc.edu" for offset in range(3)]
+                message = smtp.MessageBuffer()
+                for line in [f"From: <user{number}@cs.unc.edu>", *body]:
+                    message.append_line(line.encode("ascii"))
+                delivery.deliver(addresses, message)
+            elapsed = time.perf_counter() - start
+
+            report(f"journal (delivery, journal={journal})", options.messages, elapsed,
+                   unit="message")
+
+        # Leave the journal behind as if the program had died
+        journal_size = delivery.journal.tell()
+        delivery.delivery.close()
+        delivery.journal.close()
+
+        recovery = smtp.JournaledDelivery(smtp.MailboxDelivery(base_folder=base_folder))
+        start = time.perf_counter()
+        recovered = recovery.recover()
+        elapsed = time.perf_counter() - start
+        recovery.close()
+
+        report("journal (recovery)", 1, elapsed, unit="run")
+        report_metric(journal_size / 1024, "KiB of journal read")
+        report_metric(recovered, "messages finished", "10d")
+
+
+def plan_contention(writer: int, message_count: int, mailbox_count: int, seed: int) -> list:
+    """
+    Returns the recipients of every message that a writer process of the contention benchmark
+    delivers, as lists of addresses. The same arguments always give the same plan, so that the
+    corruption checker knows what every mailbox should contain.
+    """
+
+    generator = random.Random(seed * 1000 + writer)
+    addresses = [f"user{number}@cs.unc.edu" for number in range(mailbox_count)]
+    return [generator.sample(addresses, generator.randint(1, min(3, mailbox_count)))
+            for _ in range(message_count)]
+
+
+def contention_message(writer: int, number: int, line_count: int) -> list:
+    """
+    Returns the lines (without newlines) of a message of the contention benchmark. Every line
+    says which message it belongs to, so that check_mailboxes() can tell if messages were mixed.
+    """
+
+    filler = BODY_TEXT[:60]
+    return [f"X-Message: {writer} {number} {line_count}",
+            *[f"{writer}:{number}:{line}:{filler}" for line in range(line_count)]]
+
+
+def run_contention_writer(smtp, folder: Path, writer: int, plan: list, line_count: int,
+                          locking: bool, journal: bool, start_barrier):
+    """
+    Runs in a writer process of the contention benchmark: delivers the messages of plan to the
+    shared folder (with a JournaledDelivery if journal is True) as soon as every writer is ready.
+    """
+
+    # Every message is copied to the mailbox files in several writes, like one over 1 MiB would be
+    smtp.MessageBuffer.COPY_SIZE = 4096
+    delivery = smtp.MailboxDelivery(base_folder=folder, index=True, locking=locking)
+    if journal:
+        delivery = smtp.JournaledDelivery(delivery)
+
+    start_barrier.wait()
+    for number, email_addresses in enumerate(plan):
+        message = smtp.MessageBuffer(spill_threshold=0)
+        for line in contention_message(writer, number, line_count):
+            message.append_line(line.encode("ascii"))
+        delivery.deliver(email_addresses, message)
+    delivery.close()
+
+
+def check_mailboxes(smtp, forward_folder: Path, expected: dict, line_count: int) -> list:
+    """
+    The corruption checker of the contention benchmark. expected maps every address to the
+    messages, as (writer, number), that its mailbox should contain. Returns a description of
+    every problem found:
+
+    - a message whose lines are missing, mixed with another message's, or out of order
+    - a message that is missing or there more than once
+    - an index record that does not point at the message it should
+    - two messages that are in the same two mailboxes, but in a different order
+    """
+
+    problems = []
+    orders = {}
+
+    for address, expected_messages in expected.items():
+        lines = (forward_folder / address).read_bytes().splitlines(keepends=True)
+        found = []
+        spans = []
+        offset = 0
+        position = 0
+
+        while position < len(lines):
+            start, start_offset = position, offset
+            header = lines[position].decode("ascii", "replace").split()
+            position += 1
+            offset += len(lines[start])
+
+            if len(header) != 4 or header[0] != "X-Message:":
+                problems.append(f"{address}: stray line {start + 1}")
+                continue
+
+            writer, number = int(header[1]), int(header[2])
+            intact = int(header[3]) == line_count
+            for line in range(line_count):
+                prefix = f"{writer}:{number}:{line}:".encode("ascii")
+                if position >= len(lines) or not lines[position].startswith(prefix):
+                    intact = False
+                    break
+                offset += len(lines[position])
+                position += 1
+
+            if intact:
+                found.append((writer, number))
+                spans.append((start_offset, offset - start_offset))
+            else:
+                problems.append(f"{address}: message {writer}:{number} at line {start + 1} is "
+                                "damaged")
+
+        counts = collections.Counter(found)
+        for message in expected_messages:
+            if counts[message] != 1:
+                problems.append(f"{address}: message {message[0]}:{message[1]} is there "
+                                f"{counts[message]} times")
+
+        with smtp.MailboxReader(address, forward_folder) as reader:
+            records = [reader.get_record(number)[:2] for number in range(len(reader))]
+        if records != spans:
+            problems.append(f"{address}: the index does not match the messages")
+
+        orders[address] = found
+
+    addresses = sorted(orders)
+    for first_number, first in enumerate(addresses):
+        for second in addresses[first_number + 1:]:
+            shared = set(orders[first]) & set(orders[second])
+            if [message for message in orders[first] if message in shared] != \
+                    [message for message in orders[second] if message in shared]:
+                problems.append(f"{first} and {second}: shared messages in a different order")
+
+    return problems
+
+
+def bench_contention(smtp, options: argparse.Namespace):
+    """
+    Starts several writer processes that deliver to the same "forward" folder at once, without
+    locking, with --lock-mailboxes and with --lock-mailboxes --journal, and then checks the
+    mailboxes with check_mailboxes(). Each writer delivers a tenth of options.messages messages
+    of about options.body_size characters to one to three of ten mailboxes; the benchmark runs
+    with 2, 4 and 8 writers.
+    """
+
+    if not hasattr(smtp.MailboxDelivery, "lock_mailboxes"):
+        print("contention: this copy of SMTP1.py has no mailbox locking")
+        return
+
+    context = multiprocessing.get_context("fork")
+    message_count = max(options.messages // 10, 1)
+    mailbox_count = 10
+    line_count = max(options.body_size // (len(BODY_TEXT[:60]) + 12), 1)
+
+    for writer_count in [2, 4, 8]:
+        plans = [plan_contention(writer, message_count, mailbox_count, options.seed)
+                 for writer in range(writer_count)]
+        expected = collections.defaultdict(list)
+        for writer, plan in enumerate(plans):
+            for number, email_addresses in enumerate(plan):
+                for address in email_addresses:
+                    expected[address].append((writer, number))
+
+        for locking, journal in [(False, False), (True, False), (True, True)]:
+            with tempfile.TemporaryDirectory() as folder:
+                start_barrier = context.Barrier(writer_count + 1)
+                writers = [
+                    context.Process(target=run_contention_writer,
+                                    args=(smtp, Path(folder), writer, plan, line_count, locking,
+                                          journal, start_barrier))
+                    for writer, plan in enumerate(plans)
+                ]
+                for process in writers:
+                    process.start()
+
+                start_barrier.wait()
+                start = time.perf_counter()
+                for process in writers:
+                    process.join()
+                elapsed = time.perf_counter() - start
+
+                if any(process.exitcode != 0 for process in writers):
+                    raise RuntimeError("a writer process of the contention benchmark failed")
+
+                problems = check_mailboxes(smtp, Path(folder) / "forward", expected, line_count)
+
+            mode = "journal" if journal else f"locking={locking}"
+            report(f"contention ({writer_count} writers, {mode})",
+                   writer_count * message_count, elapsed, unit="message")
+            report_metric(len(problems), "problems found by the corruption checker", "10d")
+            for problem in problems[:3]:
+                print(f"{'':<40} {problem}")
+
+
+def bench_nonterminals(smtp, options: argparse.Namespace):
+    """
+    Measures the Parser non-terminals one at a time, on the addresses and body lines of a
+    generated transcript. Each call starts on input that the non-terminal accepts.
+    """
+
+    options = argparse.Namespace(**{**vars(options), "error_500": 0.0, "error_501": 0.0,
+                                    "error_503": 0.0})
+    transcript = generate_transcript(options)
+    addresses = generate_addresses(options)
+    body_lines = [line for line in transcript if not line.startswith(("MAIL", "RCPT", "DATA", "."))]
+    if not body_lines:
+        body_lines = ["\n"]
+
+    # (name, input lines, whether check_for_commands() runs first)
+    workloads = [
+        ("mail_from_cmd", [f"MAIL FROM:<{address}>\n" for address in addresses], True),
+        ("rcpt_to_cmd", [f"RCPT TO: <{address}>\n" for address in addresses], True),
+        ("data_cmd", ["DATA\n"], True),
+        ("is_path", [f"<{address}>\n" for address in addresses], False),
+        ("mailbox", [f"{address}>\n" for address in addresses], False),
+        ("local_part", [f"{address}>\n" for address in addresses], False),
+        ("domain", [f"{address.split('@')[1]}>\n" for address in addresses], False),
+        ("data_read_msg_line", body_lines, False),
+        ("data_end_cmd", [".\n"], False),
+    ]
+
+    parser = smtp.Parser("")
+    # Copies of SMTP1.py without Parser.load() get a new Parser per call
+    load = getattr(parser, "load", None)
+
+    for name, lines, identify_command in workloads:
+        calls = [lines[count % len(lines)] for count in range(options.repeat)]
+
+        # Some non-terminals print their success message, so throw those away while timing
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for line in calls:
+                if load is not None:
+                    load(line)
+                else:
+                    parser = smtp.Parser(line)
+                if identify_command:
+                    parser.check_for_commands()
+                getattr(parser, name)()
+            elapsed = time.perf_counter() - start
+
+        report(f"nonterminal {name}", len(calls), elapsed, unit="call")
+
+
+def run_transcript(smtp, transcript: list, deliver: bool) -> float:
+    """
+    Runs every line of a transcript through SMTPServer.handle_line() in a temporary folder, with
+    the output going to /dev/null, and returns how long that took. If deliver is False, the
+    messages are not written to mailbox files.
+    """
+
+    with tempfile.TemporaryDirectory() as folder, \
+            open(os.devnull, "w", encoding="utf-8") as devnull:
+        current_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            writer = smtp.ResponseWriter(devnull, interactive=False)
+            server = smtp.SMTPServer(writer=writer)
+            if not deliver:
+                server.process_email_message = lambda: None
+
+            start = time.perf_counter()
+            for line in transcript:
+                if not server.handle_line(line):
+                    raise RuntimeError(f"unexpected error on line: {line!r}")
+            server.close()
+            writer.flush()
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(current_folder)
+
+    return elapsed
+
+
+def bench_end_to_end(smtp, options: argparse.Namespace):
+    """
+    Runs a generated transcript through SMTPServer.handle_line(), which echoes every line and
+    handles it with process_line() (evaluate_line(), like the program): once without writing the
+    messages to the mailboxes, and once with process_email_message() writing them. Reports
+    lines/sec, MB/sec of input and the peak traced memory (from a separate run under tracemalloc,
+    which would slow down the timed one).
+    """
+
+    if not hasattr(smtp.SMTPServer, "handle_line"):
+        print("end_to_end: this copy of SMTP1.py has no SMTPServer.handle_line()")
+        return
+
+    transcript = generate_transcript(options)
+    megabytes = transcript_size(transcript)
+
+    for name, deliver in [("end_to_end (parsing only)", False), ("end_to_end (with delivery)", True)]:
+        elapsed = run_transcript(smtp, transcript, deliver)
+
+        tracemalloc.start()
+        run_transcript(smtp, transcript, deliver)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        report(name, len(transcript), elapsed)
+        report_metric(megabytes / elapsed, "MB/sec")
+        report_metric(peak / 1024, "KiB peak traced memory", "10.1f")
+
+
+def bench_process_lines(smtp, options: argparse.Namespace):
+    """
+    Runs a generated transcript through the SMTPServer.process_lines() generator, which only
+    yields records, and compares that with handle_line(), which also writes every echoed line and
+    reply to a ResponseWriter (going to /dev/null). Messages are not written to the mailboxes.
+    """
+
+    if not hasattr(smtp.SMTPServer, "process_lines"):
+        print("process_lines: this copy of SMTP1.py has no SMTPServer.process_lines()")
+        return
+
+    transcript = generate_transcript(options)
+
+    server = smtp.SMTPServer()
+    server.process_email_message = lambda: None
+    start = time.perf_counter()
+    collections.deque(server.process_lines(transcript), maxlen=0)
+    report("process_lines (records only)", len(transcript), time.perf_counter() - start)
+
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        writer = smtp.ResponseWriter(devnull, interactive=False)
+        server = smtp.SMTPServer(writer=writer)
+        server.process_email_message = lambda: None
+        start = time.perf_counter()
+        for line in transcript:
+            server.handle_line(line)
+        writer.flush()
+        report("process_lines (handle_line)", len(transcript), time.perf_counter() - start)
+
+
+def run_error_heavy(smtp, server, transcript: list, use_results: bool) -> float:
+    """
+    Handles every line of a transcript the way handle_line() does, either with the exception-free
+    evaluate_line() or with evaluate_state() (catching ParserError), and returns how long that
+    took.
+    """
+
+    writer = server.writer
+
+    start = time.perf_counter()
+    for line in transcript:
+        writer.echo(line)
+        server.set_line(line)
+
+        if use_results:
+            result = server.evaluate_line()
+            if result.code:
+                writer.reply(result.reply())
+            continue
+
+        try:
+            server.evaluate_state()
+        except smtp.ParserError as pe:
+            writer.reply(str(pe))
+            server.reset()
+    writer.flush()
+
+    return time.perf_counter() - start
+
+
+def bench_error_heavy(smtp, options: argparse.Namespace):
+    """
+    Compares the exception-based evaluate_state() with the result-based evaluate_line() on a
+    generated transcript in which most messages are preceded by erroneous lines (at least a 50%
+    chance of each of 500, 501 and 503, or the --error-* rates if they are higher). Messages are
+    not written to the mailboxes.
+    """
+
+    if not hasattr(smtp.SMTPServer, "evaluate_line"):
+        print("error_heavy: this copy of SMTP1.py has no SMTPServer.evaluate_line()")
+        return
+
+    options = argparse.Namespace(**{
+        **vars(options),
+        "error_500": max(options.error_500, 0.5),
+        "error_501": max(options.error_501, 0.5),
+        "error_503": max(options.error_503, 0.5),
+        "body_size": min(options.body_size, 100),
+    })
+    transcript = generate_transcript(options)
+
+    for name, use_results in [("error_heavy (ParserError)", False),
+                              ("error_heavy (CommandResult)", True)]:
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            writer = smtp.ResponseWriter(devnull, interactive=False)
+            server = smtp.SMTPServer(writer=writer)
+            server.process_email_message = lambda: None
+            elapsed = run_error_heavy(smtp, server, transcript, use_results)
+
+        report(name, len(transcript), elapsed)
+
+
+def run_fed_transcript(smtp, data: bytes, chunk_size: int) -> float:
+    """
+    Hands a transcript to SMTPServer.feed() chunk_size bytes at a time, with the output going to
+    /dev/null and without writing the messages to the mailboxes, and returns how long that took.
+    A chunk_size of 0 hands it to handle_line() one whole line at a time instead.
+    """
+
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        writer = smtp.ResponseWriter(devnull, interactive=False)
+        server = smtp.SMTPServer(writer=writer)
+        server.process_email_message = lambda: None
+
+        if chunk_size == 0:
+            lines = data.splitlines(keepends=True)
+            start = time.perf_counter()
+            for line in lines:
+                server.handle_line(line)
+        else:
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+            start = time.perf_counter()
+            for chunk in chunks:
+                server.feed(chunk)
+            server.feed_end()
+
+        writer.flush()
+        return time.perf_counter() - start
+
+
+def bench_feed(smtp, options: argparse.Namespace):
+    """
+    Hands a generated transcript (as bytes) to SMTPServer.feed() in chunks of different sizes,
+    the way a network connection delivers it, and compares that with handle_line() on lines that
+    were already split. With small chunks, most lines arrive in several pieces.
+    """
+
+    if not hasattr(smtp.SMTPServer, "feed"):
+        print("feed: this copy of SMTP1.py has no SMTPServer.feed()")
+        return
+
+    transcript = generate_transcript(options)
+    data = "".join(transcript).encode("ascii")
+
+    for chunk_size in [0, 16, 256, 64 * 1024]:
+        elapsed = run_fed_transcript(smtp, data, chunk_size)
+        name = "feed (whole lines)" if chunk_size == 0 else f"feed ({chunk_size}-byte chunks)"
+        report(name, len(transcript), elapsed)
+        report_metric(len(data) / 1_000_000 / elapsed, "MB/sec")
+
+
+def time_runs(command: list, transcript: bytes, runs: int, folder: str) -> float:
+    """
+    Runs command runs times in folder, with transcript as stdin and the output thrown away, and
+    returns how long that took in total.
+    """
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(command, input=transcript, stdout=subprocess.DEVNULL, cwd=folder,
+                       check=True)
+
+    return time.perf_counter() - start
+
+
+def bench_startup(smtp, options: argparse.Namespace):
+    """
+    Compares the wall-clock time of handling a short transcript with a fresh `SMTP1.py < file`
+    (cold: Python starts and imports everything every time) and with smtp_client.py sending it
+    to a running SMTP1.py --daemon (warm). Starting Python without doing anything is shown for
+    reference.
+    """
+
+    client = Path(__file__).resolve().parent / "smtp_client.py"
+    module = str(options.module)
+    if not hasattr(smtp, "run_daemon") or not client.exists():
+        print("startup: this copy of SMTP1.py has no --daemon mode")
+        return
+
+    transcript = "".join(generate_transcript(argparse.Namespace(
+        **{**vars(options), "messages": 2, "body_size": min(options.body_size, 200)}
+    ))).encode("ascii")
+    runs = max(options.repeat // 1000, 5)
+
+    with tempfile.TemporaryDirectory() as folder:
+        socket_path = os.path.join(folder, "smtp1.sock")
+        daemon = subprocess.Popen([sys.executable, module, "--daemon", socket_path], cwd=folder,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            # Wait for the daemon to start listening
+            deadline = time.perf_counter() + 30
+            while not os.path.exists(socket_path):
+                if daemon.poll() is not None or time.perf_counter() > deadline:
+                    raise RuntimeError("SMTP1.py --daemon did not start")
+                time.sleep(0.01)
+
+            commands = [
+                ("startup (python -c pass)", [sys.executable, "-c", "pass"]),
+                ("startup (cold: SMTP1.py)", [sys.executable, module]),
+                ("startup (warm: smtp_client.py)", [sys.executable, str(client), socket_path]),
+            ]
+            for name, command in commands:
+                elapsed = time_runs(command, transcript, runs, folder)
+                report(name, runs, elapsed, unit="run")
+                report_metric(elapsed / runs * 1000, "ms/run")
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+def current_commit() -> str:
+    """
+    Returns the commit that the working tree is on (with "-dirty" if it has uncommitted changes),
+    or "unknown" outside of a git repository.
+    """
+
+    folder = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=folder,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                 cwd=folder, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return f"{commit}-dirty" if changes.strip() else commit
+
+
+def save_results(path: Path, options: argparse.Namespace):
+    """
+    Appends the results of this run to a JSON Lines file, one line per result.
+    """
+
+    run = {
+        "commit": current_commit(),
+        "module": str(options.module),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    with path.open("a", encoding="utf-8") as results_file:
+        for result in RESULTS:
+            results_file.write(json.dumps({**run, **result}) + "\n")
+
+
+def compare_results(path: Path):
+    """
+    Prints how much faster or slower every result of this run is than the last result with the
+    same name in a file written by save_results().
+    """
+
+    saved = {}
+    if path.exists():
+        with path.open(encoding="utf-8") as results_file:
+            for line in results_file:
+                if line.strip():
+                    result = json.loads(line)
+                    saved[result["name"]] = result
+
+    print()
+    print(f"compared with {path}:")
+    for result in RESULTS:
+        previous = saved.get(result["name"])
+        rate_key = next(key for key in result if key.endswith("s/sec"))
+        if previous is None or not previous.get(rate_key):
+            print(f"{result['name']:<40} {'':>10} (nothing saved)")
+            continue
+
+        change = (result[rate_key] / previous[rate_key] - 1) * 100
+        print(f"{result['name']:<40} {change:+9.1f}% {rate_key} (vs {previous['commit']})")
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """
+    Returns the value at the given fraction (0.0 to 1.0) of a sorted list.
+    """
+
+    if not sorted_values:
+        return 0.0
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run_network_client(host: str, port: int, messages: int, latencies: list):
+    """
+    One client: sends `messages` messages over one connection, one command at a time, and records
+    how long each command took to be answered. Message lines are sent without waiting, since they
+    do not get a reply.
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    commands = [
+        b"MAIL FROM:<jeffay@cs.unc.edu>\n",
+        b"RCPT TO:<alice@cs.unc.edu>\n",
+        b"RCPT TO:<bob@cs.unc.edu>\n",
+        b"DATA\n",
+    ]
+    body = b"Hey Bob, do you really think we should use SMTP as a class\nproject in COMP 431?\n"
+
+    for _ in range(messages):
+        for command in commands + [body + b".\n"]:
+            start = time.perf_counter()
+            writer.write(command)
+            await writer.drain()
+            reply = await reader.readline()
+            latencies.append(time.perf_counter() - start)
+
+            if not reply.startswith((b"250", b"354")):
+                raise RuntimeError(f"unexpected reply: {reply!r}")
+
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run_network_benchmark(smtp, connections: int, messages: int) -> tuple:
+    """
+    Starts a listener on a free localhost port, opens `connections` connections at the same time
+    and returns (elapsed seconds, list of per-command latencies).
+    """
+
+    listener = await smtp.start_listener("127.0.0.1", 0)
+    host, port = listener.sockets[0].getsockname()[:2]
+    latencies = []
+
+    async with listener:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_network_client(host, port, messages, latencies) for _ in range(connections)
+        ])
+        elapsed = time.perf_counter() - start
+
+    return elapsed, latencies
+
+
+def bench_network(smtp, options: argparse.Namespace):
+    """
+    Opens options.connections simultaneous localhost connections to the asyncio listener and
+    reports the throughput and the per-command latency percentiles.
+    """
+
+    if not hasattr(smtp, "start_listener"):
+        print("network: this copy of SMTP1.py has no network listener")
+        return
+
+    messages = max(options.repeat // 1000, 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        current_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            elapsed, latencies = asyncio.run(
+                run_network_benchmark(smtp, options.connections, messages)
+            )
+        finally:
+            os.chdir(current_folder)
+
+    latencies.sort()
+    report(f"network ({options.connections} connections)", len(latencies), elapsed,
+           unit="command")
+    for label, fraction in [("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0)]:
+        report_metric(percentile(latencies, fraction) * 1000, f"ms {label} latency")
+
+
+BENCHMARKS = {
+    "recognition": bench_recognition,
+    "local_part": bench_local_part,
+    "message_body": bench_message_body,
+    "allocation": bench_allocation,
+    "delivery": bench_delivery,
+    "network": bench_network,
+    "nonterminals": bench_nonterminals,
+    "end_to_end": bench_end_to_end,
+    "deep_domain": bench_deep_domain,
+    "error_heavy": bench_error_heavy,
+    "feed": bench_feed,
+    "address_cache": bench_address_cache,
+    "process_lines": bench_process_lines,
+    "startup": bench_startup,
+    "mailbox_index": bench_mailbox_index,
+    "group_commit": bench_group_commit,
+    "journal": bench_journal,
+    "contention": bench_contention,
+}
+
+
+def main():
+    """
+    The starting point for the benchmarks.
+    """
+
+    arg_parser = argparse.ArgumentParser(description="Benchmarks for SMTP1.py")
+    arg_parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        default=list(BENCHMARKS),
+        help=f"Which benchmarks to run (default: all of them). Choices: {', '.join(BENCHMARKS)}"
+    )
+    arg_parser.add_argument(
+        "--module",
+        type=Path,
+        default=Path(__file__).resolve().parent / "SMTP1.py",
+        help="Path to the copy of SMTP1.py to measure."
+    )
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=20_000,
+        help="How many times each workload is repeated."
+    )
+    arg_parser.add_argument(
+        "--lines",
+        type=int,
+        default=1_000_000,
+        help="How many lines are in the transcripts used by the allocation benchmark."
+    )
+    arg_parser.add_argument(
+        "--connections",
+        type=int,
+        default=200,
+        help="How many simultaneous connections the network benchmark opens."
+    )
+    arg_parser.add_argument(
+        "--messages",
+        type=int,
+        default=10_000,
+        help="How many email messages are in a generated transcript."
+    )
+    arg_parser.add_argument(
+        "--recipients",
+        type=int,
+        default=3,
+        help="How many RCPT TO commands each generated message has."
+    )
+    arg_parser.add_argument(
+        "--mailboxes",
+        type=int,
+        default=100,
+        help="How many different addresses a generated transcript uses."
+    )
+    arg_parser.add_argument(
+        "--body-size",
+        type=int,
+        default=1_000,
+        metavar="CHARS",
+        help="About how many characters the body of each generated message has."
+    )
+    arg_parser.add_argument(
+        "--line-length",
+        type=int,
+        default=78,
+        metavar="CHARS",
+        help="The longest line in the body of a generated message, including the line terminator."
+    )
+    for error_no in ERROR_LINES:
+        arg_parser.add_argument(
+            f"--error-{error_no}",
+            type=float,
+            default=0.0,
+            metavar="RATE",
+            help=f"The probability (0.0 to 1.0) of a line causing a {error_no} error before each "
+                 "generated message."
+        )
+    arg_parser.add_argument(
+        "--seed",
+        type=int,
+        default=431,
+        help="The seed for generating transcripts."
+    )
+    arg_parser.add_argument(
+        "--write-transcript",
+        type=Path,
+        metavar="PATH",
+        help="Write a generated transcript to PATH (e.g., for SMTP1.py --batch) instead of running "
+             "any benchmarks."
+    )
+    arg_parser.add_argument(
+        "--save",
+        type=Path,
+        metavar="PATH",
+        help="Append the results to this JSON Lines file, with the commit they were measured on."
+    )
+    arg_parser.add_argument(
+        "--compare",
+        type=Path,
+        metavar="PATH",
+        help="Compare the results with the last ones saved in this JSON Lines file."
+    )
+    command_line_args = arg_parser.parse_args()
+
+    for name in command_line_args.benchmarks:
+        if name not in BENCHMARKS:
+            arg_parser.error(f"unknown benchmark: {name}")
+
+    if command_line_args.write_transcript:
+        with command_line_args.write_transcript.open("w", encoding="utf-8", newline="") as output:
+            output.writelines(generate_transcript(command_line_args))
+        return
+
+    smtp = load_smtp_module(command_line_args.module)
+    print(f"module: {command_line_args.module}")
+
+    for name in command_line_args.benchmarks:
+        BENCHMARKS[name](smtp, command_line_args)
+
+    # Compare before saving, so that a run is not compared with itself
+    if command_line_args.compare:
+        compare_results(command_line_args.compare)
+
+    if command_line_args.save:
+        save_results(command_line_args.save, command_line_args)
+
+
+if __name__ == "__main__":
+    main()
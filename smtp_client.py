@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A thin client for SMTP1.py --daemon: sends stdin to the daemon over its Unix socket and writes
+what comes back to stdout, so that the output and the "forward" folder (in the current working
+directory) are the same as with `python3 ./SMTP1.py < transcript`.
+
+```bash
+python3 ./SMTP1.py --daemon /tmp/smtp1.sock &
+python3 ./smtp_client.py /tmp/smtp1.sock < testfile
+```
+
+Only a few small modules are imported here, so that starting this script stays much cheaper than
+starting SMTP1.py itself.
+"""
+
+import os
+import socket
+import sys
+import threading
+
+
+CHUNK_SIZE = 64 * 1024
+"""
+How many bytes are read from stdin or from the socket at a time.
+"""
+
+
+def send_input(connection: socket.socket, stream):
+    """
+    Sends everything from a buffered binary stream (e.g., sys.stdin.buffer) to the daemon, then
+    shuts down the sending side of the connection so that the daemon knows the transcript is
+    complete.
+    """
+
+    try:
+        while True:
+            chunk = stream.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            connection.sendall(chunk)
+    except (BrokenPipeError, ConnectionResetError):
+        # The daemon stopped reading (an unexpected error); what it sent back is still written
+        return
+
+    connection.shutdown(socket.SHUT_WR)
+
+
+def main():
+    """
+    The starting point for the client.
+    """
+
+    if len(sys.argv) != 2:
+        print(f"usage: {sys.argv[0]} SOCKET < transcript", file=sys.stderr)
+        sys.exit(2)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(sys.argv[1])
+
+        # The first line tells the daemon where the "forward" folder goes
+        connection.sendall(os.fsencode(os.getcwd()) + b"\n")
+
+        # Replies come back while the input is still being sent, so sending happens in a thread;
+        # otherwise a long transcript could fill both directions of the socket and get stuck.
+        sender = threading.Thread(target=send_input, args=(connection, sys.stdin.buffer),
+                                  daemon=True)
+        sender.start()
+
+        output = sys.stdout.buffer
+        while True:
+            chunk = connection.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            output.write(chunk)
+            output.flush()
+
+
+if __name__ == "__main__":
+    main()